@@ -1,26 +1,247 @@
+import re
+import time
+import bisect
 import socket
 import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from cinp import client
 from urllib import request, parse
 
+from subcontractor_plugins.common.connection import PooledHTTPHandler, PooledHTTPSHandler
+
 
 PACKRAT_API_VERSION = '2.0'
+MANIFEST_TTL = 60  # in seconds, cached manifests younger than this are used without checking back with packrat
+VERSION_RANGE_OPERATORS = ( '>=', '<=', '>', '<' )
+SESSION_POOL_MAX = 4  # max number of idle sessions kept per host/username/proxy
+SESSION_IDLE_TIMEOUT = 3600  # in seconds, idle sessions older than this are thrown away
+BATCH_WORKERS = 8  # number of files addPackageFiles works on at once
+
+
+def _version_part_key( part ):
+  result = []
+  for non_digit, digit in re.findall( r'(\D*)(\d*)', part ):
+    if not non_digit and not digit:
+      continue
+
+    # '~' sorts before everything, even the end of the string, then letters, then everything else
+    result.append( tuple( -1 if c == '~' else ( ord( c ) if c.isalpha() else ord( c ) + 256 ) for c in non_digit ) + ( 0, ) )
+    result.append( int( digit or 0 ) )
+
+  result.append( ( 0, ) )  # the end of the string, so 1.0~rc1 < 1.0 < 1.0.1
+  result.append( 0 )
+  return tuple( result )
+
+
+def version_key( version ):
+  """
+  Returns a sort key for version that orders versions the way dpkg does, ie: 1.9 < 1.10, 1.0~rc1 < 1.0, 1:0.5 > 2.0
+  """
+  epoch = 0
+  head, sep, tail = version.partition( ':' )
+  if sep and head.isdigit():
+    epoch = int( head )
+    version = tail
+
+  upstream, sep, revision = version.rpartition( '-' )
+  if not sep:
+    upstream, revision = version, ''
+
+  return ( epoch, _version_part_key( upstream ), _version_part_key( revision ) )
+
+
+def is_exact_version( query ):
+  """
+  Returns True if the version query from a packrat url names one specific version.
+  """
+  query = parse.unquote( query or '' )
+  return bool( query ) and query != 'latest' and not query.endswith( '*' ) and not query.startswith( VERSION_RANGE_OPERATORS )
+
+
+class VersionIndex():
+  """
+  The versions of a package of one type in a repo, sorted once when the manifest is loaded, so
+  finding the latest, latest matching a prefix or latest in a range is a bisect.
+  """
+  def __init__( self, entry_map ):
+    super().__init__()
+    self.entry_map = entry_map
+    self.version_list = sorted( entry_map.keys(), key=version_key )
+    self.key_list = [ version_key( version ) for version in self.version_list ]
+
+  def __len__( self ):
+    return len( self.version_list )
+
+  def _latest( self, low, high ):
+    if high <= low:
+      raise KeyError()
+
+    return self.entry_map[ self.version_list[ high - 1 ] ]
+
+  def find( self, query ):
+    """
+    Returns the manifest entry for query, raises KeyError if there is no match.  query is one of:
+      None or 'latest'  the latest version
+      '1.2.3'           that exact version
+      '1.2.*'           the latest 1.2 version, ie: >=1.2~,<1.3~
+      '>=1.2,<2.0'      the latest version in the range, constraints are >=, >, <= and <, seperated by ','
+    """
+    if query is None or query in ( '', 'latest', '*' ):
+      return self._latest( 0, len( self.key_list ) )
+
+    if query.endswith( '*' ):
+      prefix = query[ :-1 ].rstrip( '.' )
+      match = re.match( r'^(.*?)(\d+)$', prefix )
+      if match is None:
+        raise ValueError( 'Version prefix "{0}" must end in a number'.format( query ) )
+
+      upper = '{0}{1}'.format( match.group( 1 ), int( match.group( 2 ) ) + 1 )
+      query = '>={0}~,<{1}~'.format( prefix, upper )
+
+    if not query.startswith( VERSION_RANGE_OPERATORS ):
+      return self.entry_map[ query ]
+
+    low = 0
+    high = len( self.key_list )
+    for constraint in query.split( ',' ):
+      constraint = constraint.strip()
+      for operator in VERSION_RANGE_OPERATORS:
+        if constraint.startswith( operator ):
+          key = version_key( constraint[ len( operator ): ].strip() )
+          break
+      else:
+        raise ValueError( 'Invalid version constraint "{0}"'.format( constraint ) )
+
+      if operator == '>=':
+        low = max( low, bisect.bisect_left( self.key_list, key ) )
+      elif operator == '>':
+        low = max( low, bisect.bisect_right( self.key_list, key ) )
+      elif operator == '<=':
+        high = min( high, bisect.bisect_right( self.key_list, key ) )
+      else:
+        high = min( high, bisect.bisect_left( self.key_list, key ) )
+
+    return self._latest( low, high )
+
+
+class ManifestCache():
+  """
+  In process cache of repo manifests, by ( host, repo ), each is kept as an index of
+  package -> type -> VersionIndex.  Once older than the ttl they are revalidated with
+  If-None-Match/If-Modified-Since, so an unchanged manifest is not downloaded and parsed again.
+  """
+  def __init__( self, ttl ):
+    super().__init__()
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.manifest_map = {}  # ( host, repo ) -> { 'index':, 'etag':, 'last_modified':, 'fetched': }
+
+  def get( self, host, repo ):
+    """
+    Returns ( index, header_map ), index is None if the manifest needs to be ( re )fetched,
+    header_map is the headers to make the fetch conditional with.
+    """
+    with self.lock:
+      manifest = self.manifest_map.get( ( host, repo ), None )
+
+    if manifest is None:
+      return None, {}
+
+    if time.monotonic() - manifest[ 'fetched' ] < self.ttl:
+      return manifest[ 'index' ], {}
+
+    header_map = {}
+    if manifest[ 'etag' ] is not None:
+      header_map[ 'If-None-Match' ] = manifest[ 'etag' ]
+    if manifest[ 'last_modified' ] is not None:
+      header_map[ 'If-Modified-Since' ] = manifest[ 'last_modified' ]
+
+    return None, header_map
+
+  def put( self, host, repo, manifest, etag, last_modified ):
+    """
+    Index and store the parsed manifest, returns the index.
+    """
+    index = {}
+    for package, entry_list in manifest.items():
+      type_map = {}
+      for entry in entry_list:
+        type_map.setdefault( entry[ 'type' ], {} )[ entry[ 'version' ] ] = entry
+
+      index[ package ] = dict( ( file_type, VersionIndex( entry_map ) ) for file_type, entry_map in type_map.items() )
+
+    with self.lock:
+      self.manifest_map[ ( host, repo ) ] = { 'index': index, 'etag': etag, 'last_modified': last_modified, 'fetched': time.monotonic() }
+
+    return index
+
+  def renew( self, host, repo ):
+    """
+    The manifest was not modified, returns the index allready cached, or None if it was invalidated in the mean time.
+    """
+    with self.lock:
+      try:
+        manifest = self.manifest_map[ ( host, repo ) ]
+      except KeyError:
+        return None
+
+      manifest[ 'fetched' ] = time.monotonic()
+      return manifest[ 'index' ]
+
+  def invalidate( self, host ):
+    """
+    Drop the manifests for all the repos on host, ie: after uploading to it.
+    """
+    with self.lock:
+      for key in [ key for key in self.manifest_map.keys() if key[0] == host ]:
+        del self.manifest_map[ key ]
+
+
+MANIFEST_CACHE = ManifestCache( MANIFEST_TTL )
 
 
 class Packrat():
   def __init__( self, host, username, password, proxy ):
+    self.url = host
+    self.host = parse.urlparse( host ).netloc
+    self.username = username
+    self.password = password
+    self.proxy = proxy
+    self.login_lock = threading.Lock()
     self.cinp = client.CInP( host, '/api/v2/', proxy )
 
     root = self.cinp.describe( '/api/v2/' )
     if root[ 'api-version' ] != PACKRAT_API_VERSION:
       raise Exception( 'Expected API version "{0}" found "{1}"'.format( PACKRAT_API_VERSION, root[ 'api-version' ] ) )
 
-    self.token = self.cinp.call( '/api/v2/Auth/User(login)', { 'username': username, 'password': password } )
-    self.cinp.setAuth( username, self.token )
+    self.login()
 
-  def addPackageFile( self, file_uri, justification, provenance, type, distroversion ):
-    distroversion_list = self.cinp.call( '/api/v2/Package/PackageFile(distroversionOptions)', { 'file': file_uri } )
+  def login( self, expired_token=None ):
+    with self.login_lock:
+      if expired_token is not None and self.token != expired_token:  # another thread allready logged in again
+        return
+
+      self.cinp.setAuth()
+      self.token = self.cinp.call( '/api/v2/Auth/User(login)', { 'username': self.username, 'password': self.password } )
+      self.cinp.setAuth( self.username, self.token )
+
+  def _call( self, uri, args, **kwargs ):
+    """
+    cinp call, if the session token has expired, login again and retry.
+    """
+    token = self.token
+    try:
+      return self.cinp.call( uri, args, **kwargs )
+    except client.InvalidSession:
+      logging.debug( 'Packrat: session for "{0}" on "{1}" expired, logging in again'.format( self.username, self.host ) )
+
+    self.login( token )
+    return self.cinp.call( uri, args, **kwargs )
+
+  def _getDistroversion( self, file_uri, distroversion ):
+    distroversion_list = self._call( '/api/v2/Package/PackageFile(distroversionOptions)', { 'file': file_uri } )
     if distroversion is not None:
       if distroversion not in distroversion_list:
         raise Exception( 'distroversion "{0}" not in aviable distroverison list "{1}"'.format( distroversion, distroversion_list ) )
@@ -31,22 +252,115 @@ class Packrat():
       else:
         distroversion = distroversion_list[0]
 
+    return distroversion
+
+  def _addPackageFile( self, file_uri, justification, provenance, type, distroversion ):
+    distroversion = self._getDistroversion( file_uri, distroversion )
+
     logging.info( 'Packrat: Adding file "{0}", justification: "{1}", provenance: "{2}", '
                   'distroversion: "{3}", type: "{4}"'.format( file_uri, justification, provenance, distroversion, type ) )
 
-    result = self.cinp.call( '/api/v2/Package/PackageFile(create)',
-                             {
-                                 'file': file_uri,
-                                 'justification': justification,
-                                 'provenance': provenance,
-                                 'distroversion': distroversion,
-                                 'type': type
-                             }, timeout=300 )  # it can sometimes take a while for packrat to commit large files, thus the long timeout
+    return self._call( '/api/v2/Package/PackageFile(create)',
+                       {
+                           'file': file_uri,
+                           'justification': justification,
+                           'provenance': provenance,
+                           'distroversion': distroversion,
+                           'type': type
+                       }, timeout=300 )  # it can sometimes take a while for packrat to commit large files, thus the long timeout
+
+  def addPackageFile( self, file_uri, justification, provenance, type, distroversion ):
+    result = self._addPackageFile( file_uri, justification, provenance, type, distroversion )
+    MANIFEST_CACHE.invalidate( self.host )
     return result
 
+  def addPackageFiles( self, file_list, max_workers=BATCH_WORKERS ):
+    """
+    Add many uploaded files at once, file_list is a list of dicts with the same keys as the paramaters
+    of addPackageFile.  Up to max_workers files are worked on at once, each file's create is sent as
+    soon as it's distroversion is resolved, without waiting on the others.  The cinp client is not
+    thread safe, so each worker borrows a session of it's own from PACKRAT_SESSIONS.
+    Returns a list, in the same order as file_list, of { 'file': file_uri, 'result': result of the create, 'error': None }
+    if the file failed, result is None and error is the error message, a failed file does not stop the others.
+    """
+    def _add( item ):
+      try:
+        with PACKRAT_SESSIONS.session( self.url, self.username, self.password, self.proxy ) as packrat:
+          result = packrat._addPackageFile( item[ 'file_uri' ], item[ 'justification' ], item[ 'provenance' ], item.get( 'type', None ), item.get( 'distroversion', None ) )
+      except Exception as e:
+        logging.warning( 'Packrat: Error adding file "{0}": "{1}"'.format( item[ 'file_uri' ], e ) )
+        return { 'file': item[ 'file_uri' ], 'result': None, 'error': str( e ) }
+
+      return { 'file': item[ 'file_uri' ], 'result': result, 'error': None }
+
+    try:
+      with ThreadPoolExecutor( max_workers=max( 1, min( max_workers, len( file_list ) ) ) ) as executor:
+        return list( executor.map( _add, file_list ) )
+
+    finally:
+      MANIFEST_CACHE.invalidate( self.host )
+
+
+class _PackratSession():
+  def __init__( self, pool, key, password ):
+    super().__init__()
+    self.pool = pool
+    self.key = key
+    self.password = password
+    self.packrat = None
+
+  def __enter__( self ):
+    self.packrat = self.pool._get( self.key, self.password )
+    return self.packrat
+
+  def __exit__( self, exc_type, exc_value, traceback ):
+    if exc_type is None:  # if something went wrong, the session may not be any good, don't reuse it
+      self.pool._put( self.key, self.packrat )
+
+
+class PackratSessionPool():
+  """
+  Logged in Packrat sessions, by host, username and proxy, so back to back uploads
+  skip the api version check and login.  A session is used by one thread at a time:
+
+    with PACKRAT_SESSIONS.session( host, username, password, proxy ) as packrat:
+      packrat.addPackageFile( ... )
+  """
+  def __init__( self, max_per_key, idle_timeout ):
+    super().__init__()
+    self.max_per_key = max_per_key
+    self.idle_timeout = idle_timeout
+    self.lock = threading.Lock()
+    self.idle_map = {}  # ( host, username, proxy ) -> [ ( Packrat, released at ) ]
+
+  def session( self, host, username, password, proxy ):
+    return _PackratSession( self, ( host, username, proxy ), password )
+
+  def _get( self, key, password ):
+    now = time.monotonic()
+    with self.lock:
+      idle_list = self.idle_map.get( key, [] )
+      while idle_list:
+        packrat, released = idle_list.pop()
+        if now - released < self.idle_timeout and packrat.password == password:
+          return packrat
+
+    host, username, proxy = key
+    logging.debug( 'Packrat: new session for "{0}" on "{1}"'.format( username, host ) )
+    return Packrat( host, username, password, proxy )
+
+  def _put( self, key, packrat ):
+    with self.lock:
+      idle_list = self.idle_map.setdefault( key, [] )
+      if len( idle_list ) < self.max_per_key:
+        idle_list.append( ( packrat, time.monotonic() ) )
+
+
+PACKRAT_SESSIONS = PackratSessionPool( SESSION_POOL_MAX, SESSION_IDLE_TIMEOUT )
+
 
 # TODO: study the way the proxy handler works and make this act more like that, we are carying way to much old baggage here
-# schema:   packrat(s)://host/repo/type/package[?version]  if version is omitted, then the latest version
+# schema:   packrat(s)://host/repo/type/package[?version]  if version is omitted, then the latest version, see VersionIndex.find for the version queries
 class PackratHandler( request.BaseHandler ):
   handler_order = 500  # same as regular http handler, mabey just before?
 
@@ -59,15 +373,14 @@ class PackratHandler( request.BaseHandler ):
   def add_parent( self, parent ):  # TODO: Until the proxy stuff is figured out, make sure to add PackratHandler after HTTP(s) and Proxy Handlers
     super().add_parent( parent )
 
-    handler_name_list = [ i.__class__.__name__ for i in self.parent.handlers ]
-
     self.opener = request.OpenerDirector()
-    if 'ProxyHandler' in handler_name_list:
-      self.opener.add_handler( request.ProxyHandler( self.parent.handlers[ handler_name_list.index( 'ProxyHandler' ) ].proxies ) )
+    for handler in self.parent.handlers:
+      if isinstance( handler, request.ProxyHandler ):
+        self.opener.add_handler( request.ProxyHandler( handler.proxies ) )
 
-    self.opener.add_handler( request.HTTPHandler() )
-    if 'HTTPSHandler' in handler_name_list:
-      self.opener.add_handler( request.HTTPSHandler() )
+    self.opener.add_handler( PooledHTTPHandler() )  # the connections are pooled, so the manifest and the file share connections with everything else
+    if [ i for i in self.parent.handlers if isinstance( i, request.HTTPSHandler ) ]:
+      self.opener.add_handler( PooledHTTPSHandler() )
 
     self.opener.addheaders = [ ( 'User-agent', 'subcontractor_plugin' ) ]
 
@@ -88,33 +401,41 @@ class PackratHandler( request.BaseHandler ):
 
   def _open_get( self, req, ssl, sslContext ):
     header_map = {}
-    package, version = parse.splitquery( req.selector )
+    url, entry = self.resolve( req.host, req.selector, ssl, req.timeout )
+
+    resp = self.opener.open( request.Request( url, headers=header_map, method='GET' ), timeout=req.timeout )
+    resp.packrat_entry = entry  # so the download cache can tell which version this is
+    return resp
+
+  def resolve( self, host, selector, ssl, timeout ):
+    """
+    Look up the package selector ( /repo/type/package[?version] ) refers to,
+    returns the ( url, manifest entry ) of the file.
+    """
+    package, version = parse.splitquery( selector )
     try:
       _, repo, file_type, package = package.split( '/' )
     except ValueError:
       raise ValueError( 'Unable to parse repo, type, and package' )
 
-    # TODO: somekind of manifest caching?
-    file_map = self._getFileList( req.host, repo, file_type, package, req.timeout )
-    if not file_map:
+    version_index = self._getFileList( host, repo, file_type, package, timeout )
+    if not version_index:
       raise Exception( 'Entries for Package "{0}" of type "{1}" not found in repo "{2}"'.format( package, file_type, repo ) )
 
-    if version is None:
-      version_list = file_map.keys()
-      entry = file_map[ sorted( version_list )[-1] ]
+    if version is not None:
+      version = parse.unquote( version )
 
-    else:
-      try:
-        entry = file_map[ version ]
-      except KeyError:
-        raise Exception( 'Version "{0}" for Package "{1}" of type "{2}" not found in repo "{3}"'.format( version, package, file_type, repo ) )
+    try:
+      entry = version_index.find( version )
+    except KeyError:
+      raise Exception( 'Version "{0}" for Package "{1}" of type "{2}" not found in repo "{3}"'.format( version, package, file_type, repo ) )
 
     if ssl:
-      url = 'https://{0}/{1}/{2}'.format( req.host, repo, entry[ 'path' ] )
+      url = 'https://{0}/{1}/{2}'.format( host, repo, entry[ 'path' ] )
     else:
-      url = 'http://{0}/{1}/{2}'.format( req.host, repo, entry[ 'path' ] )
+      url = 'http://{0}/{1}/{2}'.format( host, repo, entry[ 'path' ] )
 
-    return self.opener.open( request.Request( url, headers=header_map, method='GET' ), timeout=req.timeout )
+    return url, entry
 
   def _open_post( self, req, ssl, sslContext ):
     header_map = req.headers
@@ -124,13 +445,15 @@ class PackratHandler( request.BaseHandler ):
     else:
       url = 'http://{0}/api/upload'.format( req.host )
 
-    return self.opener.open( request.Request( url, data=req.data, headers=header_map, method='POST' ), timeout=req.timeout )
+    resp = self.opener.open( request.Request( url, data=req.data, headers=header_map, method='POST' ), timeout=req.timeout )
+    MANIFEST_CACHE.invalidate( req.host )
+    return resp
 
-  def _request( self, host, repo, file, timeout ):
+  def _request( self, host, repo, file, timeout, header_map=None ):
     url = 'http://{0}/{1}/{2}'.format( host, repo, file )
 
     try:
-      resp = self.opener.open( url, timeout=timeout )
+      resp = self.opener.open( request.Request( url, headers=header_map or {} ), timeout=timeout )
     except request.HTTPError as e:
       raise Exception( 'HTTPError "{0}"'.format( e ) )
 
@@ -149,24 +472,34 @@ class PackratHandler( request.BaseHandler ):
     if resp.code == 404:
       raise Exception( 'File "{0}" not Found'.format( url ) )
 
+    if resp.code == 304 and header_map:
+      resp.read()
+      return None
+
     if resp.code != 200:
       raise Exception( 'Invalid Response code "{0}"'.format( resp.code ) )
 
-    return resp.read()
+    return resp
 
-  def _getFileList( self, host, repo, file_type, package, timeout ):
-    result = {}
-    manifest = json.loads( self._request( host, repo, '_repo_main/MANIFEST_all.json', timeout ).decode() )  # TODO: remove decode when newer version of python
-    try:
-      entry_list = manifest[ package ]
-    except KeyError:
-      return {}
+  def _getManifest( self, host, repo, timeout ):
+    index, header_map = MANIFEST_CACHE.get( host, repo )
+    if index is not None:
+      return index
 
-    for entry in entry_list:
-      if entry[ 'type' ] == file_type:
-        result[ entry[ 'version' ] ] = entry
+    resp = self._request( host, repo, '_repo_main/MANIFEST_all.json', timeout, header_map )
+    if resp is None:  # not modified
+      logging.debug( 'Packrat: manifest for "{0}" on "{1}" not modified'.format( repo, host ) )
+      index = MANIFEST_CACHE.renew( host, repo )
+      if index is not None:
+        return index
 
-    return result
+      resp = self._request( host, repo, '_repo_main/MANIFEST_all.json', timeout )
+
+    manifest = json.loads( resp.read().decode() )  # TODO: remove decode when newer version of python
+    return MANIFEST_CACHE.put( host, repo, manifest, resp.headers.get( 'ETag', None ), resp.headers.get( 'Last-Modified', None ) )
+
+  def _getFileList( self, host, repo, file_type, package, timeout ):
+    return self._getManifest( host, repo, timeout ).get( package, {} ).get( file_type, None )
 
 
 class PackratsHandler( PackratHandler ):
@@ -0,0 +1,519 @@
+import ssl
+import time
+import weakref
+import asyncio
+import logging
+import email.parser
+from http import client
+from urllib import request, parse
+
+from subcontractor_plugins.common.Packrat import PackratHandler
+from subcontractor_plugins.common.cache import get_cache
+from subcontractor_plugins.common.connection import POOL_MAX_PER_HOST, POOL_IDLE_TIMEOUT, SEND_BLOCK_SIZE, _file_body
+from subcontractor_plugins.common.files import WEB_HANDLE_TIMEOUT, STREAM_CHUNK_SIZE, FileRetrieveException, Hasher, _expected_hashes, _get_opener, _destination, _add_package_file
+from subcontractor_plugins.common.transfer import SCHEDULER
+
+STREAM_LIMIT = 256 * 1024  # in bytes, how much a connection buffers ahead of it's reader, this is what bounds the memory used per transfer
+
+# asyncio versions of open_url, file_reader and file_writer from files.py, one event loop can drive
+# hundreds of these at once where the blocking versions need a thread each.  HTTP/1.1 is spoken directly
+# over asyncio streams, with keep-alive connections pooled per event loop.  packrat urls are resolved with
+# the blocking PackratHandler in the loop's executor, the file it resolves to is then transfered async.
+
+
+class _Connection():
+  def __init__( self, key, reader, writer ):
+    super().__init__()
+    self.key = key
+    self.reader = reader
+    self.writer = writer
+    self.released = None
+
+  def close( self ):
+    self.writer.close()
+
+
+class _ConnectionPool():
+  def __init__( self ):
+    super().__init__()
+    self.idle_map = {}  # key -> [ _Connection ], key is ( scheme, host, port, proxy, ssl context )
+
+  def get( self, key ):
+    now = time.monotonic()
+    for tmp_key in list( self.idle_map.keys() ):
+      idle_list = self.idle_map[ tmp_key ]
+      while idle_list and now - idle_list[0].released > POOL_IDLE_TIMEOUT:
+        idle_list.pop( 0 ).close()
+
+      if not idle_list:
+        del self.idle_map[ tmp_key ]
+
+    idle_list = self.idle_map.get( key, [] )
+    while idle_list:
+      conn = idle_list.pop()
+      if not conn.reader.at_eof() and not conn.writer.is_closing():  # at_eof is set once the other end has closed it
+        return conn
+
+      conn.close()
+
+    return None
+
+  def put( self, conn ):
+    idle_list = self.idle_map.setdefault( conn.key, [] )
+    if len( idle_list ) >= POOL_MAX_PER_HOST:
+      conn.close()
+      return
+
+    conn.released = time.monotonic()
+    idle_list.append( conn )
+
+
+_pool_map = weakref.WeakKeyDictionary()  # event loop -> _ConnectionPool, streams can't be shared between loops
+
+
+def _get_pool():
+  loop = asyncio.get_running_loop()
+  try:
+    return _pool_map[ loop ]
+  except KeyError:
+    pool = _ConnectionPool()
+    _pool_map[ loop ] = pool
+    return pool
+
+
+class AsyncResponse():
+  """
+  Response from open_url, the body is read with "await resp.read( size )".
+  Once the body has been read to the end the connection goes back to the pool.
+  """
+  def __init__( self, pool, conn, url, method, version, status, reason, headers ):
+    super().__init__()
+    self.pool = pool
+    self.conn = conn
+    self.url = url
+    self.code = status
+    self.status = status
+    self.reason = reason
+    self.headers = headers
+    self.will_close = version == 'HTTP/1.0' or 'close' in headers.get( 'Connection', '' ).lower()
+    self._chunked = 'chunked' in headers.get( 'Transfer-Encoding', '' ).lower()
+    self._chunk_left = 0
+    self._length = None
+    if not self._chunked:
+      try:
+        self._length = int( headers[ 'Content-Length' ] )
+      except ( TypeError, ValueError ):
+        self.will_close = True  # no length, the body runs until the connection is closed
+
+    self._done = False
+    if method == 'HEAD' or status in ( 204, 304 ):
+      self._length = 0
+      self._chunked = False
+
+  def _finish( self ):
+    self._done = True
+    conn, self.conn = self.conn, None
+    if conn is None:
+      return
+
+    if self.will_close:
+      conn.close()
+    else:
+      self.pool.put( conn )
+
+  async def _read( self, size ):
+    reader = self.conn.reader
+    if self._chunked:
+      if not self._chunk_left:
+        line = await reader.readline()
+        try:
+          chunk_size = int( line.split( b';' )[0].strip(), 16 )
+        except ValueError:
+          raise FileRetrieveException( 'Invalid chunk length "{0}" from "{1}"'.format( line, self.url ) )
+
+        if not chunk_size:
+          while line not in ( b'\r\n', b'\n', b'' ):  # skip any trailers
+            line = await reader.readline()
+
+          self._finish()
+          return b''
+
+        self._chunk_left = chunk_size
+
+      buff = await reader.read( min( size, self._chunk_left ) )
+      if not buff:
+        raise FileRetrieveException( 'Connection closed in the middle of a chunk from "{0}"'.format( self.url ) )
+
+      self._chunk_left -= len( buff )
+      if not self._chunk_left:
+        await reader.readline()
+
+      return buff
+
+    if self._length is not None:
+      if not self._length:
+        self._finish()
+        return b''
+
+      buff = await reader.read( min( size, self._length ) )
+      if not buff:
+        raise FileRetrieveException( 'Connection closed with {0} bytes to go from "{1}"'.format( self._length, self.url ) )
+
+      self._length -= len( buff )
+      if not self._length:
+        self._finish()
+
+      return buff
+
+    buff = await reader.read( size )
+    if not buff:
+      self._finish()
+
+    return buff
+
+  async def read( self, size=-1 ):
+    """
+    Returns up to size bytes of the body, b'' at the end.  if size is omitted, the rest of the body.
+    """
+    if size is None or size < 0:
+      part_list = []
+      buff = await self.read( STREAM_CHUNK_SIZE )
+      while buff:
+        part_list.append( buff )
+        buff = await self.read( STREAM_CHUNK_SIZE )
+
+      return b''.join( part_list )
+
+    if self._done:
+      return b''
+
+    try:
+      return await asyncio.wait_for( self._read( size ), WEB_HANDLE_TIMEOUT )
+    except TimeoutError:
+      self.close()
+      raise FileRetrieveException( 'Request Timeout after {0} seconds'.format( WEB_HANDLE_TIMEOUT ) )
+
+    except ( OSError, asyncio.IncompleteReadError ) as e:
+      self.close()
+      raise FileRetrieveException( 'Socket Error "{0}"'.format( e ) )
+
+  def close( self ):
+    """
+    Closing before the body has been read to the end closes the connection instead of pooling it.
+    """
+    self._done = True
+    conn, self.conn = self.conn, None
+    if conn is not None:
+      conn.close()
+
+  async def __aenter__( self ):
+    return self
+
+  async def __aexit__( self, exc_type, exc_value, traceback ):
+    self.close()
+
+
+async def _read_head( reader ):
+  while True:
+    head = await reader.readuntil( b'\r\n\r\n' )
+    status_line, _, header_text = head.decode( 'iso-8859-1' ).partition( '\r\n' )
+    try:
+      version, status, reason = ( status_line.split( ' ', 2 ) + [ '' ] )[ :3 ]
+      status = int( status )
+    except ValueError:
+      raise client.BadStatusLine( status_line )
+
+    if status != 100:  # skip any 100 Continue
+      return version, status, reason, email.parser.Parser( _class=client.HTTPMessage ).parsestr( header_text )
+
+
+async def _connect( scheme, host, port, proxy, sslContext ):
+  if scheme == 'https' and sslContext is None:
+    sslContext = ssl.create_default_context()
+
+  if not proxy:
+    return await asyncio.open_connection( host, port, ssl=sslContext if scheme == 'https' else None, limit=STREAM_LIMIT )
+
+  proxy_parts = parse.urlsplit( proxy if '://' in proxy else 'http://{0}'.format( proxy ) )
+  reader, writer = await asyncio.open_connection( proxy_parts.hostname, proxy_parts.port or 80, limit=STREAM_LIMIT )
+  if scheme == 'https':
+    writer.write( 'CONNECT {0}:{1} HTTP/1.1\r\nHost: {0}:{1}\r\n\r\n'.format( host, port ).encode( 'iso-8859-1' ) )
+    _, status, reason, _ = await _read_head( reader )
+    if status != 200:
+      writer.close()
+      raise FileRetrieveException( 'Proxy "{0}" refused CONNECT to "{1}:{2}": "{3} {4}"'.format( proxy, host, port, status, reason ) )
+
+    await writer.start_tls( sslContext, server_hostname=host )
+
+  return reader, writer
+
+
+def _body_info( body, header_map ):
+  """
+  returns ( header map, length ) for sending body, if the length is not known, the header map is set for chunked
+  """
+  name_map = dict( ( name.lower(), name ) for name in header_map.keys() )
+  if 'content-length' in name_map:
+    return header_map, int( header_map[ name_map[ 'content-length' ] ] )
+
+  if 'transfer-encoding' in name_map:
+    return header_map, None
+
+  if body is None:
+    return header_map, 0
+
+  if isinstance( body, ( bytes, bytearray ) ):
+    return dict( header_map, **{ 'Content-Length': str( len( body ) ) } ), len( body )
+
+  file_body = _file_body( body )
+  if file_body is not None:
+    file, offset = file_body
+    length = file.seek( 0, 2 ) - offset
+    file.seek( offset )
+    return dict( header_map, **{ 'Content-Length': str( length ) } ), length
+
+  return dict( header_map, **{ 'Transfer-Encoding': 'chunked' } ), None
+
+
+async def _send_body( writer, body, length, transfer ):
+  loop = asyncio.get_running_loop()
+  chunked = length is None
+
+  async def _write( buff ):
+    if chunked:
+      writer.writelines( [ '{0:X}\r\n'.format( len( buff ) ).encode(), buff, b'\r\n' ] )
+    else:
+      writer.write( buff )
+
+    await writer.drain()
+    if transfer is not None:
+      delay = transfer.take( len( buff ) )
+      if delay > 0:
+        await asyncio.sleep( delay )
+
+  if body is None:
+    pass
+
+  elif isinstance( body, ( bytes, bytearray ) ):
+    await _write( body )
+
+  elif hasattr( body, '__aiter__' ):  # ie: another transfer's file_reader
+    async for buff in body:
+      if buff:
+        await _write( buff )
+
+  elif not chunked and _file_body( body ) is not None:  # loop.sendfile uses os.sendfile when it can, otherwise reads the file in the executor
+    await writer.drain()
+    offset = body.tell()
+    end = offset + length
+    while offset < end:
+      block = min( SEND_BLOCK_SIZE, end - offset )
+      await loop.sendfile( writer.transport, body, offset, block )
+      offset += block
+      if transfer is not None:
+        delay = transfer.take( block )
+        if delay > 0:
+          await asyncio.sleep( delay )
+
+  else:
+    buff = await loop.run_in_executor( None, body.read, SEND_BLOCK_SIZE )
+    while buff:
+      await _write( buff )
+      buff = await loop.run_in_executor( None, body.read, SEND_BLOCK_SIZE )
+
+  if chunked:
+    writer.write( b'0\r\n\r\n' )
+    await writer.drain()
+
+
+def _packrat_handler( proxy ):
+  for handler in _get_opener( proxy ).handlers:
+    if isinstance( handler, PackratHandler ):
+      return handler
+
+  raise FileRetrieveException( 'No packrat handler' )
+
+
+async def open_url( url, proxy, resp_code, sslContext, transfer=None ):
+  """
+  async version of files.open_url, url is a str or a urllib.request.Request, returns an AsyncResponse.
+  The request body ( the Request's data ) can be bytes, a file or an async iterable of bytes.
+  if transfer is given, the bytes sent are counted against it.
+  """
+  if isinstance( url, request.Request ):
+    method = url.get_method()
+    header_map = dict( ( name.title(), value ) for name, value in url.header_items() )
+    body = url.data
+    url = url.full_url
+  else:
+    method = 'GET'
+    header_map = {}
+    body = None
+
+  logging.info( 'opener: opening "{0}"'.format( url ) )
+
+  loop = asyncio.get_running_loop()
+  parts = parse.urlsplit( url )
+  entry = None
+  if parts.scheme in ( 'packrat', 'packrats' ):
+    is_ssl = parts.scheme == 'packrats'
+    if method == 'GET':
+      selector = parse.urlunsplit( ( '', '', parts.path, parts.query, '' ) )
+      url, entry = await loop.run_in_executor( None, _packrat_handler( proxy ).resolve, parts.netloc, selector, is_ssl, WEB_HANDLE_TIMEOUT )
+
+    else:
+      url = '{0}://{1}/api/upload'.format( 'https' if is_ssl else 'http', parts.netloc )
+
+    parts = parse.urlsplit( url )
+
+  if parts.scheme not in ( 'http', 'https' ):
+    raise FileRetrieveException( 'Scheme "{0}" not supported by the async opener'.format( parts.scheme ) )
+
+  host = parts.hostname
+  port = parts.port or ( 443 if parts.scheme == 'https' else 80 )
+  if proxy and parts.scheme == 'http':
+    selector = url  # plain http proxies get the whole url
+  else:
+    selector = parse.urlunsplit( ( '', '', parts.path or '/', parts.query, '' ) )
+
+  header_map, length = _body_info( body, header_map )
+  header_map.setdefault( 'Host', parts.netloc.rsplit( '@', 1 )[ -1 ] )
+  header_map.setdefault( 'User-Agent', 'subcontractor_plugin' )
+  header_map.setdefault( 'Accept-Encoding', 'identity' )
+  head = '{0} {1} HTTP/1.1\r\n{2}\r\n'.format( method, selector, ''.join( '{0}: {1}\r\n'.format( name, value ) for name, value in header_map.items() ) ).encode( 'iso-8859-1' )
+
+  key = ( parts.scheme, host, port, proxy, sslContext )
+  pool = _get_pool()
+  replayable = body is None or isinstance( body, ( bytes, bytearray ) )  # can't resend a file or iterator if the reused connection turns out to be dead
+  conn = pool.get( key ) if replayable else None
+  while True:
+    reused = conn is not None
+    try:
+      if conn is None:
+        conn = _Connection( key, *await asyncio.wait_for( _connect( parts.scheme, host, port, proxy, sslContext ), WEB_HANDLE_TIMEOUT ) )
+
+      conn.writer.write( head )
+      await _send_body( conn.writer, body, length, transfer )
+      version, status, reason, headers = await asyncio.wait_for( _read_head( conn.reader ), WEB_HANDLE_TIMEOUT )
+
+    except TimeoutError:
+      if conn is not None:
+        conn.close()
+
+      raise FileRetrieveException( 'Request Timeout after {0} seconds'.format( WEB_HANDLE_TIMEOUT ) )
+
+    except ( OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, client.HTTPException ) as e:
+      if conn is not None:
+        conn.close()
+
+      conn = None
+      if reused and isinstance( e, ( ConnectionError, asyncio.IncompleteReadError ) ):
+        logging.debug( 'opener: pooled connection to "{0}" went away, reconnecting'.format( host ) )
+        continue
+
+      raise FileRetrieveException( 'Socket Error "{0}" for "{1}" via "{2}"'.format( e, url, proxy ) )
+
+    break
+
+  resp = AsyncResponse( pool, conn, url, method, version, status, reason, headers )
+  if entry is not None:
+    resp.packrat_entry = entry
+
+  if resp.code == 404:
+    resp.close()
+    raise FileRetrieveException( 'File "{0}" not Found'.format( url ) )
+
+  if resp.code != resp_code:
+    resp.close()
+    raise FileRetrieveException( 'Invalid Response code "{0}"'.format( resp.code ) )
+
+  return resp
+
+
+def _size( resp ):
+  try:
+    return int( resp.headers[ 'Content-Length' ] )
+  except ( TypeError, ValueError ):
+    return None
+
+
+async def file_reader( url, proxy, sslContext ):
+  """
+  async version of files.file_reader, an async generator of the contents of url in chunks of up to STREAM_CHUNK_SIZE bytes:
+
+    async for buff in file_reader( url, None, None ):
+      ...
+
+  The contents are hashed and checked against the hashes packrat has, FileHashException
+  is raised at the end if they do not match.  Files allready in the download cache are read from there.
+  """
+  logging.debug( 'file_reader: async downloading "{0}"'.format( url ) )
+  loop = asyncio.get_running_loop()
+  cache = get_cache()
+  local_file = None
+  if cache is not None and isinstance( url, str ):
+    local_file = cache.get( url )
+
+  if local_file is not None:
+    with local_file:
+      buff = await loop.run_in_executor( None, local_file.read, STREAM_CHUNK_SIZE )
+      while buff:
+        yield buff
+        buff = await loop.run_in_executor( None, local_file.read, STREAM_CHUNK_SIZE )
+
+    return
+
+  resp = await open_url( url, proxy, 200, sslContext )
+  transfer = SCHEDULER.unscheduled_transfer( 'download "{0}"'.format( url ), _destination( url ), _size( resp ) )
+  try:
+    hasher = Hasher( resp.url, _expected_hashes( resp ) )
+    buff = await resp.read( STREAM_CHUNK_SIZE )
+    while buff:
+      hasher.update( buff )
+      delay = transfer.take( len( buff ) )
+      if delay > 0:
+        await asyncio.sleep( delay )
+
+      yield buff
+      buff = await resp.read( STREAM_CHUNK_SIZE )
+
+    hasher.verify()
+
+  finally:
+    resp.close()
+    transfer.finish()
+
+
+async def file_writer( url, local_file, filename, proxy, sslContext ):
+  """
+  async version of files.file_writer, local_file can be a file or an async iterable of bytes,
+  so the output of file_reader can be uploaded as it is downloaded.
+  """
+  logging.debug( 'file_writer: async uploading to "{0}"'.format( url ) )
+
+  header_map = {
+                 'Content-Disposition': 'inline: filename="{0}"'.format( filename ),
+                 'Content-Type': 'application/octet-stream'
+               }
+
+  if hasattr( local_file, '__aiter__' ):
+    header_map[ 'Transfer-Encoding' ] = 'chunked'
+
+  else:
+    try:
+      header_map[ 'Content-Length' ] = local_file.seek( 0, 2 )
+      local_file.seek( 0, 0 )
+
+    except ( AttributeError, OSError ):  # not seekable, send it chunked
+      header_map[ 'Transfer-Encoding' ] = 'chunked'
+
+  transfer = SCHEDULER.unscheduled_transfer( 'upload "{0}"'.format( filename ), _destination( url ), header_map.get( 'Content-Length', None ) )
+  try:
+    req = request.Request( url, data=local_file, headers=header_map, method='POST' )
+    resp = await open_url( req, proxy, 202, sslContext, transfer )
+    result = await resp.read()
+
+  finally:
+    transfer.finish()
+
+  await asyncio.get_running_loop().run_in_executor( None, _add_package_file, url, result, proxy )
@@ -0,0 +1,377 @@
+import os
+import io
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+from tempfile import NamedTemporaryFile
+
+CACHE_DIR = '/var/cache/subcontractor_plugins'  # set to None to disable the download cache
+CACHE_MAX_SIZE = 20 * 1024 * 1024 * 1024  # in bytes
+CACHE_TRUST_TTL = 60  # in seconds, entries newer than this are handed out without checking back with the server
+CACHE_PARTIAL_TTL = 86400  # in seconds, how long to keep partial downloads arround to resume from
+CACHE_RECENT_MAX = 100  # number of recently used urls to remember for the prefetcher
+CACHE_RECENT_INTERVAL = 300  # in seconds, a url used again within this of being recorded is not recorded again
+
+_local = threading.local()
+
+
+def set_recording( enabled ):
+  """
+  Turn recording of url use on/off for the calling thread, so the prefetcher fetching a url does not count as using it.
+  """
+  _local.recording = enabled
+
+
+class CachedFile( io.BufferedReader ):
+  """
+  Read only handle to a file in the download cache.
+  """
+  def __init__( self, path ):
+    super().__init__( io.FileIO( path, 'r' ) )
+    self.digest_map = {}
+    self.tar_index = None
+
+
+class DownloadCache():
+  """
+  Content cache for downloaded files, the entry for a url is named by the hash of the url, with
+  a json sidecar holding the validator (packrat version, ETag or Last-Modified) it was downloaded with.
+  Entries are filled into a temp file and renamed into place, so readers never see a partial file,
+  and handles allready open to an evicted entry keep working.
+  """
+  def __init__( self, cache_dir, max_size ):
+    super().__init__()
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    self.lock = threading.Lock()
+    self.recent_lock = threading.Lock()
+    self.recorded_map = {}  # url -> when this process last wrote it to recent.json
+
+  def _path( self, url ):
+    return os.path.join( self.cache_dir, hashlib.sha256( url.encode() ).hexdigest() )
+
+  def _readMeta( self, path ):
+    try:
+      with open( path + '.json', 'r' ) as fp:
+        return json.load( fp )
+    except ( OSError, ValueError ):
+      return None
+
+  def lock_entry( self, url ):
+    """
+    Returns an open lock file, hold it ( with fcntl.flock ) while filling the entry so concurrent
+    readers of the same url wait for the first download instead of all downloading it.
+    """
+    lock_file = open( self._path( url ) + '.lock', 'w' )
+    fcntl.flock( lock_file, fcntl.LOCK_EX )
+    return lock_file
+
+  def get( self, url, validator=None ):
+    """
+    Returns a CachedFile for url or None if there is no usable entry.
+    if validator is None, the entry is only used if it is immutable or younger than CACHE_TRUST_TTL.
+    """
+    path = self._path( url )
+    meta = self._readMeta( path )
+    if meta is None or meta[ 'url' ] != url:
+      return None
+
+    if validator is None:
+      if not meta[ 'immutable' ] and time.time() - meta[ 'fetched' ] > CACHE_TRUST_TTL:
+        return None
+
+    elif meta[ 'validator' ] != validator:
+      return None
+
+    try:
+      result = CachedFile( path )
+    except FileNotFoundError:  # evicted from under us
+      return None
+
+    os.utime( path )  # for the LRU
+    result.digest_map = meta.get( 'digest_map', {} )
+    result.tar_index = meta.get( 'tar_index', None )
+    logging.debug( 'cache: hit for "{0}"'.format( url ) )
+    return result
+
+  def validator( self, url ):
+    """
+    Returns the validator of the entry for url, or None if there is no entry.
+    """
+    path = self._path( url )
+    meta = self._readMeta( path )
+    if meta is None or meta[ 'url' ] != url or not os.path.exists( path ):
+      return None
+
+    return meta[ 'validator' ]
+
+  def indexed( self, url ):
+    """
+    Returns True if the entry for url has a tar index.
+    """
+    meta = self._readMeta( self._path( url ) )
+    return meta is not None and meta[ 'url' ] == url and meta.get( 'tar_index', None ) is not None
+
+  def _setFetched( self, url, fetched ):
+    path = self._path( url )
+    meta = self._readMeta( path )
+    if meta is None or meta[ 'url' ] != url:
+      return
+
+    meta[ 'fetched' ] = fetched
+    with NamedTemporaryFile( mode='w', dir=self.cache_dir, prefix='.meta_', delete=False ) as fp:
+      json.dump( meta, fp )
+
+    os.rename( fp.name, path + '.json' )
+
+  def expire( self, url ):
+    """
+    Make the next get for url without a validator check back with the server, even if the entry is younger than CACHE_TRUST_TTL.
+    """
+    self._setFetched( url, 0 )
+
+  def renew( self, url ):
+    """
+    The server says the entry for url is still current, trust it for another CACHE_TRUST_TTL.
+    """
+    self._setFetched( url, time.time() )
+
+  def record_use( self, url ):
+    """
+    Remember url was asked for, the list is kept in the cache dir so the prefetcher can see it from other processes.
+    """
+    if not getattr( _local, 'recording', True ):
+      return
+
+    now = time.monotonic()
+    with self.recent_lock:  # the file is only for the prefetcher, it dosen't need every use
+      if now - self.recorded_map.get( url, -CACHE_RECENT_INTERVAL ) < CACHE_RECENT_INTERVAL:
+        return
+
+      if len( self.recorded_map ) >= CACHE_RECENT_MAX:
+        self.recorded_map = dict( item for item in self.recorded_map.items() if now - item[1] < CACHE_RECENT_INTERVAL )
+
+      self.recorded_map[ url ] = now
+
+    path = os.path.join( self.cache_dir, 'recent.json' )
+    with open( path + '.lock', 'w' ) as lock_file:
+      fcntl.flock( lock_file, fcntl.LOCK_EX )
+      recent_map = self._readMeta( os.path.join( self.cache_dir, 'recent' ) ) or {}
+      recent_map[ url ] = time.time()
+      if len( recent_map ) > CACHE_RECENT_MAX:
+        recent_map = dict( sorted( recent_map.items(), key=lambda item: item[1] )[ -CACHE_RECENT_MAX: ] )
+
+      with NamedTemporaryFile( mode='w', dir=self.cache_dir, prefix='.meta_', delete=False ) as fp:
+        json.dump( recent_map, fp )
+
+      os.rename( fp.name, path )
+
+  def recent_uses( self, count ):
+    """
+    Returns the count most recently used urls, most recent first.
+    """
+    recent_map = self._readMeta( os.path.join( self.cache_dir, 'recent' ) ) or {}
+    return [ url for url, _ in sorted( recent_map.items(), key=lambda item: item[1], reverse=True )[ :count ] ]
+
+  def busy_lock( self ):
+    """
+    Returns an open file holding a shared lock on busy.lock in the cache dir, held while this process has
+    transfers running, so the prefetcher can tell from any process.  Close it to release.
+    """
+    lock_file = open( os.path.join( self.cache_dir, 'busy.lock' ), 'w' )
+    fcntl.flock( lock_file, fcntl.LOCK_SH )
+    return lock_file
+
+  def busy( self ):
+    """
+    Returns True if any process using this cache dir, including this one, has transfers running.
+    """
+    with open( os.path.join( self.cache_dir, 'busy.lock' ), 'w' ) as lock_file:
+      try:
+        fcntl.flock( lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB )
+      except BlockingIOError:
+        return True
+
+    return False
+
+  def new_file( self ):
+    return NamedTemporaryFile( mode='w+b', dir=self.cache_dir, prefix='.fill_', delete=False )
+
+  def put( self, url, validator, immutable, local_file, digest_map=None, tar_index=None ):
+    """
+    Moves the completly written local_file ( from new_file ) into place as the entry for url,
+    returns a CachedFile for the new entry.  tar_index ( see tarindex.py ) is kept in the sidecar with the digests.
+    """
+    path = self._path( url )
+    local_file.flush()
+    os.fsync( local_file.fileno() )
+    local_file.close()
+
+    meta = { 'url': url, 'validator': validator, 'immutable': immutable, 'fetched': time.time(), 'digest_map': digest_map or {}, 'tar_index': tar_index }
+    with NamedTemporaryFile( mode='w', dir=self.cache_dir, prefix='.meta_', delete=False ) as fp:
+      json.dump( meta, fp )
+
+    os.rename( local_file.name, path )
+    os.rename( fp.name, path + '.json' )
+    try:
+      os.unlink( path + '.part.json' )
+    except FileNotFoundError:
+      pass
+
+    result = CachedFile( path )  # opened first, so it keeps working even if it is evicted
+    result.digest_map = meta[ 'digest_map' ]
+    result.tar_index = tar_index
+
+    self.evict( path )
+
+    return result
+
+  def partial( self, url, validator, size ):
+    """
+    Returns ( file, done_list ) for resuming a download of url, done_list is the list of ( start, end ) ranges
+    allready in file.  If the validator or size do not match what the partial file was started with, it starts over.
+    """
+    path = self._path( url ) + '.part'
+    meta = self._readMeta( path )
+    if meta is not None and meta[ 'url' ] == url and meta[ 'validator' ] == validator and meta[ 'size' ] == size and os.path.exists( path ):
+      logging.debug( 'cache: resuming "{0}", {1} ranges allready downloaded'.format( url, len( meta[ 'done_list' ] ) ) )
+      return open( path, 'r+b' ), [ tuple( i ) for i in meta[ 'done_list' ] ]
+
+    local_file = open( path, 'w+b' )
+    self.save_partial( url, validator, size, [] )
+    return local_file, []
+
+  def save_partial( self, url, validator, size, done_list ):
+    path = self._path( url ) + '.part'
+    with NamedTemporaryFile( mode='w', dir=self.cache_dir, prefix='.meta_', delete=False ) as fp:
+      json.dump( { 'url': url, 'validator': validator, 'size': size, 'done_list': done_list }, fp )
+
+    os.rename( fp.name, path + '.json' )
+
+  def discard( self, local_file ):
+    local_file.close()
+    try:
+      os.unlink( local_file.name )
+    except FileNotFoundError:
+      pass
+
+  def _remove_stale_lock( self, path ):
+    """
+    Remove a lock file no one is holding, if someone opens it just before it is removed, the worst that can
+    happen is the url is downloaded twice.
+    """
+    try:
+      with open( path, 'r' ) as lock_file:
+        fcntl.flock( lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB )
+        os.unlink( path )
+
+    except ( BlockingIOError, FileNotFoundError ):
+      pass
+
+  def _locked( self, path ):
+    """
+    Returns True if someone is holding the lock for the entry at path ( see lock_entry ), ie: filling it.
+    """
+    try:
+      with open( path + '.lock', 'r' ) as lock_file:
+        fcntl.flock( lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB )
+
+    except BlockingIOError:
+      return True
+
+    except FileNotFoundError:
+      pass
+
+    return False
+
+  def evict( self, keep=None ):
+    """
+    Remove the oldest entries till the cache is under max_size, the entry at path keep ( ie: the one just put ) is never removed.
+    Partial downloads count against the size, but are only removed after CACHE_PARTIAL_TTL, and never while they are being filled.
+    """
+    with self.lock:
+      entry_list = []
+      total = 0
+      for name in os.listdir( self.cache_dir ):
+        path = os.path.join( self.cache_dir, name )
+        try:
+          stat = os.stat( path )
+        except FileNotFoundError:
+          continue
+
+        stale = time.time() - stat.st_mtime > CACHE_PARTIAL_TTL
+        if name.startswith( ( '.fill_', '.meta_' ) ):  # left behind by a process that died while writing it
+          if stale:
+            logging.debug( 'cache: removing orphaned "{0}"'.format( path ) )
+            self._unlink( path )
+
+          continue
+
+        if name.endswith( '.lock' ):
+          if stale:
+            self._remove_stale_lock( path )
+
+          continue
+
+        if name.endswith( '.part' ):
+          if stale and not self._locked( path[ :-len( '.part' ) ] ):
+            logging.debug( 'cache: removing stale partial "{0}"'.format( path ) )
+            self._unlink( path, path + '.json' )
+          else:
+            total += stat.st_size
+
+          continue
+
+        if name.startswith( '.' ) or '.' in name:
+          continue
+
+        total += stat.st_size
+        if path != keep:
+          entry_list.append( ( stat.st_mtime, stat.st_size, path ) )
+
+      entry_list.sort()
+      while total > self.max_size and entry_list:
+        _, size, path = entry_list.pop( 0 )
+        logging.debug( 'cache: evicting "{0}"'.format( path ) )
+        self._unlink( path + '.json', path )
+        total -= size
+
+  def _unlink( self, *path_list ):
+    for path in path_list:
+      try:
+        os.unlink( path )
+      except FileNotFoundError:
+        pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+  """
+  Returns the process wide DownloadCache, or None if caching is disabled or CACHE_DIR is not usable.
+  """
+  global _cache
+
+  if CACHE_DIR is None:
+    return None
+
+  with _cache_lock:
+    if _cache is None or _cache.cache_dir != CACHE_DIR:
+      try:
+        os.makedirs( CACHE_DIR, exist_ok=True )
+      except OSError as e:
+        logging.warning( 'cache: Unable to use cache dir "{0}": "{1}", caching disabled'.format( CACHE_DIR, e ) )
+        return None
+
+      if not os.access( CACHE_DIR, os.W_OK | os.X_OK ):
+        logging.warning( 'cache: Cache dir "{0}" is not writable, caching disabled'.format( CACHE_DIR ) )
+        return None
+
+      _cache = DownloadCache( CACHE_DIR, CACHE_MAX_SIZE )
+
+    return _cache
@@ -0,0 +1,330 @@
+import os
+import ssl
+import stat
+import mmap
+import time
+import http
+import socket
+import select
+import logging
+import threading
+from urllib import request
+
+from subcontractor_plugins.common.transfer import current_transfer
+
+POOL_MAX_PER_HOST = 4  # max number of idle connections kept per host
+POOL_IDLE_TIMEOUT = 30  # in seconds, idle connections older than this are closed
+SEND_BLOCK_SIZE = 1024 * 1024  # in bytes
+
+# urllib normally sends "Connection: close" and throws the connection away after every request,
+# these handlers keep the connection open and put it back in a process wide pool once the response
+# has been completely read, so the next request to the same host skips the TCP and TLS handshakes.
+
+
+class _PooledResponse( http.client.HTTPResponse ):
+  _release_cb = None
+  _aborted = False
+
+  def close( self ):
+    if self.fp is not None:  # closed before the body was all read, the connection is in an unknown state
+      self._aborted = True
+
+    super().close()
+
+  def _close_conn( self ):
+    super()._close_conn()
+    release_cb, self._release_cb = self._release_cb, None
+    if release_cb is not None:
+      release_cb( not self._aborted and not self.will_close )
+
+
+def _readable( sock ):
+  poller = select.poll()  # not select.select, that can't handle fds over FD_SETSIZE ( 1024 )
+  poller.register( sock, select.POLLIN )
+  return bool( poller.poll( 0 ) )
+
+
+class ConnectionPool():
+  def __init__( self, max_per_host, idle_timeout ):
+    super().__init__()
+    self.max_per_host = max_per_host
+    self.idle_timeout = idle_timeout
+    self.lock = threading.Lock()
+    self.idle_map = {}  # key -> [ ( connection, released at ) ], key is ( connection class, host, tunnel host, ssl context )
+
+  def get( self, key ):
+    now = time.monotonic()
+    with self.lock:
+      for tmp_key in list( self.idle_map.keys() ):  # evict anything that has been sitting arround too long
+        idle_list = self.idle_map[ tmp_key ]
+        while idle_list and now - idle_list[0][1] > self.idle_timeout:
+          idle_list.pop( 0 )[0].close()
+
+        if not idle_list:
+          del self.idle_map[ tmp_key ]
+
+      idle_list = self.idle_map.get( key, [] )
+      while idle_list:
+        conn, _ = idle_list.pop()
+        if conn.sock is not None and not _readable( conn.sock ):  # if it is readable, the other end has closed it
+          return conn
+
+        conn.close()
+
+    return None
+
+  def put( self, key, conn ):
+    if conn.sock is None:
+      return
+
+    with self.lock:
+      idle_list = self.idle_map.setdefault( key, [] )
+      if len( idle_list ) >= self.max_per_host:
+        conn.close()
+        return
+
+      idle_list.append( ( conn, time.monotonic() ) )
+
+  def clear( self ):
+    with self.lock:
+      for idle_list in self.idle_map.values():
+        for conn, _ in idle_list:
+          conn.close()
+
+      self.idle_map = {}
+
+
+POOL = ConnectionPool( POOL_MAX_PER_HOST, POOL_IDLE_TIMEOUT )
+
+
+def _file_body( body ):
+  """
+  if body is a regular file on disk, returns ( file, offset ), otherwise None
+  """
+  try:
+    fd = body.fileno()
+    if not stat.S_ISREG( os.fstat( fd ).st_mode ):
+      return None
+
+    return ( body, body.tell() )
+
+  except ( AttributeError, OSError, ValueError ):  # io.UnsupportedOperation is an OSError and a ValueError
+    return None
+
+
+class _CountingReader():
+  def __init__( self, file, transfer ):
+    super().__init__()
+    self.file = file
+    self.transfer = transfer
+
+  def read( self, size=-1 ):
+    buff = self.file.read( size )
+    self.transfer.update( len( buff ) )
+    return buff
+
+
+def _send_file( sock, file, offset, count, encode_chunked, transfer ):
+  """
+  Send count bytes of file starting at offset without copying them through python,
+  plain sockets use sendfile, ssl sockets can't ( the kernel would have to do the encryption )
+  so they send memoryview slices of a mmap of the file.
+  """
+  def _send( buff ):
+    if encode_chunked:
+      sock.sendall( '{0:X}\r\n'.format( len( buff ) ).encode() )
+      sock.sendall( buff )
+      sock.sendall( b'\r\n' )
+    else:
+      sock.sendall( buff )
+
+    if transfer is not None:
+      transfer.update( len( buff ) )
+
+  end = offset + count
+  if isinstance( sock, ssl.SSLSocket ):
+    if count:
+      with mmap.mmap( file.fileno(), 0, access=mmap.ACCESS_READ ) as mapped:
+        view = memoryview( mapped )
+        try:
+          while offset < end:
+            block = min( SEND_BLOCK_SIZE, end - offset )
+            _send( view[ offset:offset + block ] )
+            offset += block
+
+        finally:
+          view.release()
+
+  else:
+    while offset < end:
+      block = min( SEND_BLOCK_SIZE, end - offset )
+      if encode_chunked:
+        sock.sendall( '{0:X}\r\n'.format( block ).encode() )
+
+      sent = sock.sendfile( file, offset, block )
+      if sent != block:
+        raise ConnectionError( 'sendfile sent {0} of {1} bytes'.format( sent, block ) )
+
+      if encode_chunked:
+        sock.sendall( b'\r\n' )
+
+      if transfer is not None:
+        transfer.update( block )
+
+      offset += block
+
+  if encode_chunked:
+    sock.sendall( b'0\r\n\r\n' )
+
+  file.seek( end )
+
+
+def _send_request( conn, method, selector, body, header_map, encode_chunked ):
+  transfer = current_transfer()  # the bytes sent are counted against the transfer the caller is in, if any
+  file_body = _file_body( body )
+  if file_body is None:
+    if transfer is not None and hasattr( body, 'read' ):
+      body = _CountingReader( body, transfer )
+
+    conn.request( method, selector, body, header_map, encode_chunked=encode_chunked )
+    return
+
+  file, offset = file_body
+  name_list = [ name.lower() for name in header_map.keys() ]
+  if 'content-length' in name_list:
+    count = int( [ value for name, value in header_map.items() if name.lower() == 'content-length' ][0] )
+  else:
+    count = os.fstat( file.fileno() ).st_size - offset
+    if not encode_chunked:
+      header_map = dict( header_map, **{ 'Content-Length': str( count ) } )
+
+  skip_map = {}
+  if 'host' in name_list:
+    skip_map[ 'skip_host' ] = True
+  if 'accept-encoding' in name_list:
+    skip_map[ 'skip_accept_encoding' ] = True
+
+  conn.putrequest( method, selector, **skip_map )
+  for name, value in header_map.items():
+    conn.putheader( name, value )
+
+  conn.endheaders()
+  _send_file( conn.sock, file, offset, count, encode_chunked, transfer )
+
+
+def _pooled_open( http_class, req, **http_conn_args ):
+  host = req.host
+  if not host:
+    raise request.URLError( 'no host given' )
+
+  key = ( http_class, host, req._tunnel_host, http_conn_args.get( 'context', None ) )
+
+  header_map = dict( req.unredirected_hdrs )
+  header_map.update( { k: v for k, v in req.headers.items() if k not in header_map } )
+  header_map = { name.title(): val for name, val in header_map.items() }
+  tunnel_header_map = {}
+  if 'Proxy-Authorization' in header_map:
+    tunnel_header_map[ 'Proxy-Authorization' ] = header_map.pop( 'Proxy-Authorization' )
+
+  timeout = req.timeout
+  if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+    timeout = socket.getdefaulttimeout()
+
+  replayable = req.data is None or isinstance( req.data, ( bytes, bytearray ) )  # can't resend a file body if the reused connection turns out to be dead
+  conn = POOL.get( key ) if replayable else None
+  while True:
+    reused = conn is not None
+    if conn is None:
+      conn = http_class( host, timeout=req.timeout, blocksize=SEND_BLOCK_SIZE, **http_conn_args )
+      conn.response_class = _PooledResponse
+      if req._tunnel_host:
+        conn.set_tunnel( req._tunnel_host, headers=tunnel_header_map )
+
+    else:
+      conn.timeout = req.timeout
+      conn.sock.settimeout( timeout )
+
+    try:
+      _send_request( conn, req.get_method(), req.selector, req.data, header_map, req.has_header( 'Transfer-encoding' ) )
+      resp = conn.getresponse()
+
+    except ( OSError, http.client.HTTPException ) as e:
+      conn.close()
+      conn = None
+      if reused and isinstance( e, ( ConnectionError, http.client.RemoteDisconnected, http.client.BadStatusLine ) ):
+        logging.debug( 'connection: pooled connection to "{0}" went away, reconnecting'.format( host ) )
+        continue
+
+      if isinstance( e, OSError ):
+        raise request.URLError( e )
+
+      raise e
+
+    break
+
+  resp.url = req.get_full_url()
+  resp.msg = resp.reason
+
+  def _release( reusable=True ):
+    if reusable:
+      POOL.put( key, conn )
+    else:  # don't leave the socket for the GC to close
+      conn.close()
+
+  if resp.fp is None:  # allready done, ie: a response with no body
+    if not resp.will_close:
+      _release()
+
+  else:
+    resp._release_cb = _release
+
+  return resp
+
+
+class PooledHTTPHandler( request.HTTPHandler ):
+  def http_open( self, req ):
+    return _pooled_open( http.client.HTTPConnection, req )
+
+
+class PooledHTTPSHandler( request.HTTPSHandler ):
+  def https_open( self, req ):
+    return _pooled_open( http.client.HTTPSConnection, req, context=self._context )
+
+
+_unverified_context = None
+
+
+def unverified_context():
+  """
+  Returns a shared unverified ssl context, connections are pooled by context, so using the same one
+  for every request to a host lets them share connections.
+  """
+  global _unverified_context
+
+  if _unverified_context is None:
+    _unverified_context = ssl._create_unverified_context()
+
+  return _unverified_context
+
+
+def build_opener( proxy=None, sslContext=None, handler_list=None ):
+  """
+  Returns an OpenerDirector that uses the connection pool, handler_list is a list of extra handlers to add.
+  """
+  opener = request.OpenerDirector()
+
+  if proxy:  # not doing 'is not None', so empty strings don't try and proxy   # have a proxy option to take it from the envrionment vars
+    opener.add_handler( request.ProxyHandler( { 'http': proxy, 'https': proxy } ) )
+  else:
+    opener.add_handler( request.ProxyHandler( {} ) )
+
+  opener.add_handler( PooledHTTPHandler() )
+  if hasattr( http.client, 'HTTPSConnection' ):
+    opener.add_handler( PooledHTTPSHandler( context=sslContext ) )
+
+  for handler in handler_list or []:
+    opener.add_handler( handler )
+
+  opener.add_handler( request.UnknownHandler() )
+
+  return opener
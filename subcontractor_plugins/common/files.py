@@ -1,45 +1,138 @@
+import io
+import os
+import bz2
+import gzip
+import lzma
+import zlib
+import time
+import queue
 import logging
 import http
 import socket
 import json
-from threading import Timer
-from datetime import datetime, timedelta
+import hashlib
+from threading import Thread, Lock, Condition
 from urllib import request, parse
 from tempfile import NamedTemporaryFile
 
-from subcontractor_plugins.common.Packrat import PackratHandler, PackratsHandler, Packrat
+from subcontractor_plugins.common.Packrat import PackratHandler, PackratsHandler, PACKRAT_SESSIONS, is_exact_version
+from subcontractor_plugins.common.cache import get_cache
+from subcontractor_plugins.common.connection import build_opener
+from subcontractor_plugins.common.tarindex import TarIndexer
+from subcontractor_plugins.common.transfer import SCHEDULER
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
 
-PROGRESS_INTERVAL = 10  # in seconds
 WEB_HANDLE_TIMEOUT = 60  # in seconds
+DOWNLOAD_CONNECTIONS = 4  # number of connections to use for ranged downloads
+DOWNLOAD_RETRIES = 3  # times to retry each range before giving up
+RANGE_MIN_SIZE = 64 * 1024 * 1024  # in bytes, files smaller than this are downloaded as a single stream
+RANGE_CHUNK_SIZE = 32 * 1024 * 1024  # in bytes
+STREAM_CHUNK_SIZE = 1024 * 1024  # in bytes
+STREAM_BUFFER_SIZE = 64 * 1024 * 1024  # in bytes, how far a stream is allowed to read ahead of it's consumer
+HASH_ALGORITHMS = ( 'sha1', 'sha256', 'sha512' )  # hashes that can be checked, sha256 is allways calculated
+DECOMPRESS_ENCODING_MAP = { 'gzip': 'gzip', 'x-gzip': 'gzip', 'bzip2': 'bzip2', 'xz': 'xz', 'zstd': 'zstd' }  # Content-Encoding -> codec
+DECOMPRESS_EXTENSION_MAP = { '.gz': 'gzip', '.bz2': 'bzip2', '.xz': 'xz', '.zst': 'zstd' }  # file extension -> codec, used if there is no Content-Encoding
 
 
 class FileRetrieveException( Exception ):
   pass
 
 
+class FileHashException( FileRetrieveException ):
+  pass
+
+
+class Hasher():
+  """
+  Calculates the hashes of a file as it goes by, verify() checks them against the expected ones.
+  algorithm_list is extra algorithms to calculate, for when the expected hashes are not known until later.
+  """
+  def __init__( self, name, expected_map=None, algorithm_list=None ):
+    super().__init__()
+    self.name = name
+    self.expected_map = dict( ( algo.lower(), value.lower() ) for algo, value in ( expected_map or {} ).items() )
+    self.hash_map = dict( ( algo, hashlib.new( algo ) ) for algo in set( self.expected_map.keys() ) | set( algorithm_list or [] ) | { 'sha256' } )
+
+  def update( self, buff ):
+    for hash in self.hash_map.values():
+      hash.update( buff )
+
+  def verify( self ):
+    """
+    Returns the map of algorithm -> hex digest, raises FileHashException if any do not match.
+    """
+    digest_map = dict( ( algo, hash.hexdigest() ) for algo, hash in self.hash_map.items() )
+    for algo, expected in self.expected_map.items():
+      if digest_map[ algo ] != expected:
+        raise FileHashException( '{0} of "{1}" is "{2}" expected "{3}"'.format( algo.upper(), self.name, digest_map[ algo ], expected ) )
+
+    return digest_map
+
+
+class HashingReader():
+  """
+  Wraps a file like object, hashing what is read through it.
+  """
+  def __init__( self, file, hasher ):
+    super().__init__()
+    self.file = file
+    self.hasher = hasher
+
+  def read( self, size=-1 ):
+    buff = self.file.read( size )
+    self.hasher.update( buff )
+    return buff
+
+  def fileno( self ):  # otherwise the file could be sent with sendfile, skipping the hashing
+    raise io.UnsupportedOperation( 'fileno' )
+
+  def __getattr__( self, name ):
+    return getattr( self.file, name )
+
+
+def _expected_hashes( resp ):
+  entry = getattr( resp, 'packrat_entry', None )
+  if entry is None:
+    return {}
+
+  return dict( ( algo, entry[ algo ] ) for algo in HASH_ALGORITHMS if entry.get( algo, None ) )
+
+
+_opener_map = {}
+_opener_lock = Lock()
+
+
+def _get_opener( proxy ):
+  with _opener_lock:
+    try:
+      return _opener_map[ proxy ]
+    except KeyError:
+      pass
+
+    handler_list = [ PackratHandler() ]
+    if hasattr( http.client, 'HTTPSConnection' ):
+      handler_list.append( PackratsHandler() )  # context=sslContext
+
+    handler_list.append( request.FileHandler() )
+    handler_list.append( request.FTPHandler() )
+
+    opener = build_opener( proxy, None, handler_list )  # context=sslContext
+    _opener_map[ proxy ] = opener
+
+    return opener
+
+
 def open_url( url, proxy, resp_code, sslContext ):
   if isinstance( url, request.Request ):
     logging.info( 'opener: opening "{0}"'.format( url.full_url ) )
   else:
     logging.info( 'opener: opening "{0}"'.format( url ) )
 
-  opener = request.OpenerDirector()
-
-  if proxy:  # not doing 'is not None', so empty strings don't try and proxy   # have a proxy option to take it from the envrionment vars
-    opener.add_handler( request.ProxyHandler( { 'http': proxy, 'https': proxy } ) )
-  else:
-    opener.add_handler( request.ProxyHandler( {} ) )
-
-  opener.add_handler( request.HTTPHandler() )
-  opener.add_handler( PackratHandler() )
-
-  if hasattr( http.client, 'HTTPSConnection' ):
-    opener.add_handler( request.HTTPSHandler() )  # context=sslContext
-    opener.add_handler( PackratsHandler() )  # context=sslContext
-
-  opener.add_handler( request.FileHandler() )
-  opener.add_handler( request.FTPHandler() )
-  opener.add_handler( request.UnknownHandler() )
+  opener = _get_opener( proxy )
 
   try:
     resp = opener.open( url, timeout=WEB_HANDLE_TIMEOUT )
@@ -68,73 +161,665 @@ def open_url( url, proxy, resp_code, sslContext ):
   return resp
 
 
-def file_reader( url, proxy, sslContext ):
-  local_file = NamedTemporaryFile( mode='w+b', prefix='subcontractor_' )
-  logging.debug( 'file_reader: downloading "{0}"'.format( url ) )
-  resp = open_url( url, proxy, 200, sslContext )
+def _entry_validator( entry ):
+  if entry.get( 'sha256', None ):  # the content is verified against this, so it is the best key we can have
+    return 'sha256:{0}'.format( entry[ 'sha256' ].lower() )
 
-  size = int( resp.headers[ 'content-length' ] )
+  return 'packrat:{0}:{1}'.format( entry[ 'version' ], entry[ 'path' ] )
+
+
+def _packrat_handler( proxy ):
+  for handler in _get_opener( proxy ).handlers:
+    if isinstance( handler, PackratHandler ):
+      return handler
+
+  raise Exception( 'No packrat handler' )
+
+
+def _current_validator( url, proxy, sslContext ):
+  """
+  Returns the validator url would be downloaded with now, with out downloading it, None if it can't be told.
+  packrat urls are resolved against the ( cached ) manifest, http(s) urls get a HEAD request.
+  """
+  parts = parse.urlparse( url )
+  if parts.scheme in ( 'packrat', 'packrats' ):
+    selector = parse.urlunparse( ( '', '', parts.path, '', parts.query, '' ) )
+    _, entry = _packrat_handler( proxy ).resolve( parts.netloc, selector, parts.scheme == 'packrats', WEB_HANDLE_TIMEOUT )
+    return _entry_validator( entry )
+
+  if parts.scheme in ( 'http', 'https' ):
+    resp = open_url( request.Request( url, method='HEAD' ), proxy, 200, sslContext )
+    resp.read()  # there is no body, but this lets the connection go back to the pool
+    return _validator( url, resp )[0]
+
+  return None
+
+
+def _revalidate( cache, cache_key, url, proxy, sslContext ):
+  """
+  The entry for url is to old to trust with out checking, if it is still current, renew it and return it.
+  """
+  validator = cache.validator( cache_key )
+  if validator is None:
+    return None
+
+  try:
+    current = _current_validator( url, proxy, sslContext )
+  except Exception as e:
+    logging.debug( 'file_reader: unable to revalidate "{0}": "{1}"'.format( url, e ) )
+    return None
+
+  if current != validator:
+    return None
+
+  local_file = cache.get( cache_key, validator )
+  if local_file is not None:
+    logging.debug( 'file_reader: "{0}" is still current'.format( url ) )
+    cache.renew( cache_key )
+
+  return local_file
+
+
+def _validator( url, resp ):
+  """
+  returns ( validator, immutable ) for the response, validator is None if the response is not cacheable
+  """
+  entry = getattr( resp, 'packrat_entry', None )
+  if entry is not None:
+    immutable = is_exact_version( parse.urlparse( url ).query )  # asked for a specific version
+    return _entry_validator( entry ), immutable
 
+  if resp.headers is None:
+    return None, False
+
+  etag = resp.headers.get( 'ETag', None )
+  if etag is not None:
+    return 'etag:{0}'.format( etag ), False
+
+  last_modified = resp.headers.get( 'Last-Modified', None )
+  if last_modified is not None:
+    return 'last-modified:{0}'.format( last_modified ), False
+
+  return None, False
+
+
+def _download( resp, local_file, hasher, transfer, indexer=None ):
   buff = resp.read( 4096 * 1024 )
-  cp = datetime.utcnow()
   while buff:
-    if datetime.utcnow() > cp:
-      cp = datetime.utcnow() + timedelta( seconds=PROGRESS_INTERVAL )
-      logging.debug( 'file_reader: download at {0} of {1}'.format( local_file.tell(), size ) )
-
     local_file.write( buff )
+    hasher.update( buff )
+    if indexer is not None:
+      indexer.update( buff )
+
+    transfer.update( len( buff ) )
     buff = resp.read( 4096 * 1024 )
 
   local_file.flush()
   local_file.seek( 0 )
 
-  return local_file
+  return hasher.verify()
+
+
+def _download_decompress( resp, local_file, hasher, transfer, codec, indexer=None ):
+  """
+  Download and decompress in one pass, the download runs in the StreamReader's thread, so it
+  overlaps with the decompression and writing.  The hashes are of the compressed file, the indexer
+  is fed the decompressed contents.
+  """
+  stream = StreamReader( resp, hasher, transfer )
+  reader = DecompressReader( stream, codec )
+  try:
+    buff = reader.read( STREAM_CHUNK_SIZE )
+    while buff:
+      local_file.write( buff )
+      if indexer is not None:
+        indexer.update( buff )
+
+      buff = reader.read( STREAM_CHUNK_SIZE )
+
+    if stream.digest_map is None:  # the decompressor stopped short of the end of the file, read the rest so it is all hashed
+      stream.read()
+
+  finally:
+    reader.close()
+
+  local_file.flush()
+  local_file.seek( 0 )
+
+  return stream.digest_map
+
+
+def _can_range( resp ):
+  try:
+    size = int( resp.headers[ 'content-length' ] )
+  except ( TypeError, ValueError ):
+    return False
+
+  if size < RANGE_MIN_SIZE:
+    return False
+
+  if parse.urlparse( resp.url ).scheme not in ( 'http', 'https' ):
+    return False
+
+  return resp.headers.get( 'Accept-Ranges', '' ).lower() == 'bytes'
+
+
+def _download_range( url, start, end, if_range, fd, transfer, proxy, sslContext ):
+  header_map = { 'Range': 'bytes={0}-{1}'.format( start, end ) }
+  if if_range is not None:
+    header_map[ 'If-Range' ] = if_range
+
+  resp = open_url( request.Request( url, headers=header_map ), proxy, 206, sslContext )  # if the file changed, If-Range gets us a 200, and open_url will fail
+  try:
+    offset = start
+    buff = resp.read( 4096 * 1024 )
+    while buff:
+      os.pwrite( fd, buff, offset )
+      offset += len( buff )
+      transfer.update( len( buff ) )
+      buff = resp.read( 4096 * 1024 )
+
+  finally:
+    resp.close()
 
+  if offset != end + 1:
+    raise FileRetrieveException( 'Short range, expected {0} bytes got {1}'.format( end + 1 - start, offset - start ) )
 
-class _file_writer_progress():
-  def __init__( self, file, file_size ):
+
+def _download_ranges( resp, local_file, done_list, hasher, transfer, proxy, sslContext, save_cb=None, indexer=None ):
+  """
+  Download the file resp is for with DOWNLOAD_CONNECTIONS connections at once, ranges allready in done_list
+  are skipped, save_cb( done_list ) is called every time a range is completed so the download can be resumed.
+  The ranges are hashed ( and fed to the indexer ) in order as soon as they land, while the rest are still downloading.
+  """
+  url = resp.url
+  size = int( resp.headers[ 'content-length' ] )
+  if_range = resp.headers.get( 'ETag', None )
+  if if_range is None or if_range.startswith( 'W/' ):  # weak ETags are not allowed for If-Range
+    if_range = resp.headers.get( 'Last-Modified', None )
+
+  resp.close()
+
+  fd = local_file.fileno()
+  os.ftruncate( fd, size )
+
+  chunk_list = [ ( start, min( start + RANGE_CHUNK_SIZE, size ) - 1 ) for start in range( 0, size, RANGE_CHUNK_SIZE ) ]
+  todo = queue.Queue()
+  for chunk in chunk_list:
+    if chunk not in done_list:
+      todo.put( chunk )
+
+  lock = Condition()
+  error_list = []
+  stats = { 'bytes': 0, 'busy': 0.0 }
+
+  def _worker():
+    while not error_list:
+      try:
+        start, end = todo.get_nowait()
+      except queue.Empty:
+        return
+
+      for i in range( 0, DOWNLOAD_RETRIES ):
+        begin = time.monotonic()
+        try:
+          _download_range( url, start, end, if_range, fd, transfer, proxy, sslContext )
+          break
+
+        except ( FileRetrieveException, OSError, http.client.HTTPException ) as e:
+          logging.warning( 'file_reader: range {0}-{1} of "{2}" failed, attempt {3} of {4}: "{5}"'.format( start, end, url, i + 1, DOWNLOAD_RETRIES, e ) )
+          last_error = e
+
+      else:
+        with lock:
+          error_list.append( last_error )
+          lock.notify_all()
+
+        return
+
+      with lock:
+        stats[ 'bytes' ] += end + 1 - start
+        stats[ 'busy' ] += time.monotonic() - begin
+        done_list.append( ( start, end ) )
+        if save_cb is not None:
+          save_cb( done_list )
+
+        lock.notify_all()
+
+  def _hash_worker():
+    for chunk in chunk_list:
+      with lock:
+        while chunk not in done_list and not error_list:
+          lock.wait()
+
+        if error_list:
+          return
+
+      offset, end = chunk
+      while offset <= end:
+        buff = os.pread( fd, min( 4096 * 1024, end + 1 - offset ), offset )
+        hasher.update( buff )
+        if indexer is not None:
+          indexer.update( buff )
+
+        offset += len( buff )
+
+  logging.debug( 'file_reader: ranged download of "{0}", {1} of {2} ranges to go'.format( url, todo.qsize(), len( done_list ) + todo.qsize() ) )
+  begin = time.monotonic()
+  thread_list = [ Thread( target=_worker, daemon=True ) for i in range( 0, min( DOWNLOAD_CONNECTIONS, todo.qsize() ) ) ]
+  hash_thread = Thread( target=_hash_worker, daemon=True )
+  for thread in thread_list:
+    thread.start()
+
+  hash_thread.start()
+
+  for thread in thread_list:
+    thread.join()
+
+  hash_thread.join()
+
+  if error_list:
+    raise FileRetrieveException( 'Ranged download failed: "{0}"'.format( error_list[0] ) )
+
+  elapsed = time.monotonic() - begin
+  if stats[ 'bytes' ] and elapsed > 0 and stats[ 'busy' ] > 0:
+    rate = stats[ 'bytes' ] / elapsed
+    connection_rate = stats[ 'bytes' ] / stats[ 'busy' ]
+    logging.info( 'file_reader: downloaded {0} bytes at {1:.1f} MiB/s over {2} connections, {3:.1f}x a single connection'.format( stats[ 'bytes' ], rate / 1048576.0, len( thread_list ), rate / connection_rate ) )
+
+  local_file.flush()
+  local_file.seek( 0 )
+
+  return hasher.verify()
+
+
+class StreamReader():
+  """
+  Read only, non seekable file like object backed directly by a response, a background thread
+  reads ahead of the consumer by up to STREAM_BUFFER_SIZE bytes.
+  """
+  def __init__( self, resp, hasher, transfer ):
+    super().__init__()
+    self.resp = resp
+    self.hasher = hasher
+    self.transfer = transfer
+    self.digest_map = None  # set once the end of the stream is reached
+    self.name = resp.url
+    try:
+      self.size = int( resp.headers[ 'content-length' ] )
+    except ( TypeError, ValueError ):
+      self.size = None
+
+    self.closed = False
+    self._queue = queue.Queue( maxsize=max( 1, STREAM_BUFFER_SIZE // STREAM_CHUNK_SIZE ) )
+    self._buff = b''
+    self._offset = 0
+    self._pos = 0
+    self._received = 0
+    self._eof = False
+    self._error = None
+    self._thread = Thread( target=self._fill, daemon=True )
+    self._thread.start()
+
+  def _put( self, buff ):
+    while not self.closed:
+      try:
+        self._queue.put( buff, timeout=1 )
+        return
+      except queue.Full:
+        pass
+
+  def _fill( self ):
+    try:
+      while not self.closed:
+        buff = self.resp.read( STREAM_CHUNK_SIZE )
+        self.hasher.update( buff )
+        self.transfer.update( len( buff ) )
+        self._put( buff )
+        if not buff:
+          return
+
+    except Exception as e:
+      self._error = e
+      self._put( b'' )
+
+    finally:
+      self.resp.close()
+      self.transfer.finish()
+
+  def _next( self ):
+    buff = self._queue.get()
+    if buff:
+      self._received += len( buff )
+      return buff
+
+    self._eof = True
+    if self._error is not None:
+      raise FileRetrieveException( 'Error reading stream "{0}": "{1}"'.format( self.name, self._error ) )
+
+    if self.size is not None and self._received != self.size:
+      raise FileRetrieveException( 'Stream "{0}" ended at {1} of {2}'.format( self.name, self._received, self.size ) )
+
+    self.digest_map = self.hasher.verify()
+    return b''
+
+  def read( self, size=-1 ):
+    if self.closed:
+      raise ValueError( 'read of closed stream' )
+
+    if size is None or size < 0:
+      part_list = [ self._buff[ self._offset: ] ]
+      while not self._eof:
+        part_list.append( self._next() )
+
+    else:
+      part_list = []
+      while size > 0:
+        if self._offset >= len( self._buff ):
+          if self._eof:
+            break
+
+          self._buff = self._next()
+          self._offset = 0
+          continue
+
+        part = self._buff[ self._offset:self._offset + size ]
+        self._offset += len( part )
+        size -= len( part )
+        part_list.append( part )
+
+    result = b''.join( part_list )
+    if size is None or size < 0:
+      self._buff = b''
+      self._offset = 0
+
+    self._pos += len( result )
+    return result
+
+  def readable( self ):
+    return True
+
+  def seekable( self ):
+    return False
+
+  def tell( self ):
+    return self._pos
+
+  def close( self ):
+    self.closed = True
+
+  def __enter__( self ):
+    return self
+
+  def __exit__( self, exc_type, exc_value, traceback ):
+    self.close()
+
+
+class DecompressReader():
+  """
+  Read only, non seekable file like object of the decompressed contents of file, which only needs to have read().
+  Files made of multiple compressed streams ( ie: from pigz, pbzip2 ) are handled.
+  """
+  def __init__( self, file, codec ):
+    super().__init__()
     self.file = file
-    self.file_size = file_size
-    self.cur_timer = None
+    self.codec = codec
+    self.name = getattr( file, 'name', None )
+    self.size = None  # not known until it has been decompressed
+    self._pos = 0
+    if codec == 'gzip':
+      self.reader = gzip.GzipFile( fileobj=file, mode='rb' )
+    elif codec == 'bzip2':
+      self.reader = bz2.BZ2File( file, mode='rb' )
+    elif codec == 'xz':
+      self.reader = lzma.LZMAFile( file, mode='rb' )
+    elif codec == 'zstd':
+      if zstandard is None:
+        raise FileRetrieveException( 'The zstandard module is required to decompress "{0}"'.format( self.name ) )
+
+      self.reader = zstandard.ZstdDecompressor().stream_reader( file, read_across_frames=True )
+    else:
+      raise ValueError( 'Unknown codec "{0}"'.format( codec ) )
+
+  @property
+  def digest_map( self ):  # the hashes are of the compressed file, so they are only known once it has all been read
+    return getattr( self.file, 'digest_map', None )
+
+  def read( self, size=-1 ):
+    try:
+      buff = self.reader.read( size )
+    except ( EOFError, OSError, zlib.error, lzma.LZMAError ) as e:
+      raise FileRetrieveException( 'Error decompressing "{0}": "{1}"'.format( self.name, e ) )
+
+    self._pos += len( buff )
+    return buff
+
+  def readable( self ):
+    return True
+
+  def seekable( self ):
+    return False
+
+  def tell( self ):
+    return self._pos
+
+  @property
+  def closed( self ):
+    return self.file.closed
+
+  def close( self ):
+    self.reader.close()
+    self.file.close()
+
+  def __enter__( self ):
+    return self
+
+  def __exit__( self, exc_type, exc_value, traceback ):
+    self.close()
+
+
+def _codec( resp ):
+  """
+  Returns the codec the file resp is for is compressed with, from the Content-Encoding, or the
+  extension of the file, None if it is not compressed.
+  """
+  if resp.headers is not None:
+    encoding = resp.headers.get( 'Content-Encoding', '' ).lower().strip()
+    if encoding in DECOMPRESS_ENCODING_MAP:
+      return DECOMPRESS_ENCODING_MAP[ encoding ]
+
+  entry = getattr( resp, 'packrat_entry', None )
+  if entry is not None:
+    path = entry[ 'path' ]
+  else:
+    path = parse.urlparse( resp.url ).path
 
-  def start( self ):
-    self.cur_timer = Timer( PROGRESS_INTERVAL, self._timer_cb )
-    self.cur_timer.start()
+  for extension, codec in DECOMPRESS_EXTENSION_MAP.items():
+    if path.endswith( extension ):
+      return codec
 
-  def stop( self ):
-    if self.cur_timer is not None:
-      self.cur_timer.cancel()
-      self.cur_timer = None
+  return None
 
-  def _timer_cb( self ):
-    self.cur_timer = Timer( PROGRESS_INTERVAL, self._timer_cb )
-    self.cur_timer.start()
-    logging.debug( 'file_writer: uploaded at {0} of {1}'.format( self.file.tell(), self.file_size ) )
+
+def _destination( url ):
+  if isinstance( url, request.Request ):
+    url = url.full_url
+
+  return parse.urlparse( url ).netloc
+
+
+def _size( resp ):
+  try:
+    return int( resp.headers[ 'content-length' ] )
+  except ( TypeError, ValueError ):
+    return None
+
+
+def _index_result( indexer ):
+  if indexer is None:
+    return None
+
+  return indexer.result()
+
+
+def file_reader( url, proxy, sslContext, stream=False, decompress=False, tar_index=False ):
+  """
+  Retreive url, returns a file like object of the contents.
+  if stream is True, and the file is not allready in the cache, a StreamReader is returned
+  so the caller can start consuming while the download is still running.
+  if decompress is True and the file is compressed ( by Content-Encoding or file extension, see DECOMPRESS_EXTENSION_MAP )
+  it is decompressed as it is downloaded, the decompressed contents are cached seperatly from the compressed.
+  The contents are hashed as they are downloaded, and checked against the hashes packrat has,
+  the resulting digests are in the digest_map attribute of the returned file.
+  if tar_index is True, the file is a tar, and ( if not stream ) the index of it's members is built as it is downloaded,
+  and cached with it, it is in the tar_index attribute of the returned file, None if it could not be built.
+  The download is run through the transfer scheduler, so it may wait for a free slot.
+  """
+  logging.debug( 'file_reader: downloading "{0}"'.format( url ) )
+  cache = get_cache()
+  cache_key = url
+  if decompress and isinstance( url, str ):
+    cache_key = '{0}#decompress'.format( url )
+
+  if cache is not None and isinstance( url, str ):
+    parts = parse.urlparse( url )
+    if parts.scheme in ( 'packrat', 'packrats' ) and not is_exact_version( parts.query ):  # for the prefetcher to keep up to date
+      cache.record_use( cache_key )
+
+  if stream:
+    local_file = None
+    if cache is not None and isinstance( url, str ):
+      local_file = cache.get( cache_key )
+
+    if local_file is None:
+      transfer = SCHEDULER.transfer( 'download "{0}"'.format( url ), _destination( url ) )
+      try:
+        resp = open_url( url, proxy, 200, sslContext )
+      except Exception as e:
+        transfer.finish()
+        raise e
+
+      transfer.total = _size( resp )
+      codec = _codec( resp ) if decompress else None
+      local_file = StreamReader( resp, Hasher( resp.url, _expected_hashes( resp ) ), transfer )
+      if codec is not None:
+        local_file = DecompressReader( local_file, codec )
+
+    return local_file
+
+  indexer = TarIndexer() if tar_index else None
+
+  if cache is None or not isinstance( url, str ):
+    local_file = NamedTemporaryFile( mode='w+b', prefix='subcontractor_' )
+    with SCHEDULER.transfer( 'download "{0}"'.format( url ), _destination( url ) ) as transfer:
+      resp = open_url( url, proxy, 200, sslContext )
+      transfer.total = _size( resp )
+      hasher = Hasher( resp.url, _expected_hashes( resp ) )
+      codec = _codec( resp ) if decompress else None
+      if codec is not None:
+        local_file.digest_map = _download_decompress( resp, local_file, hasher, transfer, codec, indexer )
+      elif _can_range( resp ):
+        local_file.digest_map = _download_ranges( resp, local_file, [], hasher, transfer, proxy, sslContext, indexer=indexer )
+      else:
+        local_file.digest_map = _download( resp, local_file, hasher, transfer, indexer )
+
+    local_file.tar_index = _index_result( indexer )
+    return local_file
+
+  local_file = cache.get( cache_key )
+  if local_file is None:
+    local_file = _revalidate( cache, cache_key, url, proxy, sslContext )
+
+  if local_file is not None:
+    return local_file
+
+  lock = cache.lock_entry( cache_key )
+  try:
+    local_file = cache.get( cache_key )  # some one else may of filled it while we were waiting for the lock
+    if local_file is not None:
+      return local_file
+
+    with SCHEDULER.transfer( 'download "{0}"'.format( url ), _destination( url ) ) as transfer:
+      resp = open_url( url, proxy, 200, sslContext )
+      transfer.total = _size( resp )
+      hasher = Hasher( resp.url, _expected_hashes( resp ) )
+      codec = _codec( resp ) if decompress else None
+      validator, immutable = _validator( url, resp )
+      if validator is None:
+        local_file = NamedTemporaryFile( mode='w+b', prefix='subcontractor_' )
+        if codec is not None:
+          local_file.digest_map = _download_decompress( resp, local_file, hasher, transfer, codec, indexer )
+        else:
+          local_file.digest_map = _download( resp, local_file, hasher, transfer, indexer )
+
+        local_file.tar_index = _index_result( indexer )
+        return local_file
+
+      local_file = cache.get( cache_key, validator )
+      if local_file is not None:
+        resp.close()
+        return local_file
+
+      if codec is None and _can_range( resp ):  # decompressing has to be done in order, so it is allways a single stream
+        size = int( resp.headers[ 'content-length' ] )
+        local_file, done_list = cache.partial( cache_key, validator, size )
+        try:
+          digest_map = _download_ranges( resp, local_file, done_list, hasher, transfer, proxy, sslContext, lambda done_list: cache.save_partial( cache_key, validator, size, done_list ), indexer )
+        except FileHashException as e:
+          cache.discard( local_file )  # no point resuming from bad data
+          raise e
+        except Exception as e:
+          local_file.close()  # leave the partial file for the next try to resume from
+          raise e
+
+      else:
+        local_file = cache.new_file()
+        try:
+          if codec is not None:
+            digest_map = _download_decompress( resp, local_file, hasher, transfer, codec, indexer )
+          else:
+            digest_map = _download( resp, local_file, hasher, transfer, indexer )
+
+        except Exception as e:
+          cache.discard( local_file )
+          raise e
+
+    return cache.put( cache_key, validator, immutable, local_file, digest_map, _index_result( indexer ) )
+
+  finally:
+    lock.close()
 
 
 def file_writer( url, local_file, filename, proxy, sslContext ):
   logging.debug( 'file_writer: uploading to "{0}"'.format( url ) )
 
-  file_size = local_file.seek( 0, 2 )
-  local_file.seek( 0, 0 )
-
   header_map = {
-                 'Content-Length': file_size,
                  'Content-Disposition': 'inline: filename="{0}"'.format( filename ),
                  'Content-Type': 'application/octet-stream'
                }
 
-  logger = _file_writer_progress( local_file, file_size )
-  logger.start()
   try:
+    header_map[ 'Content-Length' ] = local_file.seek( 0, 2 )
+    local_file.seek( 0, 0 )
+
+  except ( AttributeError, OSError ):  # not seekable
+    try:
+      header_map[ 'Content-Length' ] = len( local_file )  # but it knows how big it will be, ie: a tar generated as it is sent
+    except TypeError:  # so we don't know how big it is, send it chunked
+      header_map[ 'Transfer-Encoding' ] = 'chunked'
+
+  with SCHEDULER.transfer( 'upload "{0}"'.format( filename ), _destination( url ), header_map.get( 'Content-Length', None ) ):  # progress is reported by the transfer
     req = request.Request( url, data=local_file, headers=header_map, method='POST' )
     resp = open_url( req, proxy, 202, sslContext )  # TODO: strip the query string from the url?
 
-  finally:
-    logger.stop()
-
   # TODO: the rest of this should be in the handler some how, see if there is some hook that happens when the writing is closed or something
-  result = resp.read()
+  _add_package_file( url, resp.read(), proxy )
+
+
+def _add_package_file( url, result, proxy ):
+  """
+  Add the file uploaded to url to packrat, result is the body of the upload response.
+  """
   file_uri = json.loads( str( result, 'utf-8' ) )[ 'uri' ]  # TODO: need some error checking and such here
 
   parts = parse.urlparse( url )
@@ -149,7 +834,6 @@ def file_writer( url, local_file, filename, proxy, sslContext ):
   else:
     parts = parts._replace( scheme='http', query=None, path='' )
 
-  packrat = Packrat( parse.urlunparse( parts ), 'nullunit', 'nullunit', proxy )  # TODO: get username and password from URL?
-
-  logging.info( 'file_writer: Adding Packge File "{0}"'.format( packagefile_name ) )
-  packrat.addPackageFile( file_uri, options[ 'justification' ][0], options[ 'provenance' ][0], options.get( 'type', None ), options.get( 'distroversion', None ))
+  with PACKRAT_SESSIONS.session( parse.urlunparse( parts ), 'nullunit', 'nullunit', proxy ) as packrat:  # TODO: get username and password from URL?
+    logging.info( 'file_writer: Adding Packge File "{0}"'.format( packagefile_name ) )
+    packrat.addPackageFile( file_uri, options[ 'justification' ][0], options[ 'provenance' ][0], options.get( 'type', None ), options.get( 'distroversion', None ))
@@ -0,0 +1,135 @@
+import os
+import logging
+import threading
+from urllib import parse
+
+from subcontractor_plugins.common.cache import get_cache, set_recording
+from subcontractor_plugins.common.files import WEB_HANDLE_TIMEOUT, file_reader, _packrat_handler, _entry_validator
+
+PREFETCH_URL_LIST = []  # packrat urls to allways keep up to date, ie: 'packrat://packrat/prod/ova/ubuntu-noble'
+PREFETCH_COUNT = 10  # number of the most recently used packrat urls to keep up to date
+PREFETCH_INTERVAL = 300  # in seconds, how often to check the manifests for new versions
+PREFETCH_IDLE_WAIT = 10  # in seconds, how long to wait for the other transfers to finish before checking again
+PREFETCH_NICE = 10  # nice increment for the prefetch thread
+
+# Keeps the download cache warm, every PREFETCH_INTERVAL the manifests of the configured and most recently used
+# packrat urls are checked, anything that resolves to a version that is not in the cache is downloaded, so it is
+# allready there when a build asks for it.  Prefetching only starts a download when no other transfers are running, in
+# any process using the cache dir, see DownloadCache.busy().
+# Run it in process with start(), or as it's own daemon with "python3 -m subcontractor_plugins.common.prefetch", the
+# recently used list is kept in the cache dir, so the daemon sees what the subcontractor process has been asking for.
+
+
+class Prefetcher():
+  def __init__( self, url_list, count, interval, proxy ):
+    super().__init__()
+    self.url_list = url_list
+    self.count = count
+    self.interval = interval
+    self.proxy = proxy
+    self.stop_event = threading.Event()
+    self.thread = None
+
+  def start( self ):
+    if self.thread is not None:
+      return
+
+    self.stop_event.clear()
+    self.thread = threading.Thread( target=self.run, name='prefetch', daemon=True )
+    self.thread.start()
+
+  def stop( self ):
+    self.stop_event.set()
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+
+  def run( self ):
+    set_recording( False )
+    try:
+      os.nice( PREFETCH_NICE )  # on linux this only applies to the calling thread
+    except OSError:
+      pass
+
+    while not self.stop_event.is_set():
+      try:
+        self.prefetch()
+      except Exception as e:
+        logging.warning( 'prefetch: Exception while prefetching: "{0}"'.format( e ) )
+
+      self.stop_event.wait( self.interval )
+
+  def _wait_idle( self, cache ):
+    while cache.busy():
+      if self.stop_event.wait( PREFETCH_IDLE_WAIT ):
+        return False
+
+    return True
+
+  def prefetch( self ):
+    """
+    Check each url once, and download the ones that are out of date.
+    """
+    cache = get_cache()
+    if cache is None:
+      return
+
+    key_list = list( self.url_list )
+    for key in cache.recent_uses( self.count ):
+      if key not in key_list:
+        key_list.append( key )
+
+    handler = _packrat_handler( self.proxy )
+    for key in key_list:
+      if self.stop_event.is_set():
+        return
+
+      url, _, fragment = key.partition( '#' )
+      parts = parse.urlparse( url )
+      if parts.scheme not in ( 'packrat', 'packrats' ):
+        continue
+
+      selector = parse.urlunparse( ( '', '', parts.path, '', parts.query, '' ) )
+      try:
+        _, entry = handler.resolve( parts.netloc, selector, parts.scheme == 'packrats', WEB_HANDLE_TIMEOUT )
+      except Exception as e:
+        logging.warning( 'prefetch: Unable to resolve "{0}": "{1}"'.format( url, e ) )
+        continue
+
+      if cache.validator( key ) == _entry_validator( entry ):
+        continue
+
+      if not self._wait_idle( cache ):
+        return
+
+      logging.info( 'prefetch: fetching version "{0}" of "{1}"'.format( entry[ 'version' ], url ) )
+      tar_index = cache.indexed( key )  # keep indexing what was indexed before, ie: OVAs
+      cache.expire( key )  # otherwise a recently fetched entry would be trusted without checking the version
+      try:
+        file_reader( url, self.proxy, None, decompress=( fragment == 'decompress' ), tar_index=tar_index ).close()
+      except Exception as e:
+        logging.warning( 'prefetch: Unable to fetch "{0}": "{1}"'.format( url, e ) )
+
+
+PREFETCHER = Prefetcher( PREFETCH_URL_LIST, PREFETCH_COUNT, PREFETCH_INTERVAL, None )
+
+
+def start():
+  """
+  Start prefetching in a background thread of this process.
+  """
+  PREFETCHER.start()
+
+
+if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser( description='Keep the subcontractor_plugins download cache up to date with the latest packrat files' )
+  parser.add_argument( '--count', type=int, default=PREFETCH_COUNT, help='number of the most recently used urls to keep up to date' )
+  parser.add_argument( '--interval', type=int, default=PREFETCH_INTERVAL, help='seconds between checks for new versions' )
+  parser.add_argument( '--proxy', default=None, help='proxy to download through' )
+  parser.add_argument( 'url', nargs='*', help='packrat urls to allways keep up to date' )
+  args = parser.parse_args()
+
+  logging.basicConfig( level=logging.INFO )
+  Prefetcher( PREFETCH_URL_LIST + args.url, args.count, args.interval, args.proxy ).run()
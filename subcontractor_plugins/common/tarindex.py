@@ -0,0 +1,174 @@
+import hashlib
+import tarfile
+
+TAR_INDEX_HASHES = ( 'sha1', 'sha256' )  # hashes calculated for each member, OVA manifests use one of these
+
+# The index of a tar file is a map of member name -> { 'offset': offset of the data in the tar, 'size': size of the data, 'digest_map': { algorithm: hex digest } }
+# only regular files are indexed, in the order they are in the tar.
+
+_META_TYPES = ( tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK )
+_FILE_TYPES = ( tarfile.REGTYPE, tarfile.AREGTYPE, tarfile.CONTTYPE )
+_OTHER_TYPES = ( tarfile.DIRTYPE, tarfile.SYMTYPE, tarfile.LNKTYPE, tarfile.CHRTYPE, tarfile.BLKTYPE, tarfile.FIFOTYPE )  # these have no data
+
+
+def _parse_pax( buff ):
+  """
+  Returns the map of keyword -> value of the pax records in buff.
+  """
+  result = {}
+  pos = 0
+  while pos < len( buff ):
+    space = buff.index( b' ', pos )
+    length = int( buff[ pos:space ] )
+    if length <= 0:
+      raise ValueError( 'Invalid pax record length' )
+
+    keyword, _, value = buff[ space + 1:pos + length - 1 ].partition( b'=' )  # the record ends with a newline
+    result[ keyword.decode( 'utf-8' ) ] = value.decode( 'utf-8', 'surrogateescape' )
+    pos += length
+
+  return result
+
+
+class TarIndexer():
+  """
+  Builds the index of a tar file as it goes by, feed it the contents in order with update().
+  Each member is hashed as it goes by too.  ustar, gnu and pax ( for long names and sizes ) headers
+  are handled, if anything else is found ( ie: sparse files ), result() returns None.
+  """
+  def __init__( self, hash_list=TAR_INDEX_HASHES ):
+    super().__init__()
+    self.hash_list = hash_list
+    self.offset = 0  # offset in the tar of the next byte to be fed in
+    self.next_header = 0  # offset of the next header
+    self.header_buff = b''
+    self.member = None  # [ type, name, data offset, size, hash map or list of the data for the meta types ] of the member being read
+    self.member_end = 0
+    self.override_map = {}  # from pax and gnu long name headers, applies to the next member
+    self.index = {}
+    self.failed = False
+    self.done = False
+
+  def _header( self, offset ):
+    buff = self.header_buff
+    self.header_buff = b''
+    if buff == tarfile.NUL * tarfile.BLOCKSIZE:  # end of archive
+      self.done = True
+      return
+
+    try:
+      info = tarfile.TarInfo.frombuf( buff, tarfile.ENCODING, 'surrogateescape' )
+    except tarfile.HeaderError:
+      self.failed = True
+      return
+
+    data_offset = offset + tarfile.BLOCKSIZE
+    size = info.size
+    if info.type in _META_TYPES:
+      self.member = [ info.type, None, data_offset, size, [] ]
+
+    elif info.type in _FILE_TYPES:
+      name = self.override_map.get( 'path', info.name )
+      try:
+        size = int( self.override_map.get( 'size', size ) )
+      except ValueError:
+        self.failed = True
+        return
+
+      self.override_map = {}
+      self.member = [ info.type, name, data_offset, size, dict( ( algo, hashlib.new( algo ) ) for algo in self.hash_list ) ]
+
+    elif info.type in _OTHER_TYPES:
+      self.override_map = {}
+      size = 0
+
+    else:
+      self.failed = True
+      return
+
+    blocks, remainder = divmod( size, tarfile.BLOCKSIZE )
+    self.next_header = data_offset + ( blocks + ( 1 if remainder else 0 ) ) * tarfile.BLOCKSIZE
+    self.member_end = data_offset + size
+    if self.member is not None and not size:
+      self._end_member()
+
+  def _end_member( self ):
+    type, name, offset, size, data = self.member
+    self.member = None
+    if type in _FILE_TYPES:
+      self.index[ name ] = { 'offset': offset, 'size': size, 'digest_map': dict( ( algo, hash.hexdigest() ) for algo, hash in data.items() ) }
+      return
+
+    buff = b''.join( data )
+    if type == tarfile.XHDTYPE:
+      try:
+        record_map = _parse_pax( buff )
+      except ValueError:
+        self.failed = True
+        return
+
+      if [ keyword for keyword in record_map.keys() if keyword.startswith( 'GNU.sparse.' ) ]:
+        self.failed = True
+        return
+
+      for keyword in ( 'path', 'size' ):
+        if keyword in record_map:
+          self.override_map[ keyword ] = record_map[ keyword ]
+
+    elif type == tarfile.GNUTYPE_LONGNAME:
+      self.override_map[ 'path' ] = buff.rstrip( tarfile.NUL ).decode( tarfile.ENCODING, 'surrogateescape' )
+
+    # global pax headers and gnu long link names do not change where or how big the members are
+
+  def update( self, buff ):
+    view = memoryview( buff )
+    pos = 0
+    while pos < len( view ) and not self.failed and not self.done:
+      offset = self.offset + pos
+      if self.member is not None:
+        count = min( len( view ) - pos, self.member_end - offset )
+        if self.member[0] in _FILE_TYPES:
+          for hash in self.member[4].values():
+            hash.update( view[ pos:pos + count ] )
+        else:
+          self.member[4].append( bytes( view[ pos:pos + count ] ) )
+
+        pos += count
+        if self.offset + pos == self.member_end:
+          self._end_member()
+
+        continue
+
+      if offset < self.next_header:  # padding after the last member's data
+        pos += min( len( view ) - pos, self.next_header - offset )
+        continue
+
+      count = min( len( view ) - pos, tarfile.BLOCKSIZE - len( self.header_buff ) )
+      self.header_buff += bytes( view[ pos:pos + count ] )
+      pos += count
+      if len( self.header_buff ) == tarfile.BLOCKSIZE:
+        self._header( self.next_header )
+
+    self.offset += len( buff )
+
+  def result( self ):
+    """
+    Returns the index, or None if it could not be built.
+    """
+    if self.failed or self.member is not None or not self.done:
+      return None
+
+    return self.index
+
+
+def index_tar_file( file ):
+  """
+  Build the index of a seekable tar file by walking it's headers, the index has no digests.
+  """
+  file.seek( 0 )
+  try:
+    with tarfile.open( fileobj=file, mode='r' ) as tar:
+      return dict( ( member.name, { 'offset': member.offset_data, 'size': member.size, 'digest_map': {} } ) for member in tar.getmembers() if member.isreg() )
+
+  finally:
+    file.seek( 0 )
@@ -0,0 +1,333 @@
+import time
+import heapq
+import logging
+import threading
+from collections import OrderedDict
+
+from subcontractor_plugins.common.cache import get_cache
+
+PROGRESS_INTERVAL = 10  # in seconds
+MAX_CONCURRENT_TRANSFERS = 8
+BANDWIDTH_LIMIT = None  # in bytes/second across all transfers, None for unlimited
+DESTINATION_BANDWIDTH_LIMIT = None  # in bytes/second to/from any one host, None for unlimited
+
+_local = threading.local()
+
+
+def current_transfer():
+  """
+  Returns the Transfer the calling thread is in the middle of, or None.
+  """
+  return getattr( _local, 'transfer', None )
+
+
+class ProgressReporter():
+  """
+  One thread that calls registered callbacks every interval seconds, used for
+  progress reporting instead of a Timer thread per transfer.  The callbacks are called
+  one after the other, so they must not block, ie: no network calls.
+  """
+  def __init__( self ):
+    super().__init__()
+    self.cond = threading.Condition()
+    self.entry_map = {}  # handle -> ( callback, interval )
+    self.heap = []  # ( due time, handle )
+    self.counter = 0
+    self.thread = None
+
+  def register( self, callback, interval=PROGRESS_INTERVAL ):
+    """
+    callback() will be called every interval seconds until the returned handle is unregistered.
+    """
+    with self.cond:
+      self.counter += 1
+      handle = self.counter
+      self.entry_map[ handle ] = ( callback, interval )
+      heapq.heappush( self.heap, ( time.monotonic() + interval, handle ) )
+      if self.thread is None:
+        self.thread = threading.Thread( target=self._run, name='progress', daemon=True )
+        self.thread.start()
+
+      self.cond.notify()
+
+    return handle
+
+  def unregister( self, handle ):
+    with self.cond:
+      self.entry_map.pop( handle, None )  # the heap entry is dropped when it comes due
+
+  def _run( self ):
+    while True:
+      with self.cond:
+        while not self.heap:
+          self.cond.wait()
+
+        due, handle = self.heap[0]
+        now = time.monotonic()
+        if due > now:
+          self.cond.wait( due - now )
+          continue
+
+        heapq.heappop( self.heap )
+        try:
+          callback, interval = self.entry_map[ handle ]
+        except KeyError:
+          continue
+
+        heapq.heappush( self.heap, ( now + interval, handle ) )
+
+      try:
+        callback()
+      except Exception as e:
+        logging.warning( 'progress: Exception in callback "{0}": "{1}"'.format( callback, e ) )
+
+
+PROGRESS = ProgressReporter()
+
+
+def log_progress( name, done, total, rate, eta ):
+  """
+  The default progress callback.
+  """
+  if total is None:
+    logging.debug( 'transfer: "{0}" at {1}, {2:.1f} MiB/s'.format( name, done, rate / 1048576.0 ) )
+  elif eta is None:
+    logging.debug( 'transfer: "{0}" at {1} of {2}, {3:.1f} MiB/s'.format( name, done, total, rate / 1048576.0 ) )
+  else:
+    logging.debug( 'transfer: "{0}" at {1} of {2}, {3:.1f} MiB/s, ETA {4:.0f} seconds'.format( name, done, total, rate / 1048576.0, eta ) )
+
+
+class TokenBucket():
+  """
+  Bandwidth limiter, rate is in bytes/second with up to a second of burst.
+  consumers are allowed to go into debt, and then sleep it off, so a large block
+  does not have to wait for the bucket to fill all the way.
+  """
+  def __init__( self, rate ):
+    super().__init__()
+    self.rate = float( rate )
+    self.tokens = self.rate
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  def consume( self, count ):
+    """
+    Take count tokens, returns how many seconds the consumer needs to wait to pay off the debt, 0 if none.
+    """
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min( self.rate, self.tokens + ( now - self.last ) * self.rate )
+      self.last = now
+      self.tokens -= count
+      debt = -self.tokens
+
+    return max( debt, 0 ) / self.rate
+
+
+class TransferCancelled( Exception ):
+  pass
+
+
+class Transfer():
+  """
+  A transfer that has been admitted by the TransferScheduler, call update( byte_count )
+  as data moves, it will block as needed to keep under the bandwidth limits.
+  Every PROGRESS_INTERVAL progress_cb( name, done, total, rate, eta ) is called, rate is in bytes/second,
+  total and eta ( in seconds ) are None if the total size is not known.
+  Use it as a context manager, on exit the slot is given back to the scheduler.
+  cancel() makes the next update() raise TransferCancelled, for stopping transfers from another thread.
+  """
+  def __init__( self, scheduler, name, destination, total, job, bucket_list, progress_cb ):
+    super().__init__()
+    self.scheduler = scheduler
+    self.name = name
+    self.destination = destination
+    self.total = total
+    self.job = job
+    self.bucket_list = bucket_list
+    self.progress_cb = progress_cb
+    self.done = 0
+    self.lock = threading.Lock()
+    self.finished = False
+    self.cancelled = False
+    self._prev = None
+    self._last = ( time.monotonic(), 0 )
+    self._progress_handle = PROGRESS.register( self._report )
+
+  def _report( self ):
+    now = time.monotonic()
+    done = self.done
+    last_time, last_done = self._last
+    self._last = ( now, done )
+    rate = ( done - last_done ) / max( now - last_time, 0.001 )
+    eta = None
+    if self.total is not None and rate > 0:
+      eta = ( int( self.total ) - done ) / rate
+
+    self.progress_cb( self.name, done, self.total, rate, eta )
+
+  def update( self, count ):
+    delay = self.take( count )
+    if delay > 0:
+      time.sleep( delay )
+
+  def take( self, count ):
+    """
+    Same as update, except it returns how many seconds to wait to stay under the bandwidth limits
+    instead of sleeping, for callers that can't block, ie: the asyncio transfers.
+    """
+    if self.cancelled:
+      raise TransferCancelled( 'Transfer "{0}" cancelled'.format( self.name ) )
+
+    with self.lock:
+      self.done += count
+
+    delay = 0
+    for bucket in self.bucket_list:
+      delay = max( delay, bucket.consume( count ) )
+
+    return delay
+
+  def cancel( self ):
+    self.cancelled = True
+
+  def finish( self ):
+    if self.finished:
+      return
+
+    self.finished = True
+    PROGRESS.unregister( self._progress_handle )
+    if self.scheduler is not None:
+      self.scheduler._release( self )
+
+  def __enter__( self ):
+    self._prev = current_transfer()
+    _local.transfer = self
+    return self
+
+  def __exit__( self, exc_type, exc_value, traceback ):
+    _local.transfer = self._prev
+    self.finish()
+
+
+class TransferScheduler():
+  """
+  Limits the number of concurrent transfers, when full, waiting transfers are admitted
+  round robin by job, so one job queueing many transfers does not starve the others.
+  A job that allready has a transfer running is admitted right away, so a job can
+  download and upload at the same time without deadlocking against other jobs.
+
+  MAX_CONCURRENT_TRANSFERS, BANDWIDTH_LIMIT and DESTINATION_BANDWIDTH_LIMIT are read
+  each time a transfer starts, so they can be changed after this module is imported.
+  While any transfers are running, a shared lock is held on the download cache's busy.lock,
+  so the prefetcher stays out of the way, even when it is running in another process.
+  """
+  def __init__( self ):
+    super().__init__()
+    self.global_bucket = None
+    self.destination_bucket_map = {}
+    self.lock = threading.Condition()
+    self.active_map = {}  # job -> number of active transfers
+    self.active_count = 0
+    self.waiting_map = OrderedDict()  # job -> number of waiting transfers, in the order they get to go next
+    self.busy_file = None
+
+  def _buckets( self, destination ):  # call with self.lock held
+    result = []
+    if not BANDWIDTH_LIMIT:
+      self.global_bucket = None
+    else:
+      if self.global_bucket is None or self.global_bucket.rate != BANDWIDTH_LIMIT:
+        self.global_bucket = TokenBucket( BANDWIDTH_LIMIT )
+
+      result.append( self.global_bucket )
+
+    if not DESTINATION_BANDWIDTH_LIMIT:
+      self.destination_bucket_map = {}
+    elif destination is not None:
+      bucket = self.destination_bucket_map.get( destination )
+      if bucket is None or bucket.rate != DESTINATION_BANDWIDTH_LIMIT:
+        bucket = TokenBucket( DESTINATION_BANDWIDTH_LIMIT )
+        self.destination_bucket_map[ destination ] = bucket
+
+      result.append( bucket )
+
+    return result
+
+  def _admit( self, job ):
+    self.active_map[ job ] = self.active_map.get( job, 0 ) + 1
+    self.active_count += 1
+    if self.busy_file is None:
+      cache = get_cache()
+      if cache is not None:
+        try:
+          self.busy_file = cache.busy_lock()
+        except OSError as e:
+          logging.debug( 'transfer: Unable to lock busy.lock: "{0}"'.format( e ) )
+
+  def transfer( self, name, destination=None, total=None, job=None, progress_cb=log_progress ):
+    """
+    Wait for a slot and return the Transfer for it.
+    """
+    if job is None:
+      job = threading.get_ident()
+
+    with self.lock:
+      if job in self.active_map or ( self.active_count < MAX_CONCURRENT_TRANSFERS and not self.waiting_map ):
+        self._admit( job )
+
+      else:
+        logging.debug( 'transfer: "{0}" waiting, {1} active transfers'.format( name, self.active_count ) )
+        self.waiting_map[ job ] = self.waiting_map.get( job, 0 ) + 1
+        while True:
+          if self.active_count < MAX_CONCURRENT_TRANSFERS and next( iter( self.waiting_map ) ) == job:
+            break
+
+          if job in self.active_map:  # one of our other transfers got in
+            break
+
+          self.lock.wait()
+
+        self.waiting_map[ job ] -= 1
+        if self.waiting_map[ job ]:
+          self.waiting_map.move_to_end( job )  # let the other jobs go first
+        else:
+          del self.waiting_map[ job ]
+
+        self._admit( job )
+        self.lock.notify_all()
+
+      return Transfer( self, name, destination, total, job, self._buckets( destination ), progress_cb )
+
+  def unscheduled_transfer( self, name, destination=None, total=None, progress_cb=log_progress ):
+    """
+    Returns a Transfer that does not take one of the slots, for the asyncio transfers, the
+    event loop limits those, not threads.  It still counts against the bandwidth limits.
+    """
+    with self.lock:
+      bucket_list = self._buckets( destination )
+
+    return Transfer( None, name, destination, total, None, bucket_list, progress_cb )
+
+  def busy( self ):
+    """
+    Returns True if any transfers are running or waiting.
+    """
+    with self.lock:
+      return bool( self.active_count or self.waiting_map )
+
+  def _release( self, transfer ):
+    with self.lock:
+      self.active_count -= 1
+      self.active_map[ transfer.job ] -= 1
+      if not self.active_map[ transfer.job ]:
+        del self.active_map[ transfer.job ]
+
+      if not self.active_count and self.busy_file is not None:
+        self.busy_file.close()
+        self.busy_file = None
+
+      self.lock.notify_all()
+
+
+SCHEDULER = TransferScheduler()
@@ -2,11 +2,10 @@ import logging
 import time
 import json
 import base64
-import ssl
-import http
 from urllib import request
 
 from subcontractor.credentials import getCredentials
+from subcontractor_plugins.common.connection import build_opener, unverified_context
 
 
 PROXY = None
@@ -40,21 +39,10 @@ class RedFishClient():
     else:
       self.host = 'http://{0}{1}'.format( self.ip_address, port )
 
-    self.opener = request.OpenerDirector()
-
-    if PROXY:   # not doing 'is not None', so empty strings don't try and proxy
-      self.opener.add_handler( request.ProxyHandler( { 'http': PROXY, 'https': PROXY } ) )
+    if verify_ssl:
+      self.opener = build_opener( PROXY )
     else:
-      self.opener.add_handler( request.ProxyHandler( {} ) )
-
-    self.opener.add_handler( request.HTTPHandler() )
-    if hasattr( http.client, 'HTTPSConnection' ):
-      if not verify_ssl:
-        self.opener.add_handler( request.HTTPSHandler( context=ssl._create_unverified_context() ) )
-      else:
-        self.opener.add_handler( request.HTTPSHandler() )
-
-    self.opener.add_handler( request.UnknownHandler() )
+      self.opener = build_opener( PROXY, unverified_context() )
 
     basic_auth = 'Basic {0}'.format( base64.b64encode( '{0}:{1}'.format( creds[ 'username' ], creds[ 'password' ] ).encode() ).decode() )
 
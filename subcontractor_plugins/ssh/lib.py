@@ -63,15 +63,16 @@ def file( paramaters ):
   logging.info( 'ssh: transfering "{0}"-"{1}" to "{2}"...'.format( source, paramaters[ 'destination' ], paramaters[ 'host' ] ) )
 
   logging.debug( 'ssh: retreiving "{0}"'.format( paramaters[ 'destination' ] ) )
-  local_file = file_reader( source, None )
+  local_file = file_reader( source, None, None, stream=True, decompress=paramaters.get( 'decompress', False ) )  # start sending while it is still downloading
 
   client = _connect( paramaters )
   try:
     sftp = client.open_sftp()
-    sftp.putfo( local_file, paramaters[ 'destination' ], callback=_file_cb )
+    sftp.putfo( local_file, paramaters[ 'destination' ], file_size=getattr( local_file, 'size', None ) or 0, callback=_file_cb )
     sftp.close()
 
   finally:
     client.close()
+    local_file.close()
 
   return { 'rc': True }
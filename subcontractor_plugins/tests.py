@@ -1,2 +1,301 @@
+import io
+import os
+import time
+import types
+import zlib
+import random
+import struct
+import tarfile
+import hashlib
+
+import pytest
+
+
 def test_null():
   pass  # empty test just so we have one so 'make test' passes
+
+
+def test_version_key():
+  Packrat = pytest.importorskip( 'subcontractor_plugins.common.Packrat' )
+  version_key = Packrat.version_key
+
+  assert version_key( '1.9' ) < version_key( '1.10' )
+  assert version_key( '1.2' ) < version_key( '1.2.1' )
+  assert version_key( '1.0~rc1' ) < version_key( '1.0' )
+  assert version_key( '1.0~rc1' ) < version_key( '1.0~rc2' )
+  assert version_key( '1.0~' ) < version_key( '1.0~rc1' )
+  assert version_key( '1.0' ) < version_key( '1.0a' )
+  assert version_key( '1.0-1' ) < version_key( '1.0-2' )
+  assert version_key( '1.0-9' ) < version_key( '1.0-10' )
+  assert version_key( '2.0' ) < version_key( '1:0.5' )
+  assert version_key( '1:0.5' ) < version_key( '2:0.1' )
+  assert version_key( '1.0' ) == version_key( '0:1.0' )
+  assert sorted( [ '1.10', '1.0', '1:0.1', '1.9', '1.0~rc1' ], key=version_key ) == [ '1.0~rc1', '1.0', '1.9', '1.10', '1:0.1' ]
+
+
+def test_version_index():
+  Packrat = pytest.importorskip( 'subcontractor_plugins.common.Packrat' )
+  version_list = [ '1.0~rc1', '1.0', '1.2.0', '1.2.9', '1.2.10', '1.3~rc1', '1.3.0', '1.10', '2.0', '1:0.1' ]
+  index = Packrat.VersionIndex( dict( ( version, version ) for version in version_list ) )
+
+  assert len( index ) == len( version_list )
+  assert index.find( None ) == '1:0.1'
+  assert index.find( 'latest' ) == '1:0.1'
+  assert index.find( '1.2.9' ) == '1.2.9'
+  with pytest.raises( KeyError ):
+    index.find( '1.2.8' )
+
+  assert index.find( '1.2.*' ) == '1.2.10'
+  assert index.find( '1.*' ) == '1.10'
+  assert index.find( '1.0.*' ) == '1.0'  # 1.0~rc1 is before 1.0, but still a 1.0
+  with pytest.raises( KeyError ):
+    index.find( '1.4.*' )
+
+  with pytest.raises( ValueError ):
+    index.find( 'a.*' )
+
+  assert index.find( '>=1.2,<2.0' ) == '1.10'
+  assert index.find( '>=1.2,<1.3' ) == '1.3~rc1'
+  assert index.find( '>=1.2,<1.3~' ) == '1.2.10'
+  assert index.find( '>1.0,<=1.2.9' ) == '1.2.9'
+  assert index.find( '<1.0' ) == '1.0~rc1'
+  assert index.find( '>=2.0' ) == '1:0.1'
+  assert index.find( '>=1.0, <= 2.0' ) == '2.0'
+  with pytest.raises( KeyError ):
+    index.find( '>2.0,<1:0' )
+
+  with pytest.raises( KeyError ):
+    index.find( '>1.10,<2.0' )
+
+  with pytest.raises( ValueError ):
+    index.find( '>=1.0,=1.2' )
+
+
+def _decode_stream_optimized( buff, vmdk ):
+  """
+  Walk a streamOptimized VMDK the way a reader of the spec would, returns ( header, footer, disk contents ).
+  """
+  SECTOR_SIZE = vmdk.SECTOR_SIZE
+  header = vmdk.read_header( buff )
+  assert header is not None
+  assert header[ 'flags' ] & vmdk.FLAG_COMPRESSED and header[ 'flags' ] & vmdk.FLAG_MARKERS
+  assert header[ 'compress' ] == vmdk.COMPRESS_DEFLATE
+  assert header[ 'gd_offset' ] == vmdk.GD_AT_END
+  assert b'createType="streamOptimized"' in buff[ SECTOR_SIZE:vmdk.OVERHEAD * SECTOR_SIZE ]
+
+  grain_map = {}  # sector of the grain marker -> ( lba, data )
+  gt_list = []  # ( sector, grain table )
+  gd = None
+  gd_sector = None
+  footer = None
+  sector = vmdk.OVERHEAD
+  while True:
+    assert ( sector + 1 ) * SECTOR_SIZE <= len( buff ), 'ran off the end with out an end of stream marker'
+    value, size = struct.unpack_from( vmdk.GRAIN_MARKER_FORMAT, buff, sector * SECTOR_SIZE )
+    if size:  # a grain
+      data = zlib.decompress( buff[ sector * SECTOR_SIZE + 12:sector * SECTOR_SIZE + 12 + size ] )
+      assert len( data ) == vmdk.GRAIN_SIZE * SECTOR_SIZE
+      grain_map[ sector ] = ( value, data )
+      sector += ( 12 + size + SECTOR_SIZE - 1 ) // SECTOR_SIZE
+      continue
+
+    _, _, type = struct.unpack_from( vmdk.MARKER_FORMAT, buff, sector * SECTOR_SIZE )
+    sector += 1
+    if type == vmdk.MARKER_EOS:
+      break
+
+    start = sector * SECTOR_SIZE
+    if type == vmdk.MARKER_GT:
+      gt_list.append( ( sector, struct.unpack_from( '<{0}I'.format( vmdk.GTES_PER_GT ), buff, start ) ) )
+    elif type == vmdk.MARKER_GD:
+      gd_sector = sector
+      gd = struct.unpack_from( '<{0}I'.format( len( gt_list ) ), buff, start )
+    elif type == vmdk.MARKER_FOOTER:
+      footer = vmdk.read_header( buff[ start:start + SECTOR_SIZE ] )
+    else:
+      assert False, 'unknown marker type {0}'.format( type )
+
+    sector += value
+
+  assert sector * SECTOR_SIZE == len( buff )
+  assert footer is not None and footer[ 'gd_offset' ] == gd_sector
+  assert list( gd ) == [ item[0] for item in gt_list ]
+
+  disk = bytearray( header[ 'capacity' ] * SECTOR_SIZE )
+  for gd_index, ( _, gt ) in enumerate( gt_list ):
+    for gt_index, grain_sector in enumerate( gt ):
+      if not grain_sector:
+        continue
+
+      lba, data = grain_map.pop( grain_sector )
+      assert lba == ( gd_index * vmdk.GTES_PER_GT + gt_index ) * vmdk.GRAIN_SIZE
+      disk[ lba * SECTOR_SIZE:lba * SECTOR_SIZE + len( data ) ] = data[ :len( disk ) - lba * SECTOR_SIZE ]
+
+  assert not grain_map, 'grains not in any grain table'
+  return header, footer, bytes( disk )
+
+
+def test_stream_optimized_writer():
+  vmdk = pytest.importorskip( 'subcontractor_plugins.vcenter.vmdk' )
+  grain_bytes = vmdk.GRAIN_SIZE * vmdk.SECTOR_SIZE
+  gt_bytes = grain_bytes * vmdk.GTES_PER_GT
+
+  # a bit over two grain tables, some grains empty, and a short grain at the end
+  image = bytearray( gt_bytes * 2 + grain_bytes * 3 + 1000 )
+  random.seed( 0 )
+  for offset in ( 0, grain_bytes * 2 + 7, gt_bytes - 10, gt_bytes * 2 + grain_bytes, len( image ) - 500 ):
+    image[ offset:offset + 300 ] = bytes( random.getrandbits( 8 ) for _ in range( 300 ) )
+
+  image[ grain_bytes * 5:grain_bytes * 6 ] = b'\x55' * grain_bytes  # a whole grain that compresses well
+
+  file = io.BytesIO()
+  writer = vmdk.StreamOptimizedWriter( file, len( image ), 'test.vmdk' )
+  view = memoryview( bytes( image ) )
+  for pos in range( 0, len( image ), 100000 ):  # chunks that don't line up with the grains
+    writer.write( view[ pos:pos + 100000 ].tobytes() )
+
+  writer.close()
+  buff = file.getvalue()
+
+  assert writer.digest == hashlib.sha256( buff ).hexdigest()
+  assert writer.stats[ 'bytes_out' ] == len( buff )
+  assert writer.stats[ 'bytes_in' ] == len( image )
+  assert vmdk.disk_type( buff ) == 'streamOptimized'
+
+  header, footer, disk = _decode_stream_optimized( buff, vmdk )
+  assert header[ 'capacity' ] * vmdk.SECTOR_SIZE >= len( image )
+  assert footer[ 'capacity' ] == header[ 'capacity' ]
+  assert disk[ :len( image ) ] == bytes( image )
+  assert not any( disk[ len( image ): ] )
+  data_grains = len( [ pos for pos in range( 0, len( image ), grain_bytes ) if any( image[ pos:pos + grain_bytes ] ) ] )
+  assert writer.stats[ 'grains' ] - writer.stats[ 'zero_grains' ] == data_grains
+
+
+def test_cache_evict( tmp_path ):
+  from subcontractor_plugins.common.cache import DownloadCache
+
+  cache = DownloadCache( str( tmp_path ), 10 * 1024 * 1024 )
+
+  def _put( url, size ):
+    local_file = cache.new_file()
+    local_file.write( b'x' * size )
+    return cache.put( url, 'v1', False, local_file )
+
+  _put( 'http://test/old', 4 * 1024 * 1024 ).close()
+
+  # a big partial being filled, it is newer than everything and over the limit on it's own
+  lock = cache.lock_entry( 'http://test/partial' )
+  part_file, _ = cache.partial( 'http://test/partial', 'v1', 40 * 1024 * 1024 )
+  part_file.truncate( 40 * 1024 * 1024 )
+
+  new_file = _put( 'http://test/new', 1024 )
+  assert new_file.read() == b'x' * 1024
+  new_file.close()
+
+  assert cache.get( 'http://test/new' ) is not None
+  assert cache.get( 'http://test/old' ) is None  # the oldest goes to make room
+  assert os.path.exists( cache._path( 'http://test/partial' ) + '.part' )
+
+  # once it is done, the partial is renamed into place
+  lock.close()
+  cache.put( 'http://test/partial', 'v1', False, part_file ).close()
+  assert cache.get( 'http://test/partial' ) is not None
+  assert cache.get( 'http://test/new' ) is None
+
+
+def test_tar_indexer():
+  from subcontractor_plugins.common.tarindex import TarIndexer
+
+  random.seed( 1 )
+  content_map = {
+                  'disk.ovf': b'<Envelope/>\n',
+                  'a' * 150 + '/disk1.vmdk': bytes( random.getrandbits( 8 ) for _ in range( 70001 ) ),  # long name, does not end on a block
+                  'empty.mf': b'',
+                  'disk2.vmdk': bytes( 1024 ),
+                }
+  file = io.BytesIO()
+  with tarfile.open( fileobj=file, mode='w', format=tarfile.PAX_FORMAT ) as tar:
+    info = tarfile.TarInfo( 'a' * 150 )
+    info.type = tarfile.DIRTYPE
+    tar.addfile( info )
+    for name, content in content_map.items():
+      info = tarfile.TarInfo( name )
+      info.size = len( content )
+      tar.addfile( info, io.BytesIO( content ) )
+
+  buff = file.getvalue()
+
+  indexer = TarIndexer()
+  for pos in range( 0, len( buff ), 333 ):  # pieces that don't line up with the blocks
+    indexer.update( buff[ pos:pos + 333 ] )
+
+  index = indexer.result()
+  assert index is not None
+
+  file.seek( 0 )
+  with tarfile.open( fileobj=file, mode='r' ) as tar:
+    member_list = [ member for member in tar.getmembers() if member.isreg() ]
+
+  assert list( index.keys() ) == [ member.name for member in member_list ]
+  for member in member_list:
+    entry = index[ member.name ]
+    assert entry[ 'offset' ] == member.offset_data
+    assert entry[ 'size' ] == member.size
+    assert buff[ entry[ 'offset' ]:entry[ 'offset' ] + entry[ 'size' ] ] == content_map[ member.name ]
+    assert entry[ 'digest_map' ][ 'sha256' ] == hashlib.sha256( content_map[ member.name ] ).hexdigest()
+
+
+def test_task_waiter_restart( monkeypatch ):
+  tasks = pytest.importorskip( 'subcontractor_plugins.vcenter.tasks' )
+
+  class _Collector():
+    def __init__( self, waiter ):
+      super().__init__()
+      self.waiter = waiter
+      self.pending_list = []
+
+    def CreateFilter( self, spec, partial ):
+      self.pending_list += list( self.waiter.entry_map.keys() )
+      return types.SimpleNamespace( DestroyPropertyFilter=lambda: None )
+
+    def WaitForUpdatesEx( self, version, options ):
+      time.sleep( 0.01 )
+      if not self.pending_list:
+        return None
+
+      object_list = [ types.SimpleNamespace( obj=types.SimpleNamespace( _moId=moId ), changeSet=[ types.SimpleNamespace( name='info.state', val='success' ) ] ) for moId in self.pending_list ]
+      self.pending_list = []
+      return types.SimpleNamespace( version=version + '1', filterSet=[ types.SimpleNamespace( objectSet=object_list ) ] )
+
+    def DestroyPropertyCollector( self ):
+      pass
+
+  class _Session():
+    def __init__( self, waiter ):
+      super().__init__()
+      self.waiter = waiter
+
+    def __enter__( self ):
+      collector = _Collector( self.waiter )
+      content = types.SimpleNamespace( propertyCollector=types.SimpleNamespace( CreatePropertyCollector=lambda: collector ) )
+      return types.SimpleNamespace( content=content, _stub=None )
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+      pass
+
+  waiter = tasks.TaskWaiter( { 'host': 'vcenter' } )
+  monkeypatch.setattr( tasks, 'VCENTER_SESSIONS', types.SimpleNamespace( session=lambda connection_paramaters: _Session( waiter ) ) )
+  monkeypatch.setattr( tasks, 'TASK_IDLE_TIMEOUT', 0.2 )
+
+  assert waiter.wait( types.SimpleNamespace( _moId='task-1' ) )
+
+  thread = waiter.thread
+  thread.join( 5 )
+  assert not thread.is_alive()  # stopped for being idle
+
+  for count in range( 3 ):  # each time it is restarted, it follows the task instead of stopping right away
+    time.sleep( 0.3 )
+    assert waiter.wait( types.SimpleNamespace( _moId='task-{0}'.format( count + 2 ) ) )
+    assert waiter.thread is not thread
+    thread = waiter.thread
+    thread.join( 5 )
@@ -1,49 +1,68 @@
-import ssl
+import re
 import tarfile
 import logging
 import time
 import os
 import io
 import tempfile
-import http
 import hashlib
-from threading import Timer
-from datetime import datetime, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 
 from urllib import request
 from pyVmomi import vim, vmodl
 
-from subcontractor_plugins.common.files import file_reader, file_writer
+from subcontractor_plugins.common.files import file_reader, file_writer, Hasher, HashingReader, FileHashException, HASH_ALGORITHMS
+from subcontractor_plugins.common.tarindex import index_tar_file
+from subcontractor_plugins.common.connection import build_opener, unverified_context
+from subcontractor_plugins.common.transfer import SCHEDULER, PROGRESS
+from subcontractor_plugins.vcenter.vmdk import StreamOptimizedWriter, disk_type, convert_file
 
 """
 Initially derived from code from https://github.com/vmware/pyvmomi-community-samples/blob/master/samples/deploy_ova.py and deploy_ovf.py
 """
 
-PROGRESS_INTERVAL = 10  # in seconds
+PROGRESS_INTERVAL = 10  # in seconds, how often to log the progress of leases
+LEASE_KEEPALIVE_INTERVAL = 60  # in seconds, how often to renew leases, it is also kept to under a third of the lease's timeout
 DOWNLOAD_FILE_TIMEOUT = 60  # in seconds
+UPLOAD_WORKERS = 4  # number of disks to upload at once
+DOWNLOAD_WORKERS = 4  # number of disks to download at once
+TAR_STREAM_BLOCK_SIZE = 4096 * 1024  # in bytes
 
 
-def _get_tarfile_size( tarfile ):
+class Lease():
   """
-  Determine the size of a file inside the tarball.
-  If the object has a size attribute, use that. Otherwise seek to the end
-  and report that.
+  Wraps a HttpNfcLease, while started it is renewed every LEASE_KEEPALIVE_INTERVAL ( or a third of the lease's timeout if
+  that is shorter ) with the progress, and the progress is logged every PROGRESS_INTERVAL.  The renewals are SOAP calls that
+  can block, so each lease renews from a thread of it's own, not the shared PROGRESS thread.  The progress is the bytes
+  the disk transfers ( see add_transfer ) have moved out of total_size, if total_size is not known, the capacity of the disks is used.
   """
-  try:
-    return tarfile.size
-  except AttributeError:
-    pass
+  def __init__( self, nfc_lease, total_size=None ):
+    super().__init__()
+    self.lease = nfc_lease
+    self.total_size = total_size
+    self.keepalive_thread = None
+    self.stop_event = threading.Event()
+    self.progress_handle = None
+    self.transfer_list = []  # the disk transfers
 
-  size = tarfile.seek( 0, 2 )
-  tarfile.seek( 0, 0 )
-  return size
+  def add_transfer( self, transfer ):
+    self.transfer_list.append( transfer )
 
+  def cancel_transfers( self ):
+    for transfer in self.transfer_list:
+      transfer.cancel()
 
-class Lease():
-  def __init__( self, nfc_lease ):
-    super().__init__()
-    self.lease = nfc_lease
-    self.cont = False
+  @property
+  def sent( self ):  # each transfer counts under it's own lock, so this is exact no matter the order or how many are running
+    return sum( [ transfer.done for transfer in self.transfer_list ] )
+
+  @property
+  def progress( self ):
+    if not self.total_size:
+      return 0
+
+    return int( min( self.sent * 100 / self.total_size, 99 ) )  # 100 is for when the lease is complete
 
   def start_wait( self ):
     count = 0
@@ -76,19 +95,46 @@ class Lease():
     return self.lease.info
 
   def start( self ):
-    self.cont = True
-    Timer( PROGRESS_INTERVAL, self._timer_cb ).start()
+    interval = LEASE_KEEPALIVE_INTERVAL
+    try:
+      info = self.lease.info
+      if not self.total_size:  # ie: streaming an OVA with out file sizes in the descriptor
+        self.total_size = ( info.totalDiskCapacityInKB or 0 ) * 1024
+
+      if info.leaseTimeout:
+        interval = min( interval, max( info.leaseTimeout / 3.0, 1 ) )
+
+    except Exception as e:
+      logging.warning( 'Lease: Unable to get lease info: "{0}"'.format( e ) )
+
+    self.stop_event.clear()
+    self.keepalive_thread = threading.Thread( target=self._keepalive, args=( interval, ), name='lease keepalive', daemon=True )
+    self.keepalive_thread.start()
+    self.progress_handle = PROGRESS.register( self._log_progress, PROGRESS_INTERVAL )
 
   def stop( self ):
-    self.cont = False
+    self.stop_event.set()  # not joined, if a renewal is hung, the caller is not held up by it, the thread exits when it returns
+    self.keepalive_thread = None
+    if self.progress_handle is not None:
+      PROGRESS.unregister( self.progress_handle )
+      self.progress_handle = None
+
+  def _keepalive( self, interval ):
+    while not self.stop_event.wait( interval ):
+      try:
+        if self.lease.state != vim.HttpNfcLease.State.ready:
+          return
 
+        self.lease.Progress( self.progress )
+
+      except Exception as e:  # keep trying, a missed renewal is not a problem until the lease times out
+        logging.warning( 'Lease: Exception renewing lease: "{0}"'.format( e ) )
+
+  def _log_progress( self ):
+    logging.debug( 'Lease: progress at {0}%, {1} of {2} bytes'.format( self.progress, self.sent, self.total_size ) )
 
-class ImportLease( Lease ):
-  def __init__( self, nfc_lease, file_handle ):
-    super().__init__( nfc_lease )
-    self.file_handle = file_handle
-    self.file_size = os.stat( file_handle.name ).st_size
 
+class ImportLease( Lease ):
   def get_device_url( self, fileItem ):
     for device in self.lease.info.deviceUrl:
       if device.importKey == fileItem.deviceId:
@@ -96,95 +142,132 @@ class ImportLease( Lease ):
 
     raise Exception( 'Failed to find device.url for file {0}'.format( fileItem.path ) )
 
-  def _timer_cb( self ):
-    if not self.cont:
-      return
 
-    try:
-      cur_pos = self.file_handle.tell()
-      prog = cur_pos * 100 / self.file_size  # interestingly the progres is the offset position in the file, not how much has been uploaded, so if the vmdks are uploaded out of order, the progress is going to jump arround
-      self.lease.Progress( int( prog ) )
-      logging.debug( 'Lease: import progress at {0}%'.format( prog ) )
-      if self.lease.state == vim.HttpNfcLease.State.ready:
-        Timer( PROGRESS_INTERVAL, self._timer_cb ).start()
-
-      else:
-        self.cont = False
+class ExportLease( Lease ):
+  pass
 
-    except Exception as e:  # don't renew the timer
-      logging.warning( 'ImportLease: Exception during _timer_cb: "{0}"'.format( e ) )
-      self.cont = False
 
+def _parse_manifest( manifest ):
+  """
+  Parse the .mf file of an OVA, returns a map of file name -> { algorithm: hex digest }
+  """
+  result = {}
+  for line in manifest.splitlines():
+    match = re.match( r'^\s*(SHA1|SHA256|SHA512)\((.+)\)\s*=\s*([0-9a-fA-F]+)\s*$', line )
+    if match:
+      result.setdefault( match.group( 2 ), {} )[ match.group( 1 ).lower() ] = match.group( 3 )
 
-class ExportLease( Lease ):
-  def __init__( self, nfc_lease ):
-    super().__init__( nfc_lease )
-    self.progress = 0
+  return result
 
-  def _timer_cb( self ):
-    if not self.cont:
-      return
 
-    try:
-      self.lease.Progress( int( self.progress )  )
-      logging.debug( 'ExportLease: export progress at {0}%'.format( self.progress  ) )
-      if self.lease.state == vim.HttpNfcLease.State.ready:
-        Timer( PROGRESS_INTERVAL, self._timer_cb ).start()
+def _check_digests( name, expected_map, digest_map ):
+  """
+  Check the digests from the tar index against the ones from the manifest, returns False
+  if the index dosen't have all the algorithms the manifest has, so it has to be hashed as it is read.
+  """
+  for algo in expected_map.keys():
+    if algo not in digest_map:
+      return False
 
-      else:
-        self.cont = False
+  for algo, expected in expected_map.items():
+    if digest_map[ algo ] != expected.lower():
+      raise FileHashException( '{0} of "{1}" is "{2}" expected "{3}"'.format( algo.upper(), name, digest_map[ algo ], expected.lower() ) )
 
-    except Exception as e:  # don't renew the timer
-      logging.warning( 'ExportLease: Exception during _timer_cb: "{0}"'.format( e ) )
-      self.cont = False
+  return True
 
 
-#  TODO: validate the hashes against the .mf file, so far SHA256 and SHA1 hashes are used
 class OVAImportHandler():
   """
   OVAImportHandler handles most of the OVA operations.
   It processes the tarfile, matches disk keys to files and
   uploads the disks, while keeping the progress up to date for the lease.
+  The members are found with the tar index ( see tarindex.py ), which is built while
+  the OVA is downloaded and cached with it, so the tar is never scanned.
   """
   def __init__( self, ova_file, sslContext ):
     """
     Performs necessary initialization, opening the OVA file,
     processing the files and reading the embedded ovf file.
     """
-    self.handle = file_reader( ova_file, None, sslContext )
-    self.tarfile = tarfile.open( fileobj=self.handle, mode='r' )
-    ovf_filename = list( filter( lambda x: x.endswith( '.ovf' ), self.tarfile.getnames() ) )[0]
-    ovf_file = self.tarfile.extractfile( ovf_filename )
-    self.descriptor = ovf_file.read().decode()
+    self.handle = file_reader( ova_file, None, sslContext, decompress=True, tar_index=True )  # ie: .ova.gz
+    try:
+      self.index = self.handle.tar_index
+      if self.index is None:  # cached before there were indexes, or it has headers the indexer can't handle
+        logging.debug( 'OVAImportHandler: no tar index for "{0}", scanning'.format( ova_file ) )
+        self.index = index_tar_file( self.handle )
+
+      self.manifest = {}
+      mf_filename_list = [ name for name in self.index.keys() if name.endswith( '.mf' ) ]
+      if mf_filename_list:
+        self.manifest = _parse_manifest( self._get_member( mf_filename_list[0] ).read().decode() )
+
+      ovf_filename = [ name for name in self.index.keys() if name.endswith( '.ovf' ) ][0]
+      hasher = Hasher( ovf_filename, self.manifest.get( ovf_filename, {} ) )
+      buff = self._get_member( ovf_filename ).read()
+      hasher.update( buff )
+      hasher.verify()
+      self.descriptor = buff.decode()
+
+    except Exception:
+      self.close()
+      raise
+
+  def close( self ):
+    self.handle.close()
+
+  def _get_member( self, name ):
+    try:
+      entry = self.index[ name ]
+    except KeyError:
+      return None
+
+    return _MemberReader( self.handle.fileno(), entry[ 'offset' ], entry[ 'size' ] )
 
   def _get_disk( self, fileItem ):
     """
-    Does translation for disk key to file name, returning a file handle.
+    Does translation for disk key to file name, returning a reader of the disk.
     """
-    ovf_filename = list( filter( lambda x: x == fileItem.path, self.tarfile.getnames() ) )[0]
-    return self.tarfile.extractfile( ovf_filename )
+    result = self._get_member( fileItem.path )
+    if result is None:
+      raise Exception( 'File "{0}" not found in the OVA'.format( fileItem.path ) )
 
-  def _upload_disk( self, fileItem, lease, host ):
+    return result
+
+  def _upload_disk( self, fileItem, lease, host, job, abort_event ):
     """
     Upload an individual disk. Passes the file handle of the
     disk directly to the urlopen request.
+    If the tar index has the digests the manifest has, they are checked before the upload, and the
+    disk is sent straight from the OVA file ( with sendfile ), otherwise it is hashed as it is sent.
     """
     logging.info( 'OVAImportHandler: Uploading "{0}"...'.format( fileItem ) )
     file = self._get_disk( fileItem )
-    if file is None:
-        return
+    if abort_event.is_set():
+      return
 
     device = lease.get_device_url( fileItem )
     url = device.url.replace( '*', host )
-    headers = { 'Content-length': _get_tarfile_size( file ) }
-    if hasattr( ssl, '_create_unverified_context' ):
-      sslContext = ssl._create_unverified_context()
-    else:
-      sslContext = None
+    size = file.size
+    headers = { 'Content-length': size }
+    hasher = None
+    expected_map = self.manifest.get( fileItem.path, {} )
+    if not _check_digests( fileItem.path, expected_map, self.index[ fileItem.path ][ 'digest_map' ] ):
+      hasher = Hasher( fileItem.path, expected_map )
+      file = HashingReader( file, hasher )
+
+    opener = build_opener( None, unverified_context(), [ request.HTTPErrorProcessor() ] )
 
     try:
-      req = request.Request( url, data=file, headers=headers, method='POST' )
-      request.urlopen( req, context=sslContext )
+      with SCHEDULER.transfer( 'upload "{0}"'.format( fileItem.path ), host, size, job ) as transfer:
+        lease.add_transfer( transfer )
+        if abort_event.is_set():  # in case it was set before the transfer was added
+          transfer.cancel()
+
+        req = request.Request( url, data=file, headers=headers, method='POST' )
+        opener.open( req ).read()
+
+      if hasher is not None:
+        hasher.verify()  # raising here aborts the lease
 
     except Exception as e:
       logging.error( 'OVAImportHandler: Exception Uploading "{0}", lease info: "{1}": "{2}"'.format( e, lease.info, fileItem ) )
@@ -192,25 +275,42 @@ class OVAImportHandler():
 
   def upload( self, host, resource_pool, import_spec_result, datacenter ):
     """
-    Uploads all the disks, with a progress keep-alive.
+    Uploads all the disks, UPLOAD_WORKERS at a time, with a progress keep-alive.
 
     return uuid of vm
     """
-    lease = ImportLease( resource_pool.ImportVApp( spec=import_spec_result.importSpec, folder=datacenter.vmFolder ), self.handle )
+    total_size = 0
+    for fileItem in import_spec_result.fileItem:
+      try:
+        total_size += self.index[ fileItem.path ][ 'size' ]
+      except KeyError:
+        pass
+
+    lease = ImportLease( resource_pool.ImportVApp( spec=import_spec_result.importSpec, folder=datacenter.vmFolder ), total_size )
     lease.start_wait()
     uuid = lease.info.entity.config.instanceUuid
 
+    job = threading.get_ident()  # the disks are one job to the transfer scheduler
+    abort_event = threading.Event()
     try:
       lease.start()
       logging.debug( 'OVAImportHandler: Starting file upload(s)...' )
-      for fileItem in import_spec_result.fileItem:
-        self._upload_disk( fileItem, lease, host )
+      with ThreadPoolExecutor( max_workers=UPLOAD_WORKERS ) as executor:
+        future_list = [ executor.submit( self._upload_disk, fileItem, lease, host, job, abort_event ) for fileItem in import_spec_result.fileItem ]
+        wait( future_list, return_when=FIRST_EXCEPTION )
+        for future in future_list:
+          if future.done() and future.exception() is not None:
+            abort_event.set()  # stop the other uploads
+            lease.cancel_transfers()
+            raise future.exception()
 
       logging.debug( 'OVAImportHandler: File upload(s) complete' )
       lease.complete()
 
     except Exception as e:
       logging.error( 'OVAImportHandler: Exception uploading files' )
+      abort_event.set()
+      lease.cancel_transfers()
       lease.abort( vmodl.fault.SystemError( reason=str( e ) ) )
       raise e
 
@@ -220,69 +320,378 @@ class OVAImportHandler():
     return uuid
 
 
-class OVAExportHandler():
-  def __init__( self, ovf_manager, url, sslContext ):
-    super().__init__()
-    self.ovf_manager = ovf_manager
-    self.url = url
-    self.sslContext = sslContext
+class OVAStreamImportHandler():
+  """
+  Imports an OVA as it is downloaded, with out staging it on local disk.  The tar is read in order,
+  the .ovf ( and the .mf if it is next ) is read first, then each disk is sent to it's NFC url as it
+  goes by, one at a time, so the disks can be in any order.  The disks are hashed as they are sent, and
+  checked against the manifest, if the manifest comes after the disks, they are checked once it is read.
+  """
+  def __init__( self, ova_file, sslContext ):
+    self.handle = file_reader( ova_file, None, sslContext, stream=True, decompress=True )  # ie: .ova.gz
+    self.tarfile = None
+    self.manifest = None
+    self.pending = None  # member read while looking for the manifest
+    try:
+      self.tarfile = tarfile.open( fileobj=self.handle, mode='r|' )
+      member = self.tarfile.next()
+      if member is None or not member.name.endswith( '.ovf' ):
+        raise Exception( 'The .ovf must be the first file in the OVA to stream it' )
 
-  def _downloadFiles( self, wrk_dir, lease, host, header_map, proxy ):
-    ovf_files = []
+      self.ovf_filename = member.name
+      buff = self.tarfile.extractfile( member ).read()
+
+      member = self.tarfile.next()
+      if member is not None and member.name.endswith( '.mf' ):
+        self.manifest = _parse_manifest( self.tarfile.extractfile( member ).read().decode() )
+      else:
+        self.pending = member
+
+      hasher = Hasher( self.ovf_filename, ( self.manifest or {} ).get( self.ovf_filename, {} ), HASH_ALGORITHMS if self.manifest is None else None )
+      hasher.update( buff )
+      self.ovf_digest_map = hasher.verify()
+      self.descriptor = buff.decode()
+
+    except Exception:
+      self.close()
+      raise
+
+  def close( self ):
+    """
+    Stops the download, safe to call more than once.
+    """
+    if self.tarfile is not None:
+      self.tarfile.close()
+      self.tarfile = None
+
+    self.handle.close()
 
-    opener = request.OpenerDirector()
-    if proxy:  # not doing 'is not None', so empty strings don't try and proxy   # have a proxy option to take it from the envrionment vars
-      opener.add_handler( request.ProxyHandler( { 'http': proxy, 'https': proxy } ) )
+  def _next( self ):
+    if self.pending is not None:
+      member = self.pending
+      self.pending = None
+      return member
+
+    return self.tarfile.next()
+
+  def _upload_disk( self, member, fileItem, lease, host, job ):
+    """
+    Upload the disk member is for, returns the digests of it.
+    """
+    logging.info( 'OVAStreamImportHandler: Uploading "{0}"...'.format( fileItem ) )
+    device = lease.get_device_url( fileItem )
+    url = device.url.replace( '*', host )
+    headers = { 'Content-length': member.size }
+    if self.manifest is None:  # calculate everything the manifest could have
+      hasher = Hasher( member.name, None, HASH_ALGORITHMS )
     else:
-      opener.add_handler( request.ProxyHandler( {} ) )
-    opener.add_handler( request.HTTPHandler() )
-    if hasattr( http.client, 'HTTPSConnection' ):
-      opener.add_handler( request.HTTPSHandler() )  # context=self.sslContext
+      hasher = Hasher( member.name, self.manifest.get( member.name, {} ) )
 
-    opener.add_handler( request.UnknownHandler() )
+    opener = build_opener( None, unverified_context(), [ request.HTTPErrorProcessor() ] )
 
-    logging.debug( 'OVAExportHandler: Starting file downloads(s)...' )
-    for device in lease.info.deviceUrl:
-      url = device.url.replace( '*', host )
-      if not device.targetId:
-        logging.debug( 'ExportLease: No targetId for "{0}", skipping...'.format( url ) )
+    try:
+      with SCHEDULER.transfer( 'upload "{0}"'.format( member.name ), host, member.size, job ) as transfer:
+        lease.add_transfer( transfer )
+        req = request.Request( url, data=HashingReader( self.tarfile.extractfile( member ), hasher ), headers=headers, method='POST' )
+        opener.open( req ).read()
+
+      return hasher.verify()  # raising here aborts the lease
+
+    except Exception as e:
+      logging.error( 'OVAStreamImportHandler: Exception Uploading "{0}", lease info: "{1}": "{2}"'.format( e, lease.info, fileItem ) )
+      raise e
+
+  def upload( self, host, resource_pool, import_spec_result, datacenter ):
+    """
+    Uploads the disks as they come out of the OVA, with a progress keep-alive.
+
+    return uuid of vm
+    """
+    item_map = dict( ( fileItem.path, fileItem ) for fileItem in import_spec_result.fileItem )
+    total_size = sum( [ fileItem.size or 0 for fileItem in import_spec_result.fileItem ] )  # the sizes in the tar are not known till we get to them
+
+    lease = ImportLease( resource_pool.ImportVApp( spec=import_spec_result.importSpec, folder=datacenter.vmFolder ), total_size )
+    lease.start_wait()
+    uuid = lease.info.entity.config.instanceUuid
+
+    job = threading.get_ident()
+    try:
+      lease.start()
+      logging.debug( 'OVAStreamImportHandler: Starting file upload(s)...' )
+      digest_map = { self.ovf_filename: self.ovf_digest_map }
+      member = self._next()
+      while member is not None:
+        if member.name.endswith( '.mf' ) and self.manifest is None:
+          self.manifest = _parse_manifest( self.tarfile.extractfile( member ).read().decode() )
+
+        elif member.isreg() and member.name in item_map:
+          digest_map[ member.name ] = self._upload_disk( member, item_map.pop( member.name ), lease, host, job )
+
+        member = self._next()
+
+      if item_map:
+        raise Exception( 'Files "{0}" not found in the OVA'.format( '", "'.join( item_map.keys() ) ) )
+
+      for name, digests in digest_map.items():  # for when the manifest came after the disks
+        _check_digests( name, ( self.manifest or {} ).get( name, {} ), digests )
+
+      logging.debug( 'OVAStreamImportHandler: File upload(s) complete' )
+      lease.complete()
+
+    except Exception as e:
+      logging.error( 'OVAStreamImportHandler: Exception uploading files' )
+      lease.abort( vmodl.fault.SystemError( reason=str( e ) ) )
+      raise e
+
+    finally:
+      lease.stop()
+      self.close()
+
+    return uuid
+
+
+class _MemberReader():
+  """
+  Reads one file out of the OVA with os.pread, so the disk uploads can all read from
+  the same file handle at once without fighting over the file position.
+  fileno(), tell() and seek() are of the OVA file, so the upload can send the member with
+  sendfile straight from the OVA, with out it being copied through python.
+  """
+  def __init__( self, fd, offset, size ):
+    super().__init__()
+    self.fd = fd
+    self.offset = offset
+    self.size = size
+    self.pos = 0
+
+  def read( self, size=-1 ):
+    if size is None or size < 0 or size > self.size - self.pos:
+      size = self.size - self.pos
+
+    if not size:
+      return b''
+
+    buff = os.pread( self.fd, size, self.offset + self.pos )
+    if not buff:
+      raise Exception( 'OVA ended before the end of the disk' )
+
+    self.pos += len( buff )
+    return buff
+
+  def fileno( self ):
+    return self.fd
+
+  def tell( self ):
+    return self.offset + self.pos
+
+  def seek( self, offset, whence=0 ):
+    if whence != 0:
+      raise io.UnsupportedOperation( 'only absolute seeks are supported' )
+
+    self.pos = min( max( offset - self.offset, 0 ), self.size )
+    return self.offset + self.pos
+
+
+class _TarStream():
+  """
+  Read only, non seekable file like object of a tar, generated as it is read, so the tar is
+  never written out.  member_list is a list of ( name, bytes or path of the file, size ).
+  The headers are made up front, so the size of the tar ( len() ) is known before it is read.
+  """
+  def __init__( self, member_list ):
+    super().__init__()
+    self.member_list = member_list
+    self.header_list = []
+    self.size = tarfile.BLOCKSIZE * 2  # the end of archive
+    for name, _, size in member_list:
+      info = tarfile.TarInfo( name=name )
+      info.size = size
+      header = info.tobuf( tarfile.PAX_FORMAT, tarfile.ENCODING, 'surrogateescape' )  # pax for disks bigger than ustar can describe
+      self.header_list.append( header )
+      self.size += len( header ) + size + ( -size % tarfile.BLOCKSIZE )
+
+    self.name = None
+    self._parts = self._generate()
+    self._buff = b''
+    self._offset = 0
+    self._pos = 0
+    self.closed = False
+
+  def _generate( self ):
+    for ( name, source, size ), header in zip( self.member_list, self.header_list ):
+      yield header
+      if isinstance( source, bytes ):
+        yield source
+        count = len( source )
+
+      else:
+        count = 0
+        with open( source, 'rb' ) as fp:
+          buff = fp.read( TAR_STREAM_BLOCK_SIZE )
+          while buff:
+            count += len( buff )
+            yield buff
+            buff = fp.read( TAR_STREAM_BLOCK_SIZE )
+
+      if count != size:
+        raise Exception( '"{0}" is {1} bytes, expected {2}'.format( name, count, size ) )
+
+      remainder = size % tarfile.BLOCKSIZE
+      if remainder:
+        yield tarfile.NUL * ( tarfile.BLOCKSIZE - remainder )
+
+    yield tarfile.NUL * ( tarfile.BLOCKSIZE * 2 )  # end of archive
+
+  def read( self, size=-1 ):
+    if self.closed:
+      raise ValueError( 'read of closed stream' )
+
+    part_list = []
+    while size is None or size < 0 or size > 0:
+      if self._offset >= len( self._buff ):
+        try:
+          self._buff = next( self._parts )
+        except StopIteration:
+          break
+
+        self._offset = 0
         continue
 
-      logging.debug( 'OVAExportHandler: Downloading "{0}"...'.format( device.url ) )
+      if size is None or size < 0:
+        part = self._buff[ self._offset: ]
+      else:
+        part = self._buff[ self._offset:self._offset + size ]
+        size -= len( part )
+
+      self._offset += len( part )
+      part_list.append( part )
+
+    result = b''.join( part_list )
+    self._pos += len( result )
+    return result
+
+  def __len__( self ):
+    return self.size
+
+  def readable( self ):
+    return True
+
+  def seekable( self ):
+    return False
+
+  def tell( self ):
+    return self._pos
+
+  def close( self ):
+    self.closed = True
+    self._parts.close()
+
+
+class OVAExportHandler():
+  """
+  Exports a VM to packrat as an OVA.  The disks are downloaded DOWNLOAD_WORKERS at a time, hashed as they
+  come in, into a work directory, which is the only time they touch local disk.  The OVA is then
+  generated as it is uploaded, .ovf and .mf first, then the disks straight out of the work directory.
+  if stream_optimize is True, flat and sparse disks are converted to streamOptimized ( see vmdk.py ), flat disks
+  with a known size are converted as they download, others once they are downloaded.
+  """
+  def __init__( self, ovf_manager, url, sslContext, stream_optimize=False ):
+    super().__init__()
+    self.ovf_manager = ovf_manager
+    self.url = url
+    self.sslContext = sslContext
+    self.stream_optimize = stream_optimize
+
+  def _downloadFile( self, wrk_dir, device, lease, host, header_map, opener, job ):
+    """
+    Download one disk, returns ( OvfFile, sha256 hex digest ).
+    """
+    url = device.url.replace( '*', host )
+    path = os.path.join( wrk_dir, device.targetId )
+    logging.debug( 'OVAExportHandler: Downloading "{0}"...'.format( device.url ) )
+    file_hash = hashlib.sha256()
+    writer = None
+    with SCHEDULER.transfer( 'download "{0}"'.format( device.targetId ), host, None, job ) as transfer:  # progress is reported by the transfer
+      lease.add_transfer( transfer )
       req = request.Request( url, headers=header_map, method='GET' )
       resp = opener.open( req, timeout=DOWNLOAD_FILE_TIMEOUT )
       try:
-        content_length = int( resp.headers[ 'content-length' ] )
-      except TypeError:  # ESX dosen't supply contect-length?
-        content_length = '<unknwon>'
+        transfer.total = int( resp.headers[ 'content-length' ] )
+      except ( TypeError, ValueError ):  # ESX dosen't supply contect-length?
+        pass
 
-      file_hash = hashlib.sha256()
-      local_file = open( os.path.join( wrk_dir, device.targetId ), 'wb' )
       buff = resp.read( 4096 * 1024 )
-      cp = datetime.utcnow()
-      while buff:
-        if datetime.utcnow() > cp:
-          cp = datetime.utcnow() + timedelta( seconds=PROGRESS_INTERVAL )
-          logging.debug( 'OVAExportHandler: download at {0} of {1}'.format( local_file.tell(), content_length ) )
+      kind = None
+      if self.stream_optimize and device.targetId.endswith( '.vmdk' ):
+        kind = disk_type( buff )
+        if kind == 'streamOptimized':
+          kind = None
 
-        local_file.write( buff )
-        file_hash.update( buff )
-        buff = resp.read( 4096 * 1024 )
+      live = kind == 'flat' and transfer.total is not None  # convert as it comes in
+      with open( path + '.raw' if kind is not None and not live else path, 'wb' ) as local_file:
+        if live:
+          writer = StreamOptimizedWriter( local_file, transfer.total, device.targetId )
+          while buff:
+            writer.write( buff )
+            transfer.update( len( buff ) )
+            buff = resp.read( 4096 * 1024 )
 
-      ovf_file = vim.OvfManager.OvfFile()
-      ovf_file.deviceId = device.key
-      ovf_file.path = device.targetId
-      ovf_file.size = local_file.tell()
-      ovf_files.append( ( ovf_file, file_hash.hexdigest() ) )
+          writer.close()
 
-      local_file.close()
+        else:
+          while buff:
+            local_file.write( buff )
+            file_hash.update( buff )
+            transfer.update( len( buff ) )
+            buff = resp.read( 4096 * 1024 )
 
-    return ovf_files
+    if kind is not None and not live:  # the image has to be seekable to convert
+      with open( path, 'wb' ) as local_file:
+        writer = convert_file( path + '.raw', local_file, device.targetId )
+
+      os.unlink( path + '.raw' )
+
+    if writer is not None:
+      file_hash = writer.hash
+
+    size = os.stat( path ).st_size
+
+    ovf_file = vim.OvfManager.OvfFile()
+    ovf_file.deviceId = device.key
+    ovf_file.path = device.targetId
+    ovf_file.size = size
+
+    return ( ovf_file, file_hash.hexdigest() )
+
+  def _downloadFiles( self, wrk_dir, lease, host, header_map, proxy ):
+    opener = build_opener( proxy )  # context=self.sslContext
+
+    device_list = []
+    for device in lease.info.deviceUrl:
+      if not device.targetId:
+        logging.debug( 'ExportLease: No targetId for "{0}", skipping...'.format( device.url ) )
+        continue
+
+      device_list.append( device )
+
+    logging.debug( 'OVAExportHandler: Starting file downloads(s)...' )
+    job = threading.get_ident()  # the disks are one job to the transfer scheduler
+    with ThreadPoolExecutor( max_workers=DOWNLOAD_WORKERS ) as executor:
+      future_list = [ executor.submit( self._downloadFile, wrk_dir, device, lease, host, header_map, opener, job ) for device in device_list ]
+      wait( future_list, return_when=FIRST_EXCEPTION )
+      for future in future_list:
+        if future.done() and future.exception() is not None:
+          lease.cancel_transfers()  # stop the other downloads
+          for other in future_list:
+            other.cancel()
+
+          raise future.exception()
+
+      return [ future.result() for future in future_list ]
 
   def export( self, host, vm, vm_name ):
     headers = {}
     proxy = None
-    ova_file = tempfile.NamedTemporaryFile( mode='w+b', dir='/tmp', prefix='subcontractor_vcenter_' )
     wrk_dir = tempfile.TemporaryDirectory( prefix='subcontractor_vcenter_', dir='/tmp' )
     try:
       nfc_lease = vm.ExportVm()
@@ -318,37 +727,29 @@ class OVAExportHandler():
         msg = '"{0}"'.format( '", "'.join( [ i.fault for i in ovf_descriptor.warning ] ) )
         logging.warning( 'vcenter: warning creating ovf descriptor ' + msg )
 
-      ova_tarfile = tarfile.open( fileobj=ova_file, mode='w' )
-      ovf_file = tarfile.TarInfo( name='{0}.ovf'.format( vm_name ) )
-      bytes = ovf_descriptor.ovfDescriptor.encode( 'utf-8' )
-      ovf_file.size = len( bytes )
-      ova_tarfile.addfile( ovf_file, fileobj=io.BytesIO( bytes ) )
-      ovf_hash = hashlib.sha256( bytes ).hexdigest()
+      ovf_buff = ovf_descriptor.ovfDescriptor.encode( 'utf-8' )
+      ovf_hash = hashlib.sha256( ovf_buff ).hexdigest()
 
       logging.debug( 'OVAExportHandler: Generating mf...' )
       mf = 'SHA256({0}.ovf)={1}\n'.format( vm_name, ovf_hash )
       for item, hash in ovf_file_list:
         mf += 'SHA256({0})={1}\n'.format( item.path, hash )
-      mf_file = tarfile.TarInfo( name='{0}.mf'.format( vm_name ) )
-      bytes = mf.encode( 'utf-8' )
-      mf_file.size = len( bytes )
-      ova_tarfile.addfile( mf_file, fileobj=io.BytesIO( bytes ) )
+      mf_buff = mf.encode( 'utf-8' )
 
+      member_list = [ ( '{0}.ovf'.format( vm_name ), ovf_buff, len( ovf_buff ) ), ( '{0}.mf'.format( vm_name ), mf_buff, len( mf_buff ) ) ]
       for item, _ in ovf_file_list:
-        logging.debug( 'OVAExportHandler: adding "{0}"...'.format( item.path ) )
-        item_file = tarfile.TarInfo( name=item.path )
-        item_file.size = item.size
-        ova_tarfile.addfile( item_file, fileobj=open( os.path.join( wrk_dir.name, item.path ), 'rb' ) )
-      ova_tarfile.close()
+        member_list.append( ( item.path, os.path.join( wrk_dir.name, item.path ), item.size ) )
+
+      logging.debug( 'OVAExportHandler: Uploading OVA...' )
+      ova_file = _TarStream( member_list )
+      try:
+        file_writer( self.url, ova_file, '{0}.ova'.format( vm_name ), None, self.sslContext )
+      finally:
+        ova_file.close()
 
     finally:
       wrk_dir.cleanup()
 
-    ova_file.flush()
-    ova_file.seek( 0 )
-    file_writer( self.url, ova_file, '{0}.ova'.format( vm_name ), None, self.sslContext )
-    ova_file.close()
-
     return 'http://somplace/somepath/{0}.ova'.format( vm_name )
 
 
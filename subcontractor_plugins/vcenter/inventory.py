@@ -0,0 +1,390 @@
+import time
+import logging
+import threading
+
+from pyVmomi import vim, vmodl
+
+from subcontractor_plugins.common.transfer import PROGRESS
+from subcontractor_plugins.vcenter.session import VCENTER_SESSIONS, session_key
+
+INVENTORY_PAGE_SIZE = 1000  # max number of objects per RetrievePropertiesEx/ContinueRetrievePropertiesEx page
+INVENTORY_CACHE_ENABLED = True  # keep an InventoryCache per vCenter, set to False to allways fetch the inventory for each call
+INVENTORY_WAIT_TIMEOUT = 30  # in seconds, max time WaitForUpdatesEx waits for changes before returning with nothing
+INVENTORY_MAX_STALENESS = 90  # in seconds, if the cache has not heard from vCenter in this long, lookups go to vCenter directly
+INVENTORY_RETRY_INTERVAL = 30  # in seconds, how long to wait before reconnecting the cache after an error
+INVENTORY_IDLE_TIMEOUT = 3600  # in seconds, caches not used for this long are stopped
+INVENTORY_STATS_INTERVAL = 600  # in seconds, how often the stats of the caches are logged, None to not log them
+
+# the properties pulled for each type of managed object, the lookups in lib.py are answered from these
+INVENTORY_PROPERTY_MAP = {
+                           vim.Folder: [ 'name', 'parent' ],
+                           vim.Datacenter: [ 'name', 'parent', 'datastore' ],
+                           vim.ComputeResource: [ 'name', 'parent', 'resourcePool', 'host' ],  # also covers ClusterComputeResource
+                           vim.ResourcePool: [ 'name', 'parent', 'owner' ],
+                           vim.HostSystem: [ 'name', 'parent', 'datastore', 'network',
+                                             'summary.hardware.memorySize', 'summary.hardware.numCpuCores', 'summary.hardware.cpuMhz',
+                                             'summary.quickStats.overallMemoryUsage', 'summary.quickStats.overallCpuUsage' ],
+                           vim.Datastore: [ 'name', 'parent', 'summary.freeSpace' ],
+                           vim.Network: [ 'name', 'parent' ]  # also covers DistributedVirtualPortgroup
+                         }
+
+# the cache also keeps the vms, so they can be found by uuid
+INVENTORY_CACHE_PROPERTY_MAP = dict( INVENTORY_PROPERTY_MAP )
+INVENTORY_CACHE_PROPERTY_MAP[ vim.VirtualMachine ] = [ 'name', 'parent', 'config.instanceUuid' ]
+
+
+def _filter_spec( view, property_map ):
+  traversal = vmodl.query.PropertyCollector.TraversalSpec( name='traverseView', path='view', skip=False, type=vim.view.ContainerView )
+  object_spec = vmodl.query.PropertyCollector.ObjectSpec( obj=view, skip=True, selectSet=[ traversal ] )
+  property_list = [ vmodl.query.PropertyCollector.PropertySpec( type=type, pathSet=path_list ) for type, path_list in property_map.items() ]
+
+  return vmodl.query.PropertyCollector.FilterSpec( objectSet=[ object_spec ], propSet=property_list )
+
+
+def retrieve_properties( si, property_map, container=None ):
+  """
+  Returns { managed object: { property path: value } } for all the managed objects of the types in property_map
+  under container ( default is the root folder ), with one RetrievePropertiesEx and as many ContinueRetrievePropertiesEx
+  as it takes to page through them, instead of a round trip for each property of each object.
+  Unset properties are left out of the object's map.
+  """
+  content = si.content
+  if container is None:
+    container = content.rootFolder
+
+  view = content.viewManager.CreateContainerView( container, list( property_map.keys() ), True )
+  try:
+    collector = content.propertyCollector
+    result = collector.RetrievePropertiesEx( [ _filter_spec( view, property_map ) ], vmodl.query.PropertyCollector.RetrieveOptions( maxObjects=INVENTORY_PAGE_SIZE ) )
+
+    object_map = {}
+    while result is not None:
+      for item in result.objects:
+        object_map[ item.obj ] = dict( ( prop.name, prop.val ) for prop in item.propSet )
+
+      if not result.token:
+        break
+
+      result = collector.ContinueRetrievePropertiesEx( result.token )
+
+    return object_map
+
+  finally:
+    view.Destroy()
+
+
+class InventoryCache():
+  """
+  The inventory of one vCenter, kept in memory and up to date by a background thread that follows the changes with
+  WaitForUpdatesEx, on a PropertyCollector and session of it's own.  The maps are replaced, not changed, when updates come in,
+  so readers can use them with out locking.
+  """
+  def __init__( self, connection_paramaters ):
+    super().__init__()
+    self.connection_paramaters = connection_paramaters
+    self.object_map = {}  # managed object -> { property path: value }
+    self.uuid_map = {}  # vm instance uuid -> vm
+    self.ready = False
+    self.version = None
+    self.updated = None  # monotonic time vCenter was last heard from
+    self.last_used = time.monotonic()
+    self.update_count = 0
+    self.error_count = 0
+    self.last_error = None
+    self.hit_count = 0
+    self.fallback_count = 0
+    self.stop_event = threading.Event()
+    self.thread = None
+
+  def start( self ):
+    self.stop_event.clear()
+    self.thread = threading.Thread( target=self.run, name='vcenter inventory "{0}"'.format( self.connection_paramaters[ 'host' ] ), daemon=True )
+    self.thread.start()
+
+  def stop( self ):
+    self.stop_event.set()
+
+  def running( self ):
+    return self.thread is not None and self.thread.is_alive()
+
+  def staleness( self ):
+    """
+    Returns how many seconds since vCenter was last heard from, or None if the cache has never been loaded.
+    """
+    if self.updated is None:
+      return None
+
+    return time.monotonic() - self.updated
+
+  def usable( self ):
+    """
+    Returns True if the cache is loaded and fresh enough to answer from, counts the hit or fallback for stats().
+    """
+    self.last_used = time.monotonic()
+    staleness = self.staleness()
+    if self.ready and staleness is not None and staleness < INVENTORY_MAX_STALENESS:
+      self.hit_count += 1
+      return True
+
+    self.fallback_count += 1
+    return False
+
+  def stats( self ):
+    return {
+             'ready': self.ready,
+             'staleness': self.staleness(),
+             'version': self.version,
+             'object_count': len( self.object_map ),
+             'update_count': self.update_count,
+             'error_count': self.error_count,
+             'last_error': self.last_error,
+             'hit_count': self.hit_count,
+             'fallback_count': self.fallback_count
+           }
+
+  def run( self ):
+    while not self.stop_event.is_set():
+      try:
+        with VCENTER_SESSIONS.session( self.connection_paramaters ) as si:
+          self._follow( si )
+
+      except Exception as e:
+        self.error_count += 1
+        self.last_error = str( e )
+        logging.warning( 'vcenter: inventory cache for "{0}" got exception: "{1}", retrying in {2} seconds'.format( self.connection_paramaters[ 'host' ], e, INVENTORY_RETRY_INTERVAL ) )
+        self.stop_event.wait( INVENTORY_RETRY_INTERVAL )
+
+  def _follow( self, si ):
+    content = si.content
+    collector = content.propertyCollector.CreatePropertyCollector()  # our own, so the filter does not show up for anyone else
+    try:
+      view = content.viewManager.CreateContainerView( content.rootFolder, list( INVENTORY_CACHE_PROPERTY_MAP.keys() ), True )
+      try:
+        collector.CreateFilter( _filter_spec( view, INVENTORY_CACHE_PROPERTY_MAP ), False )  # not partial, so changes come back as the whole property in the pathSet
+        options = vmodl.query.PropertyCollector.WaitOptions( maxWaitSeconds=INVENTORY_WAIT_TIMEOUT )
+        version = ''
+        object_map = {}  # the initial load is collected here, so the old maps are used until it is complete
+        uuid_map = {}
+        while not self.stop_event.is_set():
+          if time.monotonic() - self.last_used > INVENTORY_IDLE_TIMEOUT:
+            logging.debug( 'vcenter: inventory cache for "{0}" is idle, stopping'.format( self.connection_paramaters[ 'host' ] ) )
+            self.stop_event.set()
+            return
+
+          update_set = collector.WaitForUpdatesEx( version, options )
+          if update_set is not None:
+            if object_map is None:
+              object_map = dict( self.object_map )
+              uuid_map = dict( self.uuid_map )
+
+            _apply_updates( object_map, uuid_map, update_set )
+            version = update_set.version
+            self.update_count += 1
+            if update_set.truncated:  # more is waiting
+              continue
+
+            self.object_map = object_map
+            self.uuid_map = uuid_map
+            self.version = version
+            object_map = None
+            uuid_map = None
+
+          if not self.ready:
+            logging.debug( 'vcenter: inventory cache for "{0}" loaded, {1} objects'.format( self.connection_paramaters[ 'host' ], len( self.object_map ) ) )
+
+          self.ready = True
+          self.updated = time.monotonic()
+
+      finally:
+        view.Destroy()
+
+    finally:
+      collector.DestroyPropertyCollector()
+
+
+def _apply_updates( object_map, uuid_map, update_set ):
+  for filter_update in update_set.filterSet:
+    for object_update in filter_update.objectSet:
+      mob = object_update.obj
+      uuid = object_map.get( mob, {} ).get( 'config.instanceUuid' )
+      if uuid is not None and uuid_map.get( uuid ) == mob:
+        del uuid_map[ uuid ]
+
+      if object_update.kind == 'leave':
+        object_map.pop( mob, None )
+        continue
+
+      property_map = dict( object_map.get( mob, {} ) )  # copy, someone may be reading the old one
+      for change in object_update.changeSet:
+        if change.op == 'assign':
+          property_map[ change.name ] = change.val
+        else:  # remove, indirectRemove
+          property_map.pop( change.name, None )
+
+      object_map[ mob ] = property_map
+      uuid = property_map.get( 'config.instanceUuid' )
+      if uuid is not None:
+        uuid_map[ uuid ] = mob
+
+
+class InventoryCachePool():
+  """
+  The InventoryCaches, by host and username/token, started the first time a vCenter is asked for
+  and stopped after they have not been used for INVENTORY_IDLE_TIMEOUT.  The stats of the running
+  caches are logged every INVENTORY_STATS_INTERVAL.
+  """
+  def __init__( self ):
+    super().__init__()
+    self.lock = threading.Lock()
+    self.cache_map = {}
+    self.stats_handle = None
+
+  def get( self, connection_paramaters ):
+    """
+    Returns the InventoryCache for connection_paramaters, or None if caching is disabled.
+    """
+    if not INVENTORY_CACHE_ENABLED:
+      return None
+
+    key, _ = session_key( connection_paramaters )
+    with self.lock:
+      cache = self.cache_map.get( key )
+      if cache is None or not cache.running():
+        cache = InventoryCache( connection_paramaters )
+        cache.start()
+        self.cache_map[ key ] = cache
+
+      if self.stats_handle is None and INVENTORY_STATS_INTERVAL:
+        self.stats_handle = PROGRESS.register( self._log_stats, INVENTORY_STATS_INTERVAL )
+
+    return cache
+
+  def stats( self ):
+    """
+    Returns { ( host, username/token ): stats } of the caches.
+    """
+    with self.lock:
+      return dict( ( key, cache.stats() ) for key, cache in self.cache_map.items() )
+
+  def _log_stats( self ):
+    with self.lock:
+      cache_list = [ ( key, cache ) for key, cache in self.cache_map.items() if cache.running() ]
+
+    for ( host, username ), cache in cache_list:
+      stats = cache.stats()
+      logging.info( 'vcenter: inventory cache for "{0}" as "{1}": ready: {2}, staleness: {3}, objects: {4}, updates: {5}, hits: {6}, fallbacks: {7}, errors: {8}, last error: "{9}"'.format(
+                    host, username, stats[ 'ready' ], stats[ 'staleness' ], stats[ 'object_count' ], stats[ 'update_count' ],
+                    stats[ 'hit_count' ], stats[ 'fallback_count' ], stats[ 'error_count' ], stats[ 'last_error' ] ) )
+
+
+INVENTORY_CACHES = InventoryCachePool()
+
+
+class Inventory():
+  """
+  The names, parents and summary fields of the vCenter inventory.  If cache ( an InventoryCache ) is fresh
+  enough, lookups are answered from it, otherwise the inventory is fetched in bulk the first time something
+  is looked up, and then answered from memory.  Anything not found in the cache is looked up again directly,
+  in case it is newer than the cache.
+  """
+  def __init__( self, si, cache=None ):
+    super().__init__()
+    self.si = si
+    self.cache = cache if cache is not None and cache.usable() else None
+    self.object_map = None
+
+  def _objects( self ):
+    if self.cache is not None:
+      return self.cache.object_map
+
+    if self.object_map is None:
+      self.object_map = retrieve_properties( self.si, INVENTORY_PROPERTY_MAP )
+
+    return self.object_map
+
+  def _miss( self ):
+    """
+    Stop using the cache for this Inventory, returns True if it was being used.
+    """
+    if self.cache is None:
+      return False
+
+    logging.debug( 'vcenter: inventory cache miss, going to vCenter' )
+    self.cache.fallback_count += 1
+    self.cache = None
+    return True
+
+  def _bind( self, value ):
+    """
+    Managed objects from the cache belong to the cache's session, return them bound to ours.
+    """
+    if self.cache is None:
+      return value
+
+    if isinstance( value, vmodl.ManagedObject ):
+      return value.__class__( value._moId, self.si._stub )
+
+    if isinstance( value, list ):
+      return [ self._bind( item ) for item in value ]
+
+    return value
+
+  def get( self, mob, path, default=None ):
+    """
+    Returns property path of mob, or default if it is unset or mob is not in the inventory.
+    """
+    property_map = self._objects().get( mob )
+    if property_map is None and self._miss():
+      property_map = self._objects().get( mob )
+
+    if property_map is None or path not in property_map:
+      return default
+
+    return self._bind( property_map[ path ] )
+
+  def name( self, mob ):
+    return self.get( mob, 'name' )
+
+  def member( self, mob, path, name ):
+    """
+    Returns the managed object named name in the list property path of mob ( ie: the hosts of a cluster ), or None.
+    If it is not in the cache's list, it is looked for again directly, in case the list is behind vCenter.
+    """
+    for item in self.get( mob, path, [] ):
+      if self.name( item ) == name:
+        return item
+
+    if self._miss():
+      return self.member( mob, path, name )
+
+    return None
+
+  def find( self, type, name ):
+    """
+    Returns the list of managed objects of type ( or a sub type ) named name.
+    """
+    result = [ mob for mob, property_map in self._objects().items() if isinstance( mob, type ) and property_map.get( 'name' ) == name ]
+    if not result and self._miss():
+      return self.find( type, name )
+
+    return self._bind( result )
+
+  def datacenter( self, mob ):
+    """
+    Returns the Datacenter mob is in, or None.
+    """
+    while mob is not None and not isinstance( mob, vim.Datacenter ):
+      mob = self.get( mob, 'parent' )
+
+    return mob
+
+  def vm( self, uuid ):
+    """
+    Returns the vm with instance uuid, or None.
+    """
+    if self.cache is not None:
+      vm = self.cache.uuid_map.get( uuid )
+      if vm is not None:
+        return self._bind( vm )
+
+    return self.si.content.searchIndex.FindByUuid( None, uuid, True, True )
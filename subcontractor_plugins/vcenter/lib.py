@@ -5,11 +5,12 @@ import random
 import ssl
 from datetime import datetime, timedelta
 
-from pyVim import connect
 from pyVmomi import vim
 
-from subcontractor.credentials import getCredentials
-from subcontractor_plugins.vcenter.images import OVAImportHandler, OVAExportHandler
+from subcontractor_plugins.vcenter.session import VCENTER_SESSIONS, current_session
+from subcontractor_plugins.vcenter.tasks import TASK_WAITERS
+from subcontractor_plugins.vcenter.inventory import INVENTORY_CACHES, Inventory, retrieve_properties
+from subcontractor_plugins.vcenter.images import OVAImportHandler, OVAStreamImportHandler, OVAExportHandler
 
 POLL_INTERVAL = 4
 BOOT_ORDER_MAP = {
@@ -32,33 +33,22 @@ class MOBNotFound( Exception ):
   pass
 
 
-def _connect( connection_paramaters ):
-  # work arround invalid SSL
-  _create_unverified_https_context = ssl._create_unverified_context
-  ssl._create_default_https_context = _create_unverified_https_context
-  # TODO: flag for trusting SSL of connection, also there is a paramater to Connect for verified SSL
+def _session( connection_paramaters ):
+  return VCENTER_SESSIONS.session( connection_paramaters )
 
-  creds = connection_paramaters[ 'credentials' ]
-  if isinstance( creds, str ):
-    creds = getCredentials( creds )
 
-  # TODO: saninity check on creds
-
-  if 'username' in creds:
-    logging.debug( 'vcenter: connecting to "{0}" with user "{1}"'.format( connection_paramaters[ 'host' ], creds[ 'username' ] ) )
-    return connect.SmartConnect( host=connection_paramaters[ 'host' ], user=creds[ 'username' ], pwd=creds[ 'password' ], mechanism='userpass' )
-
-  else:
-    logging.debug( 'vcenter: connecting to "{0}" with token "{1}"'.format( connection_paramaters[ 'host' ], creds[ 'token' ] ) )
-    return connect.SmartConnect( host=connection_paramaters[ 'host' ], b64token=creds[ 'token' ], mechanism='sspi' )
-
-
-def _disconnect( si ):
-  connect.Disconnect( si )
+def _inventory( si, connection_paramaters ):
+  return Inventory( si, INVENTORY_CACHES.get( connection_paramaters ) )
 
 
 def _taskWait( task ):
-  while True:
+  connection_paramaters = current_session()
+  if connection_paramaters is not None:
+    waiter = TASK_WAITERS.get( connection_paramaters )
+    if waiter is not None and waiter.wait( task ):
+      return
+
+  while True:  # poll it
     if task.info.state not in ( 'running', 'queued' ):
       return
 
@@ -75,52 +65,51 @@ def _taskWait( task ):
     time.sleep( POLL_INTERVAL )
 
 
-def _getDatacenter( si, name ):
-  for item in si.content.rootFolder.childEntity:
-    if item.__class__.__name__ == 'vim.Datacenter' and item.name == name:
-      return item
+def _getDatacenter( inventory, name ):
+  for item in inventory.find( vim.Datacenter, name ):
+    return item
 
   raise MOBNotFound( 'Datacenter "{0}" not found'.format( name ) )
 
 
-def _getResourcePool( dc, name ):  # TODO: recursive folder search
-  for item in dc.hostFolder.childEntity:
-    if item.__class__.__name__ in ( 'vim.ComputeResource', 'vim.ClusterComputeResource' ) and item.name == name:
-      return item.resourcePool
+def _getResourcePool( inventory, dc, name ):
+  for item in inventory.find( vim.ComputeResource, name ):  # also ClusterComputeResource
+    if inventory.datacenter( item ) == dc:
+      return inventory.get( item, 'resourcePool' )
 
-    if item.__class__.__name__ in ( 'vim.ResourcePool', ) and item.name == name:
+  for item in inventory.find( vim.ResourcePool, name ):
+    if inventory.datacenter( item ) == dc:
       return item
 
   raise MOBNotFound( 'Cluster/ResourcePool "{0}" not found'.format( name ) )
 
 
-def _getHost( rp, name ):
-  for host in rp.owner.host:
-    if host.name == name:
-      return host
+def _getHost( inventory, rp, name ):
+  host = inventory.member( inventory.get( rp, 'owner' ), 'host', name )
+  if host is not None:
+    return host
 
-  raise MOBNotFound( 'Host "{0}" in "{1}" not found'.format( name, rp.name ) )
+  raise MOBNotFound( 'Host "{0}" in "{1}" not found'.format( name, inventory.name( rp ) ) )
 
 
-def _getDatastore( dc, name ):
-  for ds in dc.datastore:
-    if ds.name == name:
-      return ds
+def _getDatastore( inventory, dc, name ):
+  ds = inventory.member( dc, 'datastore', name )
+  if ds is not None:
+    return ds
 
-  raise MOBNotFound( 'Datastore "{0}" in "{1}" not found'.format( name, dc.name ) )
+  raise MOBNotFound( 'Datastore "{0}" in "{1}" not found'.format( name, inventory.name( dc ) ) )
 
 
-def _getNetwork( host, name ):
-  for network in host.network:
-    if network.name == name:
-      return network
+def _getNetwork( inventory, host, name ):
+  network = inventory.member( host, 'network', name )
+  if network is not None:
+    return network
 
-  raise MOBNotFound( 'Network "{0}" in "{1}" not found'.format( name, host.name ) )
+  raise MOBNotFound( 'Network "{0}" in "{1}" not found'.format( name, inventory.name( host ) ) )
 
 
-def _getVM( si, vm_uuid ):
-  cont = si.RetrieveContent()
-  vm = cont.searchIndex.FindByUuid( None, vm_uuid, True, True )
+def _getVM( inventory, vm_uuid ):
+  vm = inventory.vm( vm_uuid )
 
   if vm is None:
     raise MOBNotFound( 'vcenter: unable to find vm "{0}"'.format( vm_uuid ) )
@@ -160,26 +149,28 @@ def host_list( paramaters ):
   # orderd by paramater[ 'cpu_scaler' ] * %cpu remaning + paramater[ 'memory_scaler' ] * %mem remaning
   connection_paramaters = paramaters[ 'connection' ]
   logging.info( 'vcenter: getting Host List for dc: "{0}"  rp: "{1}"'.format( paramaters[ 'datacenter' ], paramaters[ 'cluster' ] ) )
-  si = _connect( connection_paramaters )
-  try:
-    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ] )
-    resourcePool = _getResourcePool( dataCenter, paramaters[ 'cluster' ] )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    dataCenter = _getDatacenter( inventory, paramaters[ 'datacenter' ] )
+    resourcePool = _getResourcePool( inventory, dataCenter, paramaters[ 'cluster' ] )
 
     host_map = {}
-    for host in resourcePool.owner.host:
-      if host.summary.quickStats.overallMemoryUsage is None:  # sometimes the quickstats don't get updated, for now skip that host
+    for host in inventory.get( inventory.get( resourcePool, 'owner' ), 'host', [] ):
+      name = inventory.name( host )
+      memory_usage = inventory.get( host, 'summary.quickStats.overallMemoryUsage' )
+      if memory_usage is None:  # sometimes the quickstats don't get updated, for now skip that host
         continue
 
-      total_memory = host.summary.hardware.memorySize / 1024.0 / 1024.0  # we want MiB
-      memory_aviable = total_memory - host.summary.quickStats.overallMemoryUsage
+      total_memory = inventory.get( host, 'summary.hardware.memorySize' ) / 1024.0 / 1024.0  # we want MiB
+      memory_aviable = total_memory - memory_usage
       if memory_aviable < paramaters[ 'min_memory' ]:
-        logging.debug( 'vcenter: host "{0}", low aviable ram: "{1}"'.format( host.name, memory_aviable ) )
+        logging.debug( 'vcenter: host "{0}", low aviable ram: "{1}"'.format( name, memory_aviable ) )
         continue
 
-      total_cpu = host.summary.hardware.numCpuCores * host.summary.hardware.cpuMhz
-      cpu_aviable = total_cpu - host.summary.quickStats.overallCpuUsage
+      total_cpu = inventory.get( host, 'summary.hardware.numCpuCores' ) * inventory.get( host, 'summary.hardware.cpuMhz' )
+      cpu_aviable = total_cpu - inventory.get( host, 'summary.quickStats.overallCpuUsage', 0 )
 
-      host_map[ host.name ] = ( paramaters[ 'memory_scaler' ] * ( memory_aviable / total_memory ) ) + ( paramaters[ 'cpu_scaler' ] * ( cpu_aviable / total_cpu ) )
+      host_map[ name ] = ( paramaters[ 'memory_scaler' ] * ( memory_aviable / total_memory ) ) + ( paramaters[ 'cpu_scaler' ] * ( cpu_aviable / total_cpu ) )
 
     logging.debug( 'vcenter: host_map {0}'.format( host_map ) )
 
@@ -188,18 +179,15 @@ def host_list( paramaters ):
 
     return { 'host_list': result }
 
-  finally:
-    _disconnect( si )
-
 
 def create_datastore( paramaters ):
   connection_paramaters = paramaters[ 'connection' ]
   logging.info( 'vcenter: creating datastores: "{0}"'.format( paramaters[ 'name' ] ) )
-  si = _connect( connection_paramaters )
-  try:
-    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ] )
-    resourcePool = _getResourcePool( dataCenter, paramaters[ 'host' ] )
-    host = _getHost( resourcePool, paramaters[ 'host' ] )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    dataCenter = _getDatacenter( inventory, paramaters[ 'datacenter' ] )
+    resourcePool = _getResourcePool( inventory, dataCenter, paramaters[ 'host' ] )
+    host = _getHost( inventory, resourcePool, paramaters[ 'host' ] )
 
     dss = host.configManager.datastoreSystem
     ss = host.configManager.storageSystem
@@ -225,9 +213,6 @@ def create_datastore( paramaters ):
 
     return { 'done': True }
 
-  finally:
-    _disconnect( si )
-
 
 def datastore_list( paramaters ):
   connection_paramaters = paramaters[ 'connection' ]
@@ -241,27 +226,25 @@ def datastore_list( paramaters ):
   else:
     paramaters[ 'name_regex' ] = None
 
-  si = _connect( connection_paramaters )
-  try:
-    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ] )
-    resourcePool = _getResourcePool( dataCenter, paramaters[ 'cluster' ] )
-    host = _getHost( resourcePool, paramaters[ 'host' ] )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    dataCenter = _getDatacenter( inventory, paramaters[ 'datacenter' ] )
+    resourcePool = _getResourcePool( inventory, dataCenter, paramaters[ 'cluster' ] )
+    host = _getHost( inventory, resourcePool, paramaters[ 'host' ] )
 
     result = []
-    for datastore in host.datastore:
-      if datastore.summary.freeSpace / 1024.0 / 1024.0 / 1024.0 < paramaters[ 'min_free_space' ]:
+    for datastore in inventory.get( host, 'datastore', [] ):
+      name = inventory.name( datastore )
+      if inventory.get( datastore, 'summary.freeSpace', 0 ) / 1024.0 / 1024.0 / 1024.0 < paramaters[ 'min_free_space' ]:
         continue
 
-      if paramaters[ 'name_regex' ] is not None and not paramaters[ 'name_regex' ].match( datastore.name ):
+      if paramaters[ 'name_regex' ] is not None and not paramaters[ 'name_regex' ].match( name ):
         continue
 
-      result.append( datastore.name )
+      result.append( name )
 
     return { 'datastore_list': result }
 
-  finally:
-    _disconnect( si )
-
 
 def network_list( paramaters ):
   connection_paramaters = paramaters[ 'connection' ]
@@ -272,24 +255,22 @@ def network_list( paramaters ):
   except TypeError:
     pass
 
-  si = _connect( connection_paramaters )
-  try:
-    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ] )
-    resourcePool = _getResourcePool( dataCenter, paramaters[ 'cluster' ] )
-    host = _getHost( resourcePool, paramaters[ 'host' ] )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    dataCenter = _getDatacenter( inventory, paramaters[ 'datacenter' ] )
+    resourcePool = _getResourcePool( inventory, dataCenter, paramaters[ 'cluster' ] )
+    host = _getHost( inventory, resourcePool, paramaters[ 'host' ] )
 
     result = []
-    for network in host.network:
-      if paramaters[ 'name_regex' ] is not None and not paramaters[ 'name_regex' ].match( network.name ):
+    for network in inventory.get( host, 'network', [] ):
+      name = inventory.name( network )
+      if paramaters[ 'name_regex' ] is not None and not paramaters[ 'name_regex' ].match( name ):
         continue
 
-      result.append( network.name )
+      result.append( name )
 
     return { 'network_list': result }
 
-  finally:
-    _disconnect( si )
-
 
 def _createDisk( si, dc, disk, datastore, file_path ):
   ( dir_name, _ ) = file_path.rsplit( '/', 1 )
@@ -382,13 +363,12 @@ def _inject_ovf_env( si, vm, vm_paramaters ):
     raise Exception( 'Unexpected Task State With OVF Environment Injection: "{0}"'.format( task.info.state ) )
 
 
-def _create_from_template( si, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
+def _create_from_template( si, inventory, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
   logging.info( 'vcenter: creating from Template("{0}") "{1}"'.format( vm_paramaters[ 'template' ], vm_name ) )
 
   template = None
-  cont = si.RetrieveContent()
-  for item in cont.viewManager.CreateContainerView( data_center, [ vim.VirtualMachine ], True ).view:
-    if item.name == vm_paramaters[ 'template' ]:
+  for item, property_map in retrieve_properties( si, { vim.VirtualMachine: [ 'name' ] }, data_center ).items():
+    if property_map.get( 'name' ) == vm_paramaters[ 'template' ]:
       template = item
       break
 
@@ -415,7 +395,7 @@ def _create_from_template( si, vm_name, data_center, resource_pool, folder, host
 
   for i in range( 0, len( vm_paramaters[ 'interface_list' ] ) ):
     interface = vm_paramaters[ 'interface_list' ][ i ]
-    network = _getNetwork( host, interface[ 'network' ] )
+    network = _getNetwork( inventory, host, interface[ 'network' ] )
 
     devSpec = vim.vm.device.VirtualDeviceSpec()
     devSpec.operation = 'edit'
@@ -478,71 +458,78 @@ def _create_from_template( si, vm_name, data_center, resource_pool, folder, host
   return task.info.result.config.instanceUuid
 
 
-def _create_from_ova( si, vm_name, connection_host, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
+def _create_from_ova( si, inventory, vm_name, connection_host, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
   logging.info( 'vcenter: creating from OVA("{0}") "{1}"'.format( vm_paramaters[ 'ova' ], vm_name ) )
   if hasattr( ssl, '_create_unverified_context' ):
     sslContext = ssl._create_unverified_context()
   else:
     sslContext = None
 
-  handler = OVAImportHandler( vm_paramaters[ 'ova' ], sslContext )
+  if vm_paramaters.get( 'ova_stream', False ):  # upload the disks as the OVA downloads, nothing is staged on local disk
+    handler = OVAStreamImportHandler( vm_paramaters[ 'ova' ], sslContext )
+  else:
+    handler = OVAImportHandler( vm_paramaters[ 'ova' ], sslContext )
 
-  ovf_manager = si.content.ovfManager
+  try:  # the handler has the OVA open, close it no matter how this goes
+    ovf_manager = si.content.ovfManager
 
-  network_mapping = []
-  for interface in vm_paramaters[ 'interface_list' ]:
-    network_mapping.append( vim.OvfManager.NetworkMapping( name=interface[ 'physical_location' ], network=_getNetwork( host, interface[ 'network' ] ) ) )
+    network_mapping = []
+    for interface in vm_paramaters[ 'interface_list' ]:
+      network_mapping.append( vim.OvfManager.NetworkMapping( name=interface[ 'physical_location' ], network=_getNetwork( inventory, host, interface[ 'network' ] ) ) )
 
-  property_map = []
-  try:
-    for key, value in vm_paramaters[ 'property_map' ].items():
-      property_map.append( vim.KeyValue( key=key, value=value ) )
-  except KeyError:
-    pass
+    property_map = []
+    try:
+      for key, value in vm_paramaters[ 'property_map' ].items():
+        property_map.append( vim.KeyValue( key=key, value=value ) )
+    except KeyError:
+      pass
 
-  cisp = vim.OvfManager.CreateImportSpecParams( entityName=vm_name, hostSystem=host, propertyMapping=property_map, networkMapping=network_mapping )
+    cisp = vim.OvfManager.CreateImportSpecParams( entityName=vm_name, hostSystem=host, propertyMapping=property_map, networkMapping=network_mapping )
 
-  try:
-    cisp.diskProvisioning = vm_paramaters[ 'disk_provisioning' ]
-  except KeyError:
-    pass
+    try:
+      cisp.diskProvisioning = vm_paramaters[ 'disk_provisioning' ]
+    except KeyError:
+      pass
 
-  try:
-    cisp.deploymentOption = vm_paramaters[ 'deployment_option' ]
-  except KeyError:
-    pass
+    try:
+      cisp.deploymentOption = vm_paramaters[ 'deployment_option' ]
+    except KeyError:
+      pass
 
-  try:
-    cisp.ipProtocol = vm_paramaters[ 'ip_protocol' ]
-  except KeyError:
-    pass
+    try:
+      cisp.ipProtocol = vm_paramaters[ 'ip_protocol' ]
+    except KeyError:
+      pass
 
-  logging.debug( 'vcenter: Import Spec Params: "{0}"'.format( cisp ) )
+    logging.debug( 'vcenter: Import Spec Params: "{0}"'.format( cisp ) )
 
-  result = ovf_manager.CreateImportSpec( handler.descriptor, resource_pool, datastore, cisp )
+    result = ovf_manager.CreateImportSpec( handler.descriptor, resource_pool, datastore, cisp )
 
-  if result.importSpec is not None and result.importSpec.configSpec.vAppConfig is not None:
-    for property in result.importSpec.configSpec.vAppConfig.property:
-      info = property.info
-      if info.id in vm_paramaters[ 'property_map' ] and not info.userConfigurable:
-        logging.warning( 'Setting non user configurable "{0}" to configurable'.format( info.id ) )
-        info.userConfigurable = True
+    if result.importSpec is not None and result.importSpec.configSpec.vAppConfig is not None:
+      for property in result.importSpec.configSpec.vAppConfig.property:
+        info = property.info
+        if info.id in vm_paramaters[ 'property_map' ] and not info.userConfigurable:
+          logging.warning( 'Setting non user configurable "{0}" to configurable'.format( info.id ) )
+          info.userConfigurable = True
 
-  if len( result.warning ):
-    logging.warning( 'vcenter: Warning with OVA Import Spec: "{0}"'.format( result.warning ) )
+    if len( result.warning ):
+      logging.warning( 'vcenter: Warning with OVA Import Spec: "{0}"'.format( result.warning ) )
 
-  if len( result.error ):
-    raise Exception( 'OVA Import Errors: "{0}"'.format( '","'.join( [ str( i ) for i in result.error ] ) ) )
+    if len( result.error ):
+      raise Exception( 'OVA Import Errors: "{0}"'.format( '","'.join( [ str( i ) for i in result.error ] ) ) )
 
-  uuid = handler.upload( connection_host, resource_pool, result, data_center )
+    uuid = handler.upload( connection_host, resource_pool, result, data_center )
+
+  finally:
+    handler.close()
 
   if si.content.about.productLineId == 'embeddedEsx':
-    _inject_ovf_env( si, _getVM( si, uuid ), vm_paramaters )
+    _inject_ovf_env( si, _getVM( inventory, uuid ), vm_paramaters )
 
   return uuid
 
 
-def _create_from_scratch( si, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
+def _create_from_scratch( si, inventory, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
   logging.info( 'vcenter: creating from scratch "{0}"'.format( vm_name ) )
 
   vmx_file_path, disk_filepath_list = _genPaths( vm_paramaters[ 'name' ], vm_paramaters[ 'disk_list' ], datastore )
@@ -593,7 +580,7 @@ def _create_from_scratch( si, vm_name, data_center, resource_pool, folder, host,
 
   for i in range( 0, len( vm_paramaters[ 'interface_list' ] ) ):
     interface = vm_paramaters[ 'interface_list' ][ i ]
-    network = _getNetwork( host, interface[ 'network' ] )
+    network = _getNetwork( inventory, host, interface[ 'network' ] )
 
     try:
       devClass = NET_CLASS_MAP[ interface.get( 'type', 'E1000' ) ]
@@ -674,28 +661,25 @@ def create( paramaters ):  # NOTE: the picking of the cluster/host and datastore
     vm_paramaters[ 'interface_list' ][ i ][ 'mac' ] = ':'.join( mac[ x:x + 2 ] for x in range( 0, 12, 2 ) )
 
   logging.info( 'vcenter: creating vm "{0}"'.format( vm_name ) )
-  si = _connect( connection_paramaters )
-  try:
-    data_center = _getDatacenter( si, vm_paramaters[ 'datacenter' ] )
-    resource_pool = _getResourcePool( data_center, vm_paramaters[ 'cluster' ] )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    data_center = _getDatacenter( inventory, vm_paramaters[ 'datacenter' ] )
+    resource_pool = _getResourcePool( inventory, data_center, vm_paramaters[ 'cluster' ] )
     folder = data_center.vmFolder
-    host = _getHost( resource_pool, vm_paramaters[ 'host' ] )
-    datastore = _getDatastore( data_center, vm_paramaters[ 'datastore' ] )
+    host = _getHost( inventory, resource_pool, vm_paramaters[ 'host' ] )
+    datastore = _getDatastore( inventory, data_center, vm_paramaters[ 'datastore' ] )
 
     if 'ova' in vm_paramaters:
-      vm_uuid = _create_from_ova( si, vm_name, paramaters[ 'connection' ][ 'host' ], data_center, resource_pool, folder, host, datastore, vm_paramaters )
+      vm_uuid = _create_from_ova( si, inventory, vm_name, paramaters[ 'connection' ][ 'host' ], data_center, resource_pool, folder, host, datastore, vm_paramaters )
     elif 'template' in vm_paramaters:
-      vm_uuid = _create_from_template( si, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters )
+      vm_uuid = _create_from_template( si, inventory, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters )
     else:
-      vm_uuid = _create_from_scratch( si, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters )
+      vm_uuid = _create_from_scratch( si, inventory, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters )
 
     logging.info( 'vcenter: vm "{0}" created, uuid: "{1}"'.format( vm_name, vm_uuid ) )
 
     return { 'done': True, 'uuid': vm_uuid }
 
-  finally:
-    _disconnect( si )
-
 
 def create_rollback( paramaters ):
   vm_paramaters = paramaters[ 'vm' ]
@@ -703,10 +687,10 @@ def create_rollback( paramaters ):
   vm_name = vm_paramaters[ 'name' ]
   logging.info( 'vcenter: rolling back vm "{0}"'.format( vm_name ) )
 
-  si = _connect( connection_paramaters )
-  try:
-    dataCenter = _getDatacenter( si, vm_paramaters[ 'datacenter' ] )
-    datastore = _getDatastore( dataCenter, vm_paramaters[ 'datastore' ] )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    dataCenter = _getDatacenter( inventory, vm_paramaters[ 'datacenter' ] )
+    datastore = _getDatastore( inventory, dataCenter, vm_paramaters[ 'datastore' ] )
 
     vmx_file_path, disk_filepath_list = _genPaths( vm_paramaters[ 'name' ], vm_paramaters[ 'disk_list' ], datastore )
 
@@ -729,9 +713,6 @@ def create_rollback( paramaters ):
 
     return { 'rollback_done': True }
 
-  finally:
-    _disconnect( si )
-
 
 def destroy( paramaters ):
   connection_paramaters = paramaters[ 'connection' ]
@@ -739,10 +720,10 @@ def destroy( paramaters ):
   vm_name = paramaters[ 'name' ]
 
   logging.info( 'vcenter: destroying vm "{0}"({1})'.format( vm_name, vm_uuid ) )
-  si = _connect( connection_paramaters )
-  try:
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
     try:
-      vm = _getVM( si, vm_uuid )
+      vm = _getVM( inventory, vm_uuid )
     except MOBNotFound:
       return { 'done': True }  # it's gone, we are done
 
@@ -759,9 +740,6 @@ def destroy( paramaters ):
     logging.info( 'vcenter: vm "{0}" destroyed'.format( vm_name ) )
     return { 'done': True }
 
-  finally:
-    _disconnect( si )
-
 
 def get_interface_map( paramaters ):
   connection_paramaters = paramaters[ 'connection' ]
@@ -770,9 +748,9 @@ def get_interface_map( paramaters ):
   interface_list = []
 
   logging.info( 'vcenter: getting interface map "{0}"({1})'.format( vm_name, vm_uuid ) )
-  si = _connect( connection_paramaters )
-  try:
-    vm = _getVM( si, vm_uuid )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    vm = _getVM( inventory, vm_uuid )
 
     for device in vm.config.hardware.device:
       if device.__class__ in NET_CLASS_MAP.values():
@@ -784,9 +762,6 @@ def get_interface_map( paramaters ):
 
     return { 'interface_list': interface_list }
 
-  finally:
-    _disconnect( si )
-
 
 def _power_state_convert( state ):
   if state in ( vim.VirtualMachinePowerState.poweredOff, vim.VirtualMachinePowerState.suspended ):
@@ -806,9 +781,9 @@ def set_power( paramaters ):
   desired_state = paramaters[ 'state' ]
 
   logging.info( 'vcenter: setting power state of "{0}"({1}) to "{2}"...'.format( vm_name, vm_uuid, desired_state ) )
-  si = _connect( connection_paramaters )
-  try:
-    vm = _getVM( si, vm_uuid )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    vm = _getVM( inventory, vm_uuid )
 
     curent_state = _power_state_convert( vm.runtime.powerState )
     if curent_state == desired_state or ( curent_state == 'off' and desired_state == 'soft_off' ):
@@ -831,9 +806,7 @@ def set_power( paramaters ):
     # vm.terminateVM()  # no Task
 
     if task is not None:
-      while task.info.state not in ( vim.TaskInfo.State.success, vim.TaskInfo.State.error ):
-        logging.debug( 'vcenter: vm "{0}"({1}) power "{2}" at {3}%'.format( vm_name, vm_uuid, desired_state, task.info.progress ) )
-        time.sleep( POLL_INTERVAL )
+      _taskWait( task )
 
       # invalid power status happens when we try to turn off a vm that is allready off
       if task.info.state == vim.TaskInfo.State.error and task.info.error.__class__.__name__ != 'vim.fault.InvalidPowerState':   # will try again, if it happens again, the count will get it
@@ -845,9 +818,6 @@ def set_power( paramaters ):
     logging.info( 'vcenter: setting power state of "{0}"({1}) to "{2}" complete'.format( vm_name, vm_uuid, desired_state ) )
     return { 'state': _power_state_convert( vm.runtime.powerState ) }
 
-  finally:
-    _disconnect( si )
-
 
 def power_state( paramaters ):
   connection_paramaters = paramaters[ 'connection' ]
@@ -855,15 +825,12 @@ def power_state( paramaters ):
   vm_name = paramaters[ 'name' ]
 
   logging.info( 'vcenter: getting "{0}"({1}) power state...'.format( vm_name, vm_uuid ) )
-  si = _connect( connection_paramaters )
-  try:
-    vm = _getVM( si, vm_uuid )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    vm = _getVM( inventory, vm_uuid )
 
     return { 'state': _power_state_convert( vm.runtime.powerState ) }
 
-  finally:
-    _disconnect( si )
-
 
 def execute( paramaters ):
   connection_paramaters = paramaters[ 'connection' ]
@@ -874,9 +841,9 @@ def execute( paramaters ):
   dir = paramaters[ 'dir' ]
 
   logging.info( 'vcenter: executing "{0}" "{1}" on "{2}"({3})'.format( program, args, vm_name, vm_uuid ) )
-  si = _connect( connection_paramaters )
-  try:
-    vm = _getVM( si, vm_uuid )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    vm = _getVM( inventory, vm_uuid )
 
     if vm.guest.toolsStatus in ( 'toolsNotInstalled', 'toolsNotRunning' ):
       return { 'error': 'VMwareTools is not installed or not Running' }
@@ -906,9 +873,6 @@ def execute( paramaters ):
 
     return { 'rc': pList[0].exitCode }
 
-  finally:
-    _disconnect( si )
-
 
 def mark_as_template( paramaters ):
   connection_paramaters = paramaters[ 'connection' ]
@@ -917,12 +881,12 @@ def mark_as_template( paramaters ):
   as_template = paramaters[ 'as_template' ]
 
   logging.info( 'vcenter: mark_as_template "{0}"({1}) to "{2}"...'.format( vm_name, vm_uuid, as_template ) )
-  si = _connect( connection_paramaters )
-  try:
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
     if si.content.about.productLineId == 'embeddedEsx':  # mark as template not supported on ESX
       return {}
 
-    vm = _getVM( si, vm_uuid )
+    vm = _getVM( inventory, vm_uuid )
 
     if as_template:
       vm.MarkAsTemplate()
@@ -931,9 +895,6 @@ def mark_as_template( paramaters ):
 
     return {}
 
-  finally:
-    _disconnect( si )
-
 
 def export( paramaters ):
   connection_paramaters = paramaters[ 'connection' ]
@@ -948,13 +909,10 @@ def export( paramaters ):
 
   logging.info( 'vcenter: exporting "{0}"({1}) to "{2}"...'.format( vm_name, vm_uuid, url ) )
 
-  si = _connect( connection_paramaters )
-  try:
-    handler = OVAExportHandler( si.content.ovfManager, url, sslContext )
-    vm = _getVM( si, vm_uuid )
+  with _session( connection_paramaters ) as si:
+    inventory = _inventory( si, connection_paramaters )
+    handler = OVAExportHandler( si.content.ovfManager, url, sslContext, paramaters.get( 'stream_optimize', False ) )
+    vm = _getVM( inventory, vm_uuid )
     location = handler.export( paramaters[ 'connection' ][ 'host' ], vm, vm_name )
 
     return { 'location': location }
-
-  finally:
-    _disconnect( si )
@@ -0,0 +1,193 @@
+import ssl
+import time
+import logging
+import threading
+from http.client import HTTPException
+
+from pyVim import connect
+from pyVmomi import vim
+
+from subcontractor.credentials import getCredentials
+
+SESSION_POOL_MAX = 4  # max number of idle sessions kept per host/credential
+SESSION_IDLE_TIMEOUT = 3600  # in seconds, sessions idle in the pool longer than this are logged out, until then the keepalive stops vCenter from dropping them
+SESSION_KEEPALIVE_INTERVAL = 300  # in seconds, how often idle sessions are touched with CurrentTime(), keep it well under vCenter's session timeout, 30 min by default
+SESSION_HTTP_TIMEOUT = 300  # in seconds, socket timeout for the SOAP calls, so a vCenter that stops answering does not hang the caller forever
+
+_local = threading.local()
+
+
+def current_session():
+  """
+  Returns the connection_paramaters of the session the calling thread has borrowed, or None.
+  """
+  return getattr( _local, 'connection_paramaters', None )
+
+
+def _login_method( creds ):
+  """
+  Returns the login method for VimSessionOrientedStub, it is called for the first call on the stub, and again
+  when a call fails with NotAuthenticated, so a session vCenter has dropped is logged back in with out the caller knowing.
+  """
+  if 'username' in creds:
+    return connect.VimSessionOrientedStub.makeUserLoginMethod( creds[ 'username' ], creds[ 'password' ] )
+
+  def _login( soap_stub ):
+    session_manager = vim.ServiceInstance( 'ServiceInstance', soap_stub ).content.sessionManager
+    if not session_manager.currentSession:
+      session_manager.LoginBySSPI( creds[ 'token' ] )
+
+  return _login
+
+
+def session_key( connection_paramaters ):
+  """
+  Returns ( key, creds ) for connection_paramaters, the key is ( host, username/token ).
+  """
+  creds = connection_paramaters[ 'credentials' ]
+  if isinstance( creds, str ):
+    creds = getCredentials( creds )
+
+  # TODO: saninity check on creds
+
+  return ( connection_paramaters[ 'host' ], creds.get( 'username', creds.get( 'token' ) ) ), creds
+
+
+class _VCenterSession():
+  def __init__( self, pool, key, creds, connection_paramaters ):
+    super().__init__()
+    self.pool = pool
+    self.key = key
+    self.creds = creds
+    self.connection_paramaters = connection_paramaters
+    self.si = None
+    self.prev_connection_paramaters = None
+
+  def __enter__( self ):
+    self.si = self.pool._get( self.key, self.creds )
+    self.prev_connection_paramaters = current_session()
+    _local.connection_paramaters = self.connection_paramaters
+    return self.si
+
+  def __exit__( self, exc_type, exc_value, traceback ):
+    _local.connection_paramaters = self.prev_connection_paramaters
+    if exc_type is not None and issubclass( exc_type, ( OSError, HTTPException ) ):  # the connection is in a bad way, don't reuse it
+      self.pool._logout( self.si )
+    else:
+      self.pool._put( self.key, self.si, self.creds )
+
+
+class VCenterSessionPool():
+  """
+  Logged in vCenter ServiceInstances, by host and username/token, so each call borrows a session instead of doing a
+  full login and logout.  A session is used by one thread at a time:
+
+    with VCENTER_SESSIONS.session( connection_paramaters ) as si:
+      vm = si.content.searchIndex.FindByUuid( ... )
+
+  Idle sessions are kept alive with CurrentTime() every SESSION_KEEPALIVE_INTERVAL, and logged out after idle_timeout,
+  from a thread of the pool's own, as those calls can block.
+  """
+  def __init__( self, max_per_key, idle_timeout ):
+    super().__init__()
+    self.max_per_key = max_per_key
+    self.idle_timeout = idle_timeout
+    self.lock = threading.Lock()
+    self.idle_map = {}  # ( host, username/token ) -> [ ( ServiceInstance, creds, released at ) ]
+    self.keepalive_thread = None
+
+  def session( self, connection_paramaters ):
+    key, creds = session_key( connection_paramaters )
+    return _VCenterSession( self, key, creds, connection_paramaters )
+
+  def _get( self, key, creds ):
+    now = time.monotonic()
+    expired_list = []
+    result = None
+    with self.lock:
+      idle_list = self.idle_map.get( key, [] )
+      while idle_list:
+        si, si_creds, released = idle_list.pop()
+        if now - released < self.idle_timeout and si_creds == creds:
+          result = si
+          break
+
+        expired_list.append( si )
+
+    for si in expired_list:
+      self._logout( si )
+
+    if result is not None:
+      return result
+
+    return self._login( key, creds )
+
+  def _login( self, key, creds ):
+    # work arround invalid SSL
+    _create_unverified_https_context = ssl._create_unverified_context
+    ssl._create_default_https_context = _create_unverified_https_context
+    # TODO: flag for trusting SSL of connection, also there is a paramater to Connect for verified SSL
+
+    host, _ = key
+    if 'username' in creds:
+      logging.debug( 'vcenter: new session to "{0}" with user "{1}"'.format( host, creds[ 'username' ] ) )
+    else:
+      logging.debug( 'vcenter: new session to "{0}" with token "{1}"'.format( host, creds[ 'token' ] ) )
+
+    stub = connect.VimSessionOrientedStub( connect.SmartStubAdapter( host=host, httpConnectionTimeout=SESSION_HTTP_TIMEOUT ), _login_method( creds ) )
+    si = vim.ServiceInstance( 'ServiceInstance', stub )
+    si.content  # log in now, so bad credentials show up here and not in the middle of something
+    return si
+
+  def _logout( self, si ):
+    try:
+      connect.Disconnect( si )
+    except Exception as e:
+      logging.debug( 'vcenter: Exception while logging out session: "{0}"'.format( e ) )
+
+  def _put( self, key, si, creds ):
+    with self.lock:
+      idle_list = self.idle_map.setdefault( key, [] )
+      if len( idle_list ) < self.max_per_key:
+        idle_list.append( ( si, creds, time.monotonic() ) )
+        si = None
+
+      if self.keepalive_thread is None:
+        self.keepalive_thread = threading.Thread( target=self._keepalive_run, name='vcenter session keepalive', daemon=True )
+        self.keepalive_thread.start()
+
+    if si is not None:  # to many idle allready
+      self._logout( si )
+
+  def _keepalive_run( self ):
+    while True:
+      time.sleep( SESSION_KEEPALIVE_INTERVAL )
+      try:
+        self._keepalive()
+      except Exception as e:
+        logging.warning( 'vcenter: Exception in session keep-alive: "{0}"'.format( e ) )
+
+  def _keepalive( self ):
+    now = time.monotonic()
+    expired_list = []
+    keep_list = []
+    with self.lock:
+      for idle_list in self.idle_map.values():
+        for item in list( idle_list ):
+          if now - item[2] >= self.idle_timeout:
+            idle_list.remove( item )
+            expired_list.append( item[0] )
+          else:
+            keep_list.append( item[0] )
+
+    for si in expired_list:
+      self._logout( si )
+
+    for si in keep_list:  # if one of these is borrowed in the mean time, it dosen't hurt, the stub is thread safe
+      try:
+        si.CurrentTime()
+      except Exception as e:
+        logging.debug( 'vcenter: Exception during session keep-alive: "{0}"'.format( e ) )
+
+
+VCENTER_SESSIONS = VCenterSessionPool( SESSION_POOL_MAX, SESSION_IDLE_TIMEOUT )
@@ -0,0 +1,195 @@
+import time
+import logging
+import threading
+
+from pyVmomi import vim, vmodl
+
+from subcontractor_plugins.vcenter.session import VCENTER_SESSIONS, session_key
+
+TASK_WAITER_ENABLED = True  # set to False to poll tasks instead
+TASK_WAIT_TIMEOUT = 30  # in seconds, max time WaitForUpdatesEx waits for changes before returning with nothing
+TASK_LOG_INTERVAL = 10  # in seconds, how often the progress of a task being waited on is logged
+TASK_START_TIMEOUT = 30  # in seconds, how long to wait for a waiter to connect before giving up on it
+TASK_IDLE_TIMEOUT = 300  # in seconds, waiters with no tasks for this long are stopped
+TASK_DONE_STATES = ( 'success', 'error' )
+
+
+class _TaskEntry():
+  def __init__( self, task ):
+    super().__init__()
+    self.task = task
+    self.state = None
+    self.progress = None
+    self.done = threading.Event()
+    self.failed = False  # the waiter stopped following the task
+
+
+class TaskWaiter():
+  """
+  Waits on the tasks of one vCenter with one PropertyCollector, on a session of it's own.  Each task waited on gets a
+  filter on info.state and info.progress, and a background thread follows the changes for all of them with WaitForUpdatesEx,
+  so a task is seen to finish as soon as it does, with out fetching the TaskInfo over and over.
+  """
+  def __init__( self, connection_paramaters ):
+    super().__init__()
+    self.connection_paramaters = connection_paramaters
+    self.lock = threading.Lock()
+    self.entry_map = {}  # task moId -> _TaskEntry
+    self.si = None
+    self.collector = None
+    self.started = threading.Event()
+    self.thread = None
+    self.idle_since = time.monotonic()
+
+  def _start( self ):  # call with self.lock held
+    if self.thread is not None and self.thread.is_alive():
+      return
+
+    self.started.clear()
+    self.idle_since = time.monotonic()  # otherwise a restarted thread sees the idle time from before it stopped, and stops right away
+    self.thread = threading.Thread( target=self.run, name='vcenter tasks "{0}"'.format( self.connection_paramaters[ 'host' ] ), daemon=True )
+    self.thread.start()
+
+  def wait( self, task ):
+    """
+    Blocks until task is no longer queued or running.  Returns False if the task could not be followed, in which case
+    the caller has to poll it.
+    """
+    with self.lock:
+      self._start()
+
+    if not self.started.wait( TASK_START_TIMEOUT ):
+      return False
+
+    entry = _TaskEntry( task )
+    with self.lock:
+      si = self.si
+      collector = self.collector
+      if collector is None:  # it stopped
+        return False
+
+      self.entry_map[ task._moId ] = entry
+
+    filter = None
+    try:
+      object_spec = vmodl.query.PropertyCollector.ObjectSpec( obj=vim.Task( task._moId, si._stub ), skip=False )
+      property_spec = vmodl.query.PropertyCollector.PropertySpec( type=vim.Task, pathSet=[ 'info.state', 'info.progress' ] )
+      filter = collector.CreateFilter( vmodl.query.PropertyCollector.FilterSpec( objectSet=[ object_spec ], propSet=[ property_spec ] ), True )
+
+      while not entry.done.wait( TASK_LOG_INTERVAL ):
+        if entry.progress is not None:
+          logging.debug( 'vmware: Waiting, {0}% Complete ...'.format( entry.progress ) )
+        else:
+          logging.debug( 'vmware: Waiting ...' )
+
+    except Exception as e:
+      logging.warning( 'vcenter: unable to follow task "{0}": "{1}"'.format( task._moId, e ) )
+      entry.failed = True
+
+    finally:
+      with self.lock:
+        self.entry_map.pop( task._moId, None )
+        if not self.entry_map:
+          self.idle_since = time.monotonic()
+
+      if filter is not None:
+        try:
+          filter.DestroyPropertyFilter()
+        except Exception:
+          pass  # allready gone with the collector
+
+    return not entry.failed
+
+  def run( self ):
+    try:
+      with VCENTER_SESSIONS.session( self.connection_paramaters ) as si:
+        collector = si.content.propertyCollector.CreatePropertyCollector()  # our own, the filters only concern us
+        try:
+          with self.lock:
+            self.si = si
+            self.collector = collector
+
+          self.started.set()
+          self._follow( collector )
+
+        finally:
+          try:
+            collector.DestroyPropertyCollector()
+          except Exception:
+            pass
+
+    except Exception as e:
+      logging.warning( 'vcenter: task waiter for "{0}" got exception: "{1}"'.format( self.connection_paramaters[ 'host' ], e ) )
+
+    finally:
+      with self.lock:
+        self.si = None
+        self.collector = None
+        for entry in self.entry_map.values():  # they will have to poll
+          entry.failed = True
+          entry.done.set()
+
+      self.started.set()  # so anything waiting for the start gives up
+
+  def _follow( self, collector ):
+    options = vmodl.query.PropertyCollector.WaitOptions( maxWaitSeconds=TASK_WAIT_TIMEOUT )
+    version = ''
+    while True:
+      with self.lock:
+        if not self.entry_map and time.monotonic() - self.idle_since > TASK_IDLE_TIMEOUT:
+          self.collector = None  # while still holding the lock, so no more tasks are added
+          return
+
+      update_set = collector.WaitForUpdatesEx( version, options )
+      if update_set is None:
+        continue
+
+      version = update_set.version
+      for filter_update in update_set.filterSet:
+        for object_update in filter_update.objectSet:
+          with self.lock:
+            entry = self.entry_map.get( object_update.obj._moId )
+
+          if entry is None:
+            continue
+
+          for change in object_update.changeSet:
+            if change.name == 'info.state':
+              entry.state = change.val
+            elif change.name == 'info.progress':
+              entry.progress = change.val
+
+          if entry.state in TASK_DONE_STATES:
+            entry.done.set()
+
+
+class TaskWaiterPool():
+  """
+  The TaskWaiters, by host and username/token.
+  """
+  def __init__( self ):
+    super().__init__()
+    self.lock = threading.Lock()
+    self.waiter_map = {}
+
+  def get( self, connection_paramaters ):
+    """
+    Returns the TaskWaiter for connection_paramaters, or None if the waiters are disabled.
+    """
+    if not TASK_WAITER_ENABLED:
+      return None
+
+    key, _ = session_key( connection_paramaters )
+    with self.lock:
+      try:
+        return self.waiter_map[ key ]
+      except KeyError:
+        pass
+
+      waiter = TaskWaiter( connection_paramaters )
+      self.waiter_map[ key ] = waiter
+
+    return waiter
+
+
+TASK_WAITERS = TaskWaiterPool()
@@ -0,0 +1,322 @@
+"""
+Converts flat and hosted sparse ( monolithicSparse ) disk images to streamOptimized VMDKs, the format
+in OVAs, the grains are deflated and zero grains are dropped.  See the VMware Virtual Disk Format 5.0 spec.
+"""
+import os
+import zlib
+import time
+import random
+import struct
+import hashlib
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+SECTOR_SIZE = 512
+GRAIN_SIZE = 128  # in sectors, 64KiB
+GTES_PER_GT = 512
+DESCRIPTOR_SIZE = 20  # in sectors
+OVERHEAD = 128  # in sectors, the header and descriptor, the grains start after this
+DEFLATE_WORKERS = 4  # threads compressing grains, shared by all conversions, zlib releases the GIL
+DEFLATE_LEVEL = 1  # zlib level, 1 is fastest, 9 is smallest, past 1 costs a lot of cpu for little gain on disk images
+DEFLATE_QUEUE = 256  # grains compressing at once for each conversion
+
+MAGIC = 0x564d444b  # 'KDMV'
+FLAG_VALID_NEWLINE_TEST = 0x1
+FLAG_COMPRESSED = 0x10000
+FLAG_MARKERS = 0x20000
+COMPRESS_DEFLATE = 1
+GD_AT_END = 0xffffffffffffffff
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+HEADER_FORMAT = '<IIIQQQQIQQQB4cH433x'
+MARKER_FORMAT = '<QII496x'
+GRAIN_MARKER_FORMAT = '<QI'
+
+_ZERO_GRAIN = bytes( GRAIN_SIZE * SECTOR_SIZE )
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+  global _executor
+
+  with _executor_lock:
+    if _executor is None:
+      _executor = ThreadPoolExecutor( max_workers=DEFLATE_WORKERS, thread_name_prefix='deflate' )
+
+    return _executor
+
+
+def _deflate( buff, level ):
+  begin = time.thread_time()
+  result = zlib.compress( buff, level )
+  return result, time.thread_time() - begin
+
+
+def _sectors( count ):
+  return ( count + SECTOR_SIZE - 1 ) // SECTOR_SIZE
+
+
+def read_header( buff ):
+  """
+  Returns the sparse extent header at the start of buff as a dict, None if it is not a sparse VMDK.
+  """
+  if len( buff ) < SECTOR_SIZE:
+    return None
+
+  value_list = struct.unpack( HEADER_FORMAT, buff[ :SECTOR_SIZE ] )
+  if value_list[0] != MAGIC:
+    return None
+
+  return {
+           'version': value_list[1],
+           'flags': value_list[2],
+           'capacity': value_list[3],
+           'grain_size': value_list[4],
+           'gtes_per_gt': value_list[7],
+           'rgd_offset': value_list[8],
+           'gd_offset': value_list[9],
+           'compress': value_list[16]
+         }
+
+
+def disk_type( buff ):
+  """
+  Returns what the disk image starting with buff is, 'flat', 'sparse' ( hosted sparse ) or 'streamOptimized'.
+  """
+  header = read_header( buff )
+  if header is None:
+    return 'flat'
+
+  if header[ 'flags' ] & FLAG_COMPRESSED:
+    return 'streamOptimized'
+
+  return 'sparse'
+
+
+class StreamOptimizedWriter():
+  """
+  Writes a streamOptimized VMDK of a disk of capacity bytes to file, give it the contents with write() in
+  order, file is only ever appended to, so it can be a pipe.  Once close() is called, the sha256 of what was
+  written is in digest, and the counts and timings are in stats.
+  """
+  def __init__( self, file, capacity, name ):
+    super().__init__()
+    self.file = file
+    self.name = name
+    self.capacity = _sectors( capacity )
+    self.gd = [ 0 ] * ( ( self.capacity + GRAIN_SIZE * GTES_PER_GT - 1 ) // ( GRAIN_SIZE * GTES_PER_GT ) )
+    self.gt_index = 0  # the grain table being filled
+    self.gt = [ 0 ] * GTES_PER_GT
+    self.pending = deque()  # ( lba, future ) being compressed
+    self.buff = b''  # the part of a grain that has been written
+    self.lba = 0  # sector the next write starts at
+    self.offset = 0  # bytes written to file
+    self.hash = hashlib.sha256()
+    self.digest = None
+    self.stats = { 'bytes_in': 0, 'bytes_out': 0, 'grains': 0, 'zero_grains': 0, 'deflate_time': 0.0, 'elapsed': 0.0 }
+    self._begin = time.monotonic()
+
+    descriptor = self._descriptor().encode()
+    if len( descriptor ) > DESCRIPTOR_SIZE * SECTOR_SIZE:
+      raise ValueError( 'Descriptor is too big' )
+
+    self._write( self._header( GD_AT_END ) )
+    self._write( descriptor )
+    self._pad( OVERHEAD * SECTOR_SIZE - self.offset )
+
+  def _header( self, gd_offset ):
+    return struct.pack( HEADER_FORMAT, MAGIC, 3, FLAG_VALID_NEWLINE_TEST | FLAG_COMPRESSED | FLAG_MARKERS, self.capacity, GRAIN_SIZE, 1, DESCRIPTOR_SIZE,
+                        GTES_PER_GT, 0, gd_offset, OVERHEAD, 0, b'\n', b' ', b'\r', b'\n', COMPRESS_DEFLATE )
+
+  def _descriptor( self ):
+    cylinders = min( self.capacity // ( 255 * 63 ), 65535 )
+    return '\n'.join( [
+                        '# Disk DescriptorFile',
+                        'version=1',
+                        'CID={0:08x}'.format( random.randint( 0, 0xfffffffd ) ),
+                        'parentCID=ffffffff',
+                        'createType="streamOptimized"',
+                        '',
+                        '# Extent description',
+                        'RW {0} SPARSE "{1}"'.format( self.capacity, self.name ),
+                        '',
+                        '# The Disk Data Base',
+                        '#DDB',
+                        '',
+                        'ddb.adapterType = "lsilogic"',
+                        'ddb.geometry.cylinders = "{0}"'.format( cylinders ),
+                        'ddb.geometry.heads = "255"',
+                        'ddb.geometry.sectors = "63"',
+                        'ddb.virtualHWVersion = "4"',
+                        ''
+                      ] )
+
+  def _write( self, buff ):
+    self.file.write( buff )
+    self.hash.update( buff )
+    self.offset += len( buff )
+
+  def _pad( self, count ):
+    if count > 0:
+      self._write( bytes( count ) )
+
+  def _pad_sector( self ):
+    self._pad( -self.offset % SECTOR_SIZE )
+
+  def _marker( self, sector_count, type ):
+    self._write( struct.pack( MARKER_FORMAT, sector_count, 0, type ) )
+
+  def _write_gt( self ):
+    self._marker( _sectors( GTES_PER_GT * 4 ), MARKER_GT )
+    self.gd[ self.gt_index ] = self.offset // SECTOR_SIZE
+    self._write( struct.pack( '<{0}I'.format( GTES_PER_GT ), *self.gt ) )
+    self.gt_index += 1
+    self.gt = [ 0 ] * GTES_PER_GT
+
+  def _write_grain( self ):
+    lba, future = self.pending.popleft()
+    buff, cpu_time = future.result()
+    self.stats[ 'deflate_time' ] += cpu_time
+    grain = lba // GRAIN_SIZE
+    while grain // GTES_PER_GT > self.gt_index:  # the grain tables are written after their grains, all of them, even if they are empty
+      self._write_gt()
+
+    self.gt[ grain % GTES_PER_GT ] = self.offset // SECTOR_SIZE
+    self._write( struct.pack( GRAIN_MARKER_FORMAT, lba, len( buff ) ) )
+    self._write( buff )
+    self._pad_sector()
+
+  def write_grain( self, lba, buff ):
+    """
+    Write the grain starting at sector lba, grains have to be written in order, skipped grains read as zeros.
+    """
+    self.stats[ 'grains' ] += 1
+    self.stats[ 'bytes_in' ] += len( buff )
+    if len( buff ) < len( _ZERO_GRAIN ):  # the end of the disk
+      buff = buff + bytes( len( _ZERO_GRAIN ) - len( buff ) )
+
+    if buff == _ZERO_GRAIN:
+      self.stats[ 'zero_grains' ] += 1
+      return
+
+    self.pending.append( ( lba, _get_executor().submit( _deflate, buff, DEFLATE_LEVEL ) ) )
+    while len( self.pending ) > DEFLATE_QUEUE:
+      self._write_grain()
+
+  def write( self, buff ):
+    """
+    Write the next part of a flat image.
+    """
+    grain_bytes = GRAIN_SIZE * SECTOR_SIZE
+    if self.buff:
+      count = grain_bytes - len( self.buff )
+      self.buff += buff[ :count ]
+      buff = buff[ count: ]
+      if len( self.buff ) < grain_bytes:
+        return
+
+      self.write_grain( self.lba, self.buff )
+      self.lba += GRAIN_SIZE
+      self.buff = b''
+
+    view = memoryview( buff )
+    pos = 0
+    while len( view ) - pos >= grain_bytes:
+      self.write_grain( self.lba, view[ pos:pos + grain_bytes ].tobytes() )
+      self.lba += GRAIN_SIZE
+      pos += grain_bytes
+
+    self.buff = view[ pos: ].tobytes()
+
+  def close( self ):
+    if self.buff:
+      self.write_grain( self.lba, self.buff )
+      self.lba += GRAIN_SIZE
+      self.buff = b''
+
+    while self.pending:
+      self._write_grain()
+
+    while self.gt_index < len( self.gd ):
+      self._write_gt()
+
+    gd_size = _sectors( len( self.gd ) * 4 )
+    self._marker( gd_size, MARKER_GD )
+    gd_offset = self.offset // SECTOR_SIZE
+    self._write( struct.pack( '<{0}I'.format( len( self.gd ) ), *self.gd ) )
+    self._pad_sector()
+
+    self._marker( 1, MARKER_FOOTER )
+    self._write( self._header( gd_offset ) )
+    self._marker( 0, MARKER_EOS )
+
+    self.digest = self.hash.hexdigest()
+    self.stats[ 'bytes_out' ] = self.offset
+    self.stats[ 'elapsed' ] = time.monotonic() - self._begin
+    stats = self.stats
+    logging.info( 'vmdk: converted "{0}" {1} -> {2} bytes ({3:.1f}%), {4} of {5} grains zero, deflate {6:.1f}s cpu in {7:.1f}s'.format(
+                  self.name, stats[ 'bytes_in' ], stats[ 'bytes_out' ], stats[ 'bytes_out' ] * 100.0 / max( stats[ 'bytes_in' ], 1 ),
+                  stats[ 'zero_grains' ], stats[ 'grains' ], stats[ 'deflate_time' ], stats[ 'elapsed' ] ) )
+
+
+def _sparse_grains( fd ):
+  """
+  Iterate over the allocated grains of the hosted sparse VMDK open on fd, yields ( lba, grain ).
+  """
+  header = read_header( os.pread( fd, SECTOR_SIZE, 0 ) )
+  grain_size = header[ 'grain_size' ]
+  gtes_per_gt = header[ 'gtes_per_gt' ]
+  gd_count = ( header[ 'capacity' ] + grain_size * gtes_per_gt - 1 ) // ( grain_size * gtes_per_gt )
+  gd_offset = header[ 'gd_offset' ] if header[ 'gd_offset' ] not in ( 0, GD_AT_END ) else header[ 'rgd_offset' ]
+  gd = struct.unpack( '<{0}I'.format( gd_count ), os.pread( fd, gd_count * 4, gd_offset * SECTOR_SIZE ) )
+  for gd_index, gt_offset in enumerate( gd ):
+    if not gt_offset:
+      continue
+
+    gt = struct.unpack( '<{0}I'.format( gtes_per_gt ), os.pread( fd, gtes_per_gt * 4, gt_offset * SECTOR_SIZE ) )
+    for gt_index, grain_offset in enumerate( gt ):
+      if grain_offset <= 1:  # 0 is unallocated, 1 is zeroed
+        continue
+
+      lba = ( gd_index * gtes_per_gt + gt_index ) * grain_size
+      if lba >= header[ 'capacity' ]:
+        return
+
+      size = min( grain_size, header[ 'capacity' ] - lba ) * SECTOR_SIZE
+      buff = os.pread( fd, size, grain_offset * SECTOR_SIZE )
+      if len( buff ) != size:
+        raise ValueError( 'Sparse VMDK ended in a grain' )
+
+      yield lba, buff
+
+
+def convert_file( path, file, name ):
+  """
+  Convert the flat or hosted sparse disk image at path to streamOptimized, written to file, returns the StreamOptimizedWriter.
+  """
+  with open( path, 'rb' ) as source:
+    header = read_header( source.read( SECTOR_SIZE ) )
+    if header is None:
+      writer = StreamOptimizedWriter( file, os.fstat( source.fileno() ).st_size, name )
+      source.seek( 0 )
+      buff = source.read( GRAIN_SIZE * SECTOR_SIZE * 64 )
+      while buff:
+        writer.write( buff )
+        buff = source.read( GRAIN_SIZE * SECTOR_SIZE * 64 )
+
+    else:
+      if header[ 'grain_size' ] != GRAIN_SIZE:
+        raise ValueError( 'Grain size of {0} sectors is not supported'.format( header[ 'grain_size' ] ) )
+
+      writer = StreamOptimizedWriter( file, header[ 'capacity' ] * SECTOR_SIZE, name )
+      for lba, buff in _sparse_grains( source.fileno() ):
+        writer.write_grain( lba, buff )
+
+  writer.close()
+  return writer
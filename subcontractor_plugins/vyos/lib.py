@@ -1,30 +1,17 @@
 import logging
-import ssl
-import http
 import json
 from urllib import request, parse
 
+from subcontractor_plugins.common.connection import build_opener, unverified_context
+
 # from subcontractor.credentials import getCredentials
 
 
 def _get_opener( proxy=None, verify_ssl=False ):
-  result = request.OpenerDirector()
-
-  if proxy:  # not doing 'is not None', so empty strings don't try and proxy   # have a proxy option to take it from the envrionment vars
-    result.add_handler( request.ProxyHandler( { 'http': proxy, 'https': proxy } ) )
-  else:
-    result.add_handler( request.ProxyHandler( {} ) )
-
-  result.add_handler( request.HTTPHandler() )
-  if hasattr( http.client, 'HTTPSConnection' ):
-    if not verify_ssl:
-      result.add_handler( request.HTTPSHandler( context=ssl._create_unverified_context() ) )
-    else:
-      result.add_handler( request.HTTPSHandler() )
+  if verify_ssl:
+    return build_opener( proxy )
 
-  result.add_handler( request.UnknownHandler() )
-
-  return result
+  return build_opener( proxy, unverified_context() )
 
 
 def _send( host, auth_key, data ):